@@ -30,6 +30,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rancid.lib.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -43,7 +44,7 @@ ROOT_URLCONF = 'djancid.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'rancid.lib.metrics.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR,'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -108,6 +109,56 @@ RANCID_SETTINGS_DIR = '/etc/rancid/'
 RANCID_BIN_DIR = '/var/lib/rancid/bin/'
 RANCID_ROOT = '/var/lib/rancid/'
 
+# Lock files for djancid's own edits to router.db, .cloginrc and rancid.conf.
+# FILE_LOCK_DIR defaults to RANCID_ROOT when None.
+FILE_LOCK_DIR = None
+FILE_LOCK_TIMEOUT = 10
+# Seconds a page waits for rancid-run to release a group before editing its router.db,
+# after which the user is asked to try again. Jobs such as removing a deleted group's
+# files wait RANCID_RUN_JOB_WAIT seconds, then are queued again
+RANCID_RUN_LOCK_WAIT = 5
+RANCID_RUN_JOB_WAIT = 600
+
+# Seconds a non-staff user's permitted groups stay in the cache. Changes made in
+# this process invalidate them at once; with a per-process cache backend other
+# workers pick them up after this timeout.
+PERMISSION_CACHE_TIMEOUT = 60
+
+CHANGES_PAGE_SIZE = 20
+CHANGES_MAX_PAGE_SIZE = 200
+
+# Bytes of historical config blobs kept in memory per process
+BLOB_CACHE_BYTES = 64 * 1024 * 1024
+# Seconds an unused git repository handle, with its cat-file processes, stays open
+REPO_POOL_IDLE_TIMEOUT = 300
+# Seconds a diff between two blobs stays in the cache backend. Blobs never change, so
+# this only bounds memory use
+BLOB_DIFF_CACHE_TIMEOUT = 7 * 24 * 3600
+# Configs compared side by side may total at most this many bytes, and git gets this
+# many seconds to diff them, before the page says they are too large to compare
+COMPARE_MAX_BYTES = 32 * 1024 * 1024
+COMPARE_TIMEOUT = 10
+
+# Config search index files. SEARCH_INDEX_DIR defaults to RANCID_ROOT when None.
+SEARCH_INDEX_DIR = None
+SEARCH_MAX_RESULTS = 200
+SEARCH_MAX_LINES = 20
+
+# Seconds between queue checks by "manage.py rancidworker"
+JOB_POLL_INTERVAL = 2
+# Jobs a worker runs at once, like rancid's PAR_COUNT. Collection jobs for the same
+# group are never run together
+JOB_PAR_COUNT = 4
+# Seconds between a worker's heartbeats for the jobs it is running. A running job with
+# no heartbeat for JOB_HEARTBEAT_TIMEOUT seconds is failed, as its worker has died
+JOB_HEARTBEAT_INTERVAL = 30
+JOB_HEARTBEAT_TIMEOUT = 300
+JOBS_PAGE_SIZE = 50
+
+# Addresses and networks allowed to read /metrics. Each request's file, git, query and
+# template totals are also logged to the rancid.metrics logger at INFO
+METRICS_ALLOWED_IPS = ["127.0.0.1","::1"]
+
 DBSETTINGS = ["deviceType","status"]
 RCSETTINGS = [
     "method","autoenable","prompt","cyphertype",
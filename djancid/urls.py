@@ -16,12 +16,13 @@ Including another URLconf
 from django.conf.urls import url,include
 from django.contrib import admin
 from django.contrib.auth import views as auth_views
-from rancid.views import AllDevices
+from rancid.views import AllDevices,Metrics
 
 urlpatterns = [
     url(r'^$', AllDevices.as_view(), name='AllDevice'),
     url(r'^login/$', auth_views.login, name='login'),
     url(r'^logout/$', auth_views.logout, {'next_page':'login'}, name='logout'),
     url(r'^rancid/', include('rancid.urls')),
+    url(r'^metrics$', Metrics.as_view(), name='Metrics'),
     url(r'^admin/', admin.site.urls),
 ]
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class RancidConfig(AppConfig):
     name = 'rancid'
+
+    def ready(self):
+        import rancid.signals
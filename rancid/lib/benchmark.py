@@ -0,0 +1,102 @@
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from django.conf import settings
+from django.test.utils import override_settings
+from rancid.lib import fileops
+from rancid.lib.fileops import RouterDB,Cloginrc,RancidConf
+from rancid.lib.gitops import get_config_diffs,get_config_diff_page
+from rancid.lib.main import DjancidGroup,DjancidDevice
+from rancid.lib.synthetic import build_tree,group_name,device_name
+
+COLD_START_SCRIPT = """
+import time
+start = time.perf_counter()
+import django
+django.setup()
+import djancid.urls
+print(time.perf_counter() - start)
+"""
+
+def summarise(name,timings,**extra):
+    '''Machine readable summary of a list of timings in seconds'''
+    result = {
+        "name":name,
+        "runs":len(timings),
+        "min":min(timings),
+        "median":statistics.median(timings),
+        "max":max(timings),
+    }
+    result.update(extra)
+    return(result)
+
+def time_cold_start(runs=5):
+    '''Time what a new mod_wsgi worker does before serving its first request:
+    django.setup() plus importing the URLconf, which pulls in every view and rancid.lib
+    module. Each run uses a fresh interpreter'''
+    env = dict(os.environ)
+    env.setdefault("DJANGO_SETTINGS_MODULE","djancid.settings")
+    timings = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable,"-c",COLD_START_SCRIPT],cwd=settings.BASE_DIR,env=env)
+        timings.append(float(output.decode("ascii").split()[-1]))
+    return(summarise("cold_start",timings))
+
+def time_calls(function,runs,setup=None):
+    '''Seconds taken by each of runs calls of function, calling setup untimed before each'''
+    timings = []
+    for i in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return(timings)
+
+def clear_parsed_files():
+    '''Forget every parsed rancid file so the next read parses from disk'''
+    fileops._parsedFiles.clear()
+
+def parse_scale(scale):
+    '''(groups, devices per group, commits) from "GROUPSxDEVICESxCOMMITS"'''
+    groups,devices,commits = [int(n) for n in scale.lower().split("x")]
+    return((groups,devices,commits))
+
+def run_lib_benchmarks(groups,devices,commits,runs=5,lines=200,churn=0.05):
+    '''Time the rancid.lib hot paths against a synthetic tree of this size. Each result
+    is a summary from summarise(); "cold" runs parse their files from disk, "cached"
+    runs reuse the parsed file cache. Needs a database, as groups and devices read it'''
+    root = tempfile.mkdtemp(prefix="djancid-bench-")
+    try:
+        start = time.perf_counter()
+        overrides = build_tree(root,groups,devices,commits,lines,churn)
+        buildSeconds = time.perf_counter() - start
+        group = group_name(0)
+        device = device_name(0,devices // 2)
+        with override_settings(**overrides):
+            names = [router['ip'] for router in RouterDB(group).getAllRouters()]
+            results = [
+                summarise("routerdb_cold",time_calls(lambda: RouterDB(group).getAllRouters(),runs,clear_parsed_files),devices=devices),
+                summarise("routerdb_cached",time_calls(lambda: RouterDB(group).getAllRouters(),runs),devices=devices),
+                summarise("cloginrc_resolve_one_cold",time_calls(lambda: Cloginrc().getRouterDetails(device),runs,clear_parsed_files)),
+                summarise("cloginrc_resolve_group_cold",time_calls(lambda: Cloginrc().getAllRouterDetails(names),runs,clear_parsed_files),devices=devices),
+                summarise("rancidconf_cold",time_calls(lambda: RancidConf().expandSetting("LOGDIR"),runs,clear_parsed_files)),
+                summarise("group_construct_cold",time_calls(lambda: DjancidGroup(group),runs,clear_parsed_files)),
+                summarise("group_load_devices_cold",time_calls(lambda: DjancidGroup.loadDevices([DjancidGroup(group)]),runs,clear_parsed_files),devices=devices),
+                summarise("group_load_devices_cached",time_calls(lambda: DjancidGroup.loadDevices([DjancidGroup(group)]),runs),devices=devices),
+                summarise("device_construct_cached",time_calls(lambda: DjancidDevice(device,DjancidGroup(group)),runs)),
+                summarise("all_groups_load_devices_cold",time_calls(
+                    lambda: DjancidGroup.loadDevices([DjancidGroup(g) for g in RancidConf().readSetting("LIST_OF_GROUPS").split()]),
+                    runs,clear_parsed_files
+                ),devices=devices * groups),
+                summarise("config_diffs",time_calls(lambda: list(get_config_diffs(group,device)),runs)),
+                summarise("config_diff_page_cached",time_calls(lambda: get_config_diff_page(group,device),runs)),
+            ]
+        return({"groups":groups,"devices":devices,"commits":commits,"buildSeconds":buildSeconds,"results":results})
+    finally:
+        clear_parsed_files()
+        shutil.rmtree(root)
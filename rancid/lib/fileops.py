@@ -1,9 +1,26 @@
 from django.conf import settings
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+import fcntl
+import logging
 import os
+import re
+import stat
+import tempfile
+import threading
+import time
+from rancid.lib.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+_parsedFiles = {}
+_transactions = threading.local()
+_heldLocks = threading.local()
 
 def get_device_types():
     filePath = os.path.join(settings.RANCID_SETTINGS_DIR,'rancid.types.base')
-    with open(filePath,"r") as f:
+    with timed("file_read"),open(filePath,"r") as f:
         lines = f.readlines()
     typesRaw = [line.split(";")[0] for line in lines if ";" in line and "#" not in line]
     types = list(set(typesRaw))
@@ -11,214 +28,658 @@ def get_device_types():
     return(types)
 
 
-class RancidConf(object):
-    def __init__(self,confDir=settings.RANCID_SETTINGS_DIR):
+def file_signature(filePath):
+    '''(inode, mtime, size) of a file. Changes whenever the file is rewritten or replaced'''
+    fileStat = os.stat(filePath)
+    return((fileStat.st_ino,fileStat.st_mtime_ns,fileStat.st_size))
+
+
+def rewrite_in_place(filePath,lines):
+    '''Overwrite a file's contents through its existing inode, keeping its owner'''
+    with open(filePath,"r+") as f:
+        f.writelines(lines)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@timed("file_write")
+def atomic_write(filePath,lines):
+    '''Replace a file's contents through a temp file in the same directory that is fsynced
+    and renamed over the original, so readers never see a partly written file. The temp
+    file is given the original's mode, owner and group. Files we cannot do that for, such
+    as a .cloginrc owned by the rancid user, or that are in directories we cannot create
+    files in, are rewritten in place instead'''
+    dirName = os.path.dirname(filePath)
+    try:
+        fd,tempPath = tempfile.mkstemp(dir=dirName,prefix=".{n}.".format(n=os.path.basename(filePath)))
+    except PermissionError:
+        rewrite_in_place(filePath,lines)
+        return
+    try:
+        with os.fdopen(fd,"w") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+            tempStat = os.fstat(f.fileno())
+        if os.path.exists(filePath):
+            fileStat = os.stat(filePath)
+            os.chmod(tempPath,stat.S_IMODE(fileStat.st_mode))
+            if (tempStat.st_uid,tempStat.st_gid) != (fileStat.st_uid,fileStat.st_gid):
+                try:
+                    os.chown(tempPath,fileStat.st_uid,fileStat.st_gid)
+                except PermissionError:
+                    os.unlink(tempPath)
+                    rewrite_in_place(filePath,lines)
+                    return
+        os.rename(tempPath,filePath)
+    except:
+        if os.path.exists(tempPath):
+            os.unlink(tempPath)
+        raise
+    dirFd = os.open(dirName,os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+
+def lock_path(filePath):
+    '''Sidecar file that FileLock locks for a rancid file. Lock files live in FILE_LOCK_DIR
+    (RANCID_ROOT by default) because /etc/rancid is usually not writable'''
+    lockDir = getattr(settings,"FILE_LOCK_DIR",None) or settings.RANCID_ROOT
+    lockName = ".djancid{p}.lock".format(p=os.path.abspath(filePath).replace(os.sep,"_"))
+    return(os.path.join(lockDir,lockName))
+
+
+class FileLock(object):
+    '''Exclusive fcntl lock that serialises read-modify-write cycles on a rancid file
+    across threads and processes. Re-entrant within a thread. Waits for at most timeout
+    seconds (FILE_LOCK_TIMEOUT by default) and keeps per-process wait statistics'''
+    stats = {"acquired":0,"contended":0,"timeouts":0,"waitSeconds":0.0,"maxWaitSeconds":0.0}
+    statsLock = threading.Lock()
+    def __init__(self,filePath,timeout=None):
+        self.filePath = filePath
+        self.lockPath = lock_path(filePath)
+        if timeout is None:
+            timeout = getattr(settings,"FILE_LOCK_TIMEOUT",10)
+        self.timeout = timeout
+    def heldLocks(self):
+        if not hasattr(_heldLocks,"locks"):
+            _heldLocks.locks = {}
+        return(_heldLocks.locks)
+    def acquire(self):
+        held = self.heldLocks()
+        if self.lockPath in held:
+            held[self.lockPath][1] += 1
+            return
+        fd = os.open(self.lockPath,os.O_RDWR | os.O_CREAT,0o600)
+        start = time.time()
+        contended = False
+        while True:
+            try:
+                fcntl.flock(fd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                contended = True
+                if time.time() - start >= self.timeout:
+                    os.close(fd)
+                    self.recordWait(time.time() - start,contended,timedOut=True)
+                    raise(self.LockTimeout("Timed out after {t}s waiting for lock on {f}".format(t=self.timeout,f=self.filePath)))
+                time.sleep(0.01)
+        self.recordWait(time.time() - start,contended)
+        held[self.lockPath] = [fd,1]
+    def release(self):
+        held = self.heldLocks()
+        held[self.lockPath][1] -= 1
+        if held[self.lockPath][1] == 0:
+            fd = held.pop(self.lockPath)[0]
+            fcntl.flock(fd,fcntl.LOCK_UN)
+            os.close(fd)
+    def recordWait(self,waited,contended,timedOut=False):
+        with self.statsLock:
+            if timedOut:
+                self.stats['timeouts'] += 1
+            else:
+                self.stats['acquired'] += 1
+            if contended:
+                self.stats['contended'] += 1
+            self.stats['waitSeconds'] += waited
+            self.stats['maxWaitSeconds'] = max(self.stats['maxWaitSeconds'],waited)
+        if waited >= 1:
+            logger.warning("Waited %.2fs for lock on %s",waited,self.filePath)
+    def __enter__(self):
+        self.acquire()
+        return(self)
+    def __exit__(self,excType,excValue,traceback):
+        self.release()
+        return(False)
+    class LockTimeout(Exception):
+        pass
+
+
+def rancid_run_lock_path(group):
+    '''Lock file that rancid-run creates in its TMPDIR while it collects a group'''
+    try:
+        tmpDir = RancidConf().expandSetting("TMPDIR")
+    except RancidConf.SettingNotExistException:
+        tmpDir = "/tmp"
+    return(os.path.join(tmpDir,".{g}.run.lock".format(g=group)))
+
+
+class RancidRunBusy(Exception):
+    pass
+
+
+def rancid_run_lock_stale(runLock):
+    '''True if a rancid-run lock file is older than rancid.conf's LOCKTIME hours (4 by
+    default), the age at which rancid-run itself reports a lock as stale'''
+    try:
+        lockTime = float(RancidConf().readSetting("LOCKTIME"))
+    except (RancidConf.SettingNotExistException,ValueError):
+        lockTime = 4
+    try:
+        return(time.time() - os.stat(runLock).st_mtime > lockTime * 3600)
+    except FileNotFoundError:
+        return(False)
+
+
+def wait_for_rancid_run(group,timeout=None):
+    '''Wait up to timeout seconds (RANCID_RUN_LOCK_WAIT by default) for a running
+    rancid-run to release a group. Raises RancidRunBusy if it still holds the group.
+    A stale lock left by a rancid-run that died is ignored with a warning'''
+    if timeout is None:
+        timeout = settings.RANCID_RUN_LOCK_WAIT
+    runLock = rancid_run_lock_path(group)
+    deadline = time.time() + timeout
+    while os.path.exists(runLock):
+        if rancid_run_lock_stale(runLock):
+            logger.warning("Ignoring stale rancid-run lock %s",runLock)
+            return
+        if time.time() >= deadline:
+            raise(RancidRunBusy("rancid-run is collecting {g}, try again once it has finished".format(g=group)))
+        time.sleep(min(0.5,max(deadline - time.time(),0.01)))
+
+
+def locked_mutation(method):
+    '''Decorator for ParsedFile methods that read-modify-write their file'''
+    @wraps(method)
+    def wrapper(self,*args,**kwargs):
+        with self.mutation():
+            return(method(self,*args,**kwargs))
+    return(wrapper)
+
+
+class FileTransaction(object):
+    '''Context manager that batches edits made through ParsedFile objects. Edits are applied
+    to in-memory copies which later reads in the same thread see, and each changed file is
+    written once with atomic_write when the outermost transaction exits cleanly. Nested
+    transactions join the outer one; an exception discards every pending edit'''
+    def __init__(self):
+        self.files = OrderedDict()
+        self.locks = OrderedDict()
+        self.outer = None
+    def __enter__(self):
+        self.outer = getattr(_transactions,"current",None)
+        if self.outer is None:
+            _transactions.current = self
+        return(self)
+    def __exit__(self,excType,excValue,traceback):
+        if self.outer is not None:
+            return(False)
+        _transactions.current = None
+        try:
+            if excType is None:
+                self.commit()
+        finally:
+            self.releaseLocks()
+        return(False)
+    @staticmethod
+    def current():
+        return(getattr(_transactions,"current",None))
+    def lock(self,filePath):
+        '''Lock a file until the transaction ends'''
+        if filePath not in self.locks:
+            fileLock = FileLock(filePath)
+            fileLock.acquire()
+            self.locks[filePath] = fileLock
+    def releaseLocks(self):
+        for fileLock in reversed(list(self.locks.values())):
+            fileLock.release()
+        self.locks = OrderedDict()
+    def commit(self):
+        for filePath,(lines,parsed) in self.files.items():
+            atomic_write(filePath,lines)
+            _parsedFiles.pop(filePath,None)
+        self.files = OrderedDict()
+
+
+class ParsedFile(object):
+    '''Inheritable class for rancid files that are parsed once per change. The parsed
+    contents are shared by every instance pointing at the same path within the process
+    and are thrown away when the file's signature changes'''
+    filePath = None
+    def parse(self,lines):
+        raise(NotImplementedError)
+    def load(self):
+        '''Return the parsed contents, re-reading the file only if it changed on disk.
+        Inside a FileTransaction, pending edits to the file are included'''
+        transaction = FileTransaction.current()
+        if transaction is not None and self.filePath in transaction.files:
+            lines,parsed = transaction.files[self.filePath]
+            if parsed is None:
+                parsed = self.parse(lines)
+                transaction.files[self.filePath] = (lines,parsed)
+            return(parsed)
+        signature = file_signature(self.filePath)
+        cached = _parsedFiles.get(self.filePath)
+        if cached is not None and cached[0] == signature:
+            return(cached[1])
+        with timed("file_read"),open(self.filePath,"r") as f:
+            lines = f.readlines()
+        parsed = self.parse(lines)
+        _parsedFiles[self.filePath] = (signature,parsed)
+        return(parsed)
+    @contextmanager
+    def mutation(self):
+        '''Hold the file's lock around a read-modify-write. Inside a FileTransaction the
+        lock is taken on first use and kept until the transaction ends'''
+        transaction = FileTransaction.current()
+        if transaction is not None:
+            transaction.lock(self.filePath)
+            yield
+        else:
+            with FileLock(self.filePath):
+                yield
+    def writeLines(self,lines):
+        '''Replace the file's contents, or stage them if a FileTransaction is active'''
+        transaction = FileTransaction.current()
+        if transaction is not None:
+            transaction.files[self.filePath] = (lines,None)
+        else:
+            atomic_write(self.filePath,lines)
+            _parsedFiles.pop(self.filePath,None)
+
+
+def shell_value(text,start):
+    '''Read a shell word starting at text[start]. Returns the unquoted value and the index
+    just after the word'''
+    value = []
+    i = start
+    while i < len(text) and not text[i].isspace() and text[i] != ";":
+        if text[i] in "\"'":
+            quote = text[i]
+            i += 1
+            while i < len(text) and text[i] != quote:
+                if quote == '"' and text[i] == "\\" and i + 1 < len(text):
+                    i += 1
+                value.append(text[i])
+                i += 1
+            i += 1
+        else:
+            if text[i] == "\\" and i + 1 < len(text):
+                i += 1
+            value.append(text[i])
+            i += 1
+    return(("".join(value),min(i,len(text))))
+
+
+class RancidConf(ParsedFile):
+    '''rancid.conf parsed into its shell variable assignments. As in the shell, the last
+    assignment of a variable wins. The parsed file is shared by every RancidConf in the
+    process and only re-read when the file changes'''
+    assignmentRe = re.compile(r"^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=")
+    variableRe = re.compile(r"\$(?:\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*))")
+    def __init__(self,confDir=None):
+        if confDir is None:
+            confDir = settings.RANCID_SETTINGS_DIR
         self.confDir = os.path.join(confDir,"rancid.conf")
-    def readSetting(self,setting):
-        '''Read a setting from the config file'''
-        with open(self.confDir,"r") as confFile:
-            lines = confFile.readlines()
+        self.filePath = self.confDir
+    def parse(self,lines):
+        '''Map each variable to (line number, value, start and end of the value in the line)'''
+        assignments = {}
+        for i,line in enumerate(lines):
+            match = self.assignmentRe.match(line)
+            if match:
+                value,end = shell_value(line,match.end())
+                assignments[match.group(1)] = (i,value,match.end(),end)
+        return({"lines":lines,"settings":assignments,"expanded":{}})
+    def findSetting(self,rancidConf,setting):
         try:
-            settingLine = [line for line in lines if line.startswith(setting)][0]
-        except IndexError:
+            return(rancidConf['settings'][setting])
+        except KeyError:
             raise(self.SettingNotExistException("Setting {s} does not exist".format(s=setting)))
-        output = settingLine.split(";")[0].split("=")[1].replace('"',"")
-        return(output)
+    def readSetting(self,setting):
+        '''Read a setting from the config file, with quotes removed'''
+        return(self.findSetting(self.load(),setting)[1])
+    def expandSetting(self,setting):
+        '''Read a setting with $VAR and ${VAR} references expanded. Variables come from
+        earlier assignments in the file and then the environment. $BASEDIR is always
+        RANCID_ROOT so that paths agree with the rest of djancid'''
+        rancidConf = self.load()
+        if setting not in rancidConf['expanded']:
+            lineIndex,value,start,end = self.findSetting(rancidConf,setting)
+            def expand(match):
+                name = match.group(1) or match.group(2)
+                if name == "BASEDIR":
+                    return(settings.RANCID_ROOT.rstrip("/"))
+                if name in rancidConf['settings'] and rancidConf['settings'][name][0] < lineIndex:
+                    return(self.expandSetting(name))
+                return(os.environ.get(name,""))
+            rancidConf['expanded'][setting] = self.variableRe.sub(expand,value)
+        return(rancidConf['expanded'][setting])
+    @locked_mutation
+    def replaceValue(self,setting,newValue):
+        '''Rewrite the value of a setting in place, keeping the rest of the line'''
+        rancidConf = self.load()
+        lineIndex,oldValue,start,end = self.findSetting(rancidConf,setting)
+        lines = list(rancidConf['lines'])
+        line = lines[lineIndex]
+        lines[lineIndex] = '{b}"{v}"{a}'.format(b=line[:start],v=newValue.replace('"','\\"'),a=line[end:])
+        self.writeLines(lines)
+    @locked_mutation
     def writeSetting(self,setting,value):
         '''Completely replace a setting value with the supplied value'''
-        with open(self.confDir,"r") as confFile:
-            lines = confFile.readlines()
-        try:
-            settingLine = [line for line in lines if line.startswith(setting)][0]
-        except IndexError:
-            raise(self.SettingNotExistException("Setting {s} does not exist".format(s=setting)))
-        oldSetting = settingLine.split(";")[0].split("=")[1].replace('"',"")
-        for i,line in enumerate(lines):
-            if line == settingLine:
-                lines[i] = settingLine.replace(oldSetting,value)
-        with open(self.confDir,"w") as confFile:
-            confFile.writelines(lines)
+        self.replaceValue(setting,value)
+    @locked_mutation
     def appendValue(self,setting,value,seperator=" "):
         '''Append a value to the list of existing values for a setting'''
-        with open(self.confDir,"r") as confFile:
-            lines = confFile.readlines()
-        try:
-            settingLine = [line for line in lines if line.startswith(setting)][0]
-        except IndexError:
-            raise(self.SettingNotExistException("Setting {s} does not exist".format(s=setting)))
-        oldValues = settingLine.split(";")[0].split("=")[1].replace('"',"")
-        newValues = "{ov}{sp}{v}".format(ov=oldValues,sp=seperator,v=value)
-        for i,line in enumerate(lines):
-            if line == settingLine:
-                lines[i] = settingLine.replace(oldValues,newValues)
-        with open(self.confDir,"w") as confFile:
-            confFile.writelines(lines)
+        oldValues = self.readSetting(setting)
+        if oldValues:
+            newValues = "{ov}{sp}{v}".format(ov=oldValues,sp=seperator,v=value)
+        else:
+            newValues = value
+        self.replaceValue(setting,newValues)
+    @locked_mutation
     def deleteValue(self,setting,value,seperator=" "):
         '''Remove a single value from a list of values for a setting'''
-        with open(self.confDir,"r") as confFile:
-            lines = confFile.readlines()
-        try:
-            settingLine = [line for line in lines if line.startswith(setting)][0]
-        except IndexError:
-            raise(self.SettingNotExistException("Setting {s} does not exist".format(s=setting)))
-        oldValues = settingLine.split(";")[0].split("=")[1].replace('"',"")
-        oldValuesList = oldValues.split(seperator)
+        oldValuesList = self.readSetting(setting).split(seperator)
         try:
             oldValuesList.remove(value)
         except ValueError:
             raise(self.ValueNotExistException("{v} is not in list of values for setting {s}".format(v=value,s=setting)))
-        newValues = seperator.join(oldValuesList)
-        for i,line in enumerate(lines):
-            if line == settingLine:
-                lines[i] = settingLine.replace(oldValues,newValues)
-        with open(self.confDir,"w") as confFile:
-            confFile.writelines(lines)
+        self.replaceValue(setting,seperator.join(oldValuesList))
     class SettingNotExistException(Exception):
         pass
     class ValueNotExistException(Exception):
         pass
 
-class RouterDB(object):
-    def __init__(self,groupName,rancidRoot=settings.RANCID_ROOT):
+class RouterDB(ParsedFile):
+    '''router.db for a single group. The parsed file is indexed by exact device name and
+    shared between every RouterDB for the same group'''
+    def __init__(self,groupName,rancidRoot=None):
+        if rancidRoot is None:
+            rancidRoot = settings.RANCID_ROOT
+        self.groupName = groupName
         self.routerDBDir = os.path.join(rancidRoot,groupName,"router.db")
+        self.filePath = self.routerDBDir
         if not os.path.exists(self.routerDBDir):
             raise(FileNotFoundError("File {f} does not exist".format(f=self.routerDBDir)))
-    def addRouter(self,ip,deviceType="cisco",status="up"):
+    def mutation(self):
+        '''Also give a running rancid-run up to RANCID_RUN_LOCK_WAIT seconds to finish
+        with the group before router.db is changed. Raises RancidRunBusy if it has not'''
+        wait_for_rancid_run(self.groupName)
+        return(super(RouterDB,self).mutation())
+    def parse(self,lines):
+        '''Returns the raw lines plus an ordered index of name -> (line number, details)'''
+        routers = OrderedDict()
+        for i,line in enumerate(lines):
+            router = line.rstrip("\n").split(";")
+            if len(router) >= 3 and router[0] and not router[0].startswith("#"):
+                if router[0] not in routers:
+                    routers[router[0]] = (i,{"ip":router[0],"deviceType":router[1],"status":router[2] != "down"})
+        return({"lines":lines,"routers":routers})
+    def statusString(self,status):
         if isinstance(status,bool):
             if status:
-                statusStr = "up"
+                return("up")
             else:
-                statusStr = "down"
-        with open(self.routerDBDir,"r") as routerDBFile:
-            lines = routerDBFile.readlines()
-        for line in lines:
-            if line.startswith(ip):
-                raise(self.RouterAlreadyExistsException("Router {r} already exists".format(r=ip)))
-        lines.append("{ip};{dt};{st}\n".format(ip=ip,dt=deviceType,st=statusStr))
-        with open(self.routerDBDir,"w") as routerDBFile:
-            routerDBFile.writelines(lines) 
+                return("down")
+        return(str(status))
+    @locked_mutation
+    def addRouter(self,ip,deviceType="cisco",status="up"):
+        routerDB = self.load()
+        if ip in routerDB['routers']:
+            raise(self.RouterAlreadyExistsException("Router {r} already exists".format(r=ip)))
+        lines = list(routerDB['lines'])
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] = "{l}\n".format(l=lines[-1])
+        lines.append("{ip};{dt};{st}\n".format(ip=ip,dt=deviceType,st=self.statusString(status)))
+        self.writeLines(lines)
+    @locked_mutation
     def deleteRouter(self,ip):
-        with open(self.routerDBDir,"r") as routerDBFile:
-            lines = routerDBFile.readlines()
-        lines = [line for line in lines if ip not in line]
-        with open(self.routerDBDir,"w") as routerDBFile:
-            routerDBFile.writelines(lines)
+        routerDB = self.load()
+        if ip in routerDB['routers']:
+            lines = [line for i,line in enumerate(routerDB['lines']) if i != routerDB['routers'][ip][0]]
+            self.writeLines(lines)
     def editRouter(self,ip,deviceType=None,status=None):
-        with open(self.routerDBDir,"r") as routerDBFile:
-            lines = routerDBFile.readlines()
-        for i,line in enumerate(lines):
-            if line.startswith(ip):
-                routerLine = line.split(";")
-                if deviceType is not None:
-                    routerLine[1] = deviceType
-                if status is not None:
-                    if isinstance(status,bool):
-                        if status:
-                            statusStr = "up"
-                        else:
-                            statusStr = "down"
-                    else:
-                        statusStr = str(status)
-                    routerLine[2] = statusStr
-                lines[i] = "{l}\n".format(l=";".join(routerLine))
-        with open(self.routerDBDir,"w") as routerDBFile:
-            routerDBFile.writelines(lines)
+        self.editRouters({ip:(deviceType,status)})
+    @locked_mutation
+    def editRouters(self,changes):
+        '''Edit many routers with one rewrite. changes maps name -> (deviceType,status),
+        where None leaves that field as it is. Unknown routers are ignored'''
+        routerDB = self.load()
+        lines = list(routerDB['lines'])
+        changed = False
+        for ip,(deviceType,status) in changes.items():
+            if ip not in routerDB['routers']:
+                continue
+            lineIndex = routerDB['routers'][ip][0]
+            routerLine = lines[lineIndex].rstrip("\n").split(";")
+            if deviceType is not None:
+                routerLine[1] = deviceType
+            if status is not None:
+                routerLine[2] = self.statusString(status)
+            newLine = "{l}\n".format(l=";".join(routerLine))
+            if newLine != lines[lineIndex]:
+                lines[lineIndex] = newLine
+                changed = True
+        if changed:
+            self.writeLines(lines)
     def getRouterDetails(self,ip):
-        with open(self.routerDBDir,"r") as routerDBFile:
-            lines = routerDBFile.readlines()
-        routerLines = [line for line in lines if line.startswith(ip)]
-        if routerLines and ip:
-            router = routerLines[0].replace("\n","").split(";")
-        else:
+        routers = self.load()['routers']
+        if not ip or ip not in routers:
             raise(self.RouterNotFoundException("Router does not exist: {r}".format(r=ip)))
-        if router[2] == "down":
-            status = False
-        else:
-            status = True
-        routerOutput = {"ip":ip,"deviceType":router[1],"status":status}
-        return(routerOutput)
+        return(dict(routers[ip][1]))
     def getAllRouters(self):
-        with open(self.routerDBDir,"r") as routerDBFile:
-            lines = routerDBFile.readlines()
-        routerLines = []
-        for line in lines:
-            router = line.replace("\n","").split(";")
-            if len(router) == 3:
-                if router[2] == "down":
-                    status = False
-                else:
-                    status = True
-                routerLines.append({"ip":router[0],"deviceType":router[1],"status":status})
-        return(routerLines)
+        return([dict(router) for i,router in self.load()['routers'].values()])
     class RouterAlreadyExistsException(Exception):
         pass
     class RouterNotFoundException(Exception):
         pass
 
-class Cloginrc(object):
-    def __init__(self,cloginrcDir=os.path.join(settings.RANCID_ROOT,".cloginrc")):
-        self.cloginrcDir = cloginrcDir
-    def getRouterDetails(self,ip):
-        with open(self.cloginrcDir,"r") as cloginrcFile:
-            lines = cloginrcFile.readlines()
-        routerLines = [line for line in lines if ip in line]
-        details = {}
-        if routerLines:
-            for line in routerLines:
-                lineSplit = line.split(" ")
-                if len(lineSplit) == 4:
-                    value = lineSplit[3].replace("{","").replace("}","").replace("\n","")
-                    if value in ["0","1"]:
-                        value = bool(int(value))
-                elif len(lineSplit) > 4:
-                    value = []
-                    for item in lineSplit[3:]:
-                        item = item.replace("{","").replace("}","").replace("\n","")
-                        if item in ["0","1"]:
-                             item = bool(int(item))
-                        value.append(item)
-                details[lineSplit[1]] = value 
+def tcl_words(line):
+    '''Split a line into Tcl words. Braced words are returned without their outer braces'''
+    words = []
+    i = 0
+    while i < len(line):
+        if line[i].isspace():
+            i += 1
+        elif line[i] == "{":
+            depth = 1
+            j = i + 1
+            while j < len(line) and depth:
+                if line[j] == "{":
+                    depth += 1
+                elif line[j] == "}":
+                    depth -= 1
+                j += 1
+            words.append(line[i+1:j-1] if not depth else line[i+1:j])
+            i = j
         else:
-            raise(self.NoRouterDetails("No details configured for router: {ip}".format(ip=ip)))
-        return(details)
-    def addDetail(self,ip,name,value):
-        if name not in settings.RCSETTINGS:
-            raise(self.InvalidDetailName("{n} is not a valid cloginrc command".format(n=name)))
-        with open(self.cloginrcDir,"r") as cloginrcFile:
-            lines = cloginrcFile.readlines()
-        lines = [line for line in lines if "{n} {i}".format(n=name,i=ip) not in line]
+            j = i
+            while j < len(line) and not line[j].isspace():
+                j += 1
+            words.append(line[i:j])
+            i = j
+    return(words)
+
+
+def tcl_glob_to_regex(pattern):
+    '''Compile a Tcl "string match -nocase" pattern, as used by clogin to match hosts'''
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "*":
+            regex.append(".*")
+        elif char == "?":
+            regex.append(".")
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        elif char == "[" and "]" in pattern[i+1:]:
+            end = pattern.index("]",i+1)
+            regex.append("[{c}]".format(c="".join(["\\"+c if c in "\\^]" else c for c in pattern[i+1:end]])))
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return(re.compile("(?:{r})\\Z".format(r="".join(regex)),re.IGNORECASE | re.DOTALL))
+
+
+class Cloginrc(ParsedFile):
+    '''.cloginrc compiled into per-host and wildcard entries. Settings for a host are resolved
+    the way clogin does it: for each command the first matching "add" line in the file wins.
+    method and password take a list of values, such as the login and enable passwords, and
+    are always returned as a list. Every other command has a single value'''
+    globChars = set("*?[\\")
+    listCommands = ("method","password")
+    def __init__(self,cloginrcDir=None):
+        if cloginrcDir is None:
+            cloginrcDir = os.path.join(settings.RANCID_ROOT,".cloginrc")
+        self.cloginrcDir = cloginrcDir
+        self.filePath = self.cloginrcDir
+    def parse(self,lines):
+        '''Index the add commands by exact host and by glob pattern. Each index maps
+        command name -> (line number, value) for the first line of that command'''
+        entries = []
+        exact = {}
+        globs = OrderedDict()
+        for i,line in enumerate(lines):
+            words = tcl_words(line)
+            if len(words) < 4 or words[0] != "add":
+                continue
+            name,pattern = words[1],words[2]
+            entries.append((i,name,pattern))
+            if self.globChars.intersection(pattern):
+                if pattern not in globs:
+                    globs[pattern] = (tcl_glob_to_regex(pattern),{})
+                commands = globs[pattern][1]
+            else:
+                commands = exact.setdefault(pattern.lower(),{})
+            if name not in commands:
+                commands[name] = (i,self.parseValue(name,words[3:]))
+        return({"lines":lines,"entries":entries,"exact":exact,"globs":globs,"resolved":{}})
+    def parseValue(self,name,words):
+        values = []
+        for word in words:
+            if word in ["0","1"]:
+                values.append(bool(int(word)))
+            else:
+                values.append(word)
+        if name in self.listCommands:
+            return(values)
+        # clogin uses the first value of single valued commands
+        return(values[0])
+    def formatValue(self,value):
         if isinstance(value,bool):
-            valueStr = "{{{v}}}".format(v=str(int(value)))
+            return("{{{v}}}".format(v=str(int(value))))
         elif isinstance(value,list):
-            valueStr = " ".join(["{{{v}}}".format(v=item) for item in value])
+            return(" ".join([self.formatValue(item) for item in value]))
         else:
-            valueStr = "{{{v}}}".format(v=value)
-        detailLine = "add {n} {ip} {v}\n".format(n=name,ip=ip,v=valueStr)
-        insertIndex = 0
-        for i,line in enumerate(lines):
-            if ip in line:
-                insertIndex = i
-                break
-        lines.insert(insertIndex,detailLine)
-        with open(self.cloginrcDir,"w") as cloginrcFile:
-            cloginrcFile.writelines(lines)
+            return("{{{v}}}".format(v=value))
+    def resolve(self,ip):
+        '''Effective settings for a host, memoised until the file changes'''
+        cloginrc = self.load()
+        if ip not in cloginrc['resolved']:
+            matches = []
+            if ip.lower() in cloginrc['exact']:
+                matches.append(cloginrc['exact'][ip.lower()])
+            for regex,commands in cloginrc['globs'].values():
+                if regex.match(ip):
+                    matches.append(commands)
+            winners = {}
+            for commands in matches:
+                for name,(lineIndex,value) in commands.items():
+                    if name not in winners or lineIndex < winners[name][0]:
+                        winners[name] = (lineIndex,value)
+            cloginrc['resolved'][ip] = dict([(name,value) for name,(lineIndex,value) in winners.items()])
+        return(cloginrc['resolved'][ip])
+    def hostDetails(self,ip):
+        '''Settings given on lines for exactly this host, ignoring wildcard entries'''
+        commands = self.load()['exact'].get(ip.lower(),{})
+        return(dict([(name,value) for name,(lineIndex,value) in commands.items()]))
+    def getRouterDetails(self,ip):
+        details = self.resolve(ip)
+        if not details:
+            raise(self.NoRouterDetails("No details configured for router: {ip}".format(ip=ip)))
+        return(dict([(k,list(v) if isinstance(v,list) else v) for k,v in details.items()]))
+    def getAllRouterDetails(self,ips):
+        '''Settings for many hosts from a single load of the file. Hosts without any
+        settings map to an empty dict'''
+        self.load()
+        allDetails = {}
+        for ip in ips:
+            try:
+                allDetails[ip] = self.getRouterDetails(ip)
+            except self.NoRouterDetails:
+                allDetails[ip] = {}
+        return(allDetails)
+    def addDetail(self,ip,name,value):
+        self.addAllRouterDetails({ip:{name:value}})
     def addDetails(self,ip,detailsDict):
-        for k,v in detailsDict.item():
-            self.addDetail(ip=ip,name=k,value=v)
+        self.addAllRouterDetails({ip:detailsDict})
+    @locked_mutation
+    def addAllRouterDetails(self,routerDetails):
+        '''Set settings for many hosts in one pass over the file. routerDetails maps host ->
+        {setting: value}. A host's new lines go where its first existing line was, or at
+        the top of the file so that they take precedence over wildcard entries'''
+        for details in routerDetails.values():
+            for name in details.keys():
+                if name not in settings.RCSETTINGS:
+                    raise(self.InvalidDetailName("{n} is not a valid cloginrc command".format(n=name)))
+        routerDetails = dict([(ip,details) for ip,details in routerDetails.items() if details])
+        if not routerDetails:
+            return
+        cloginrc = self.load()
+        dropLines = set([i for i,name,pattern in cloginrc['entries'] if name in routerDetails.get(pattern,{})])
+        firstLines = {}
+        for i,name,pattern in cloginrc['entries']:
+            if pattern in routerDetails and pattern not in firstLines and i not in dropLines:
+                firstLines[pattern] = i
+        topLines = []
+        insertLines = {}
+        for ip,details in routerDetails.items():
+            newLines = ["add {n} {ip} {v}\n".format(n=name,ip=ip,v=self.formatValue(value)) for name,value in details.items()]
+            if ip in firstLines:
+                insertLines.setdefault(firstLines[ip],[]).extend(newLines)
+            else:
+                topLines.extend(newLines)
+        lines = topLines
+        for i,line in enumerate(cloginrc['lines']):
+            lines.extend(insertLines.get(i,[]))
+            if i not in dropLines:
+                lines.append(line)
+        self.writeLines(lines)
+    @locked_mutation
     def deleteDetail(self,ip,name):
-        with open(self.cloginrcDir,"r") as cloginrcfile:
-            lines = cloginrcfile.readlines()
-        lines = [line for line in lines if "{n} {i}".format(n=name,i=ip) not in line]
-        with open(self.cloginrcDir,"w") as cloginrcFile:
-            cloginrcFile.writelines(lines)
+        cloginrc = self.load()
+        dropLines = set([i for i,n,pattern in cloginrc['entries'] if n == name and pattern == ip])
+        if dropLines:
+            self.writeLines([line for i,line in enumerate(cloginrc['lines']) if i not in dropLines])
     def deleteRouterDetails(self,ip):
-        with open(self.cloginrcDir,"r") as cloginrcFile:
-            lines = cloginrcFile.readlines()
-        lines = [line for line in lines if ip not in line]
-        with open(self.cloginrcDir,"w") as cloginrcFile:
-            cloginrcFile.writelines(lines)
+        self.deleteAllRouterDetails([ip])
+    @locked_mutation
+    def deleteAllRouterDetails(self,ips):
+        '''Remove every line for the given hosts in one pass over the file. Wildcard
+        entries are left alone'''
+        ips = set(ips)
+        cloginrc = self.load()
+        dropLines = set([i for i,n,pattern in cloginrc['entries'] if pattern in ips])
+        if dropLines:
+            self.writeLines([line for i,line in enumerate(cloginrc['lines']) if i not in dropLines])
     class InvalidDetailName(Exception):
         pass
     class NoRouterDetails(Exception):
         pass
-
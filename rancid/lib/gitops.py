@@ -1,31 +1,605 @@
 import os
-from git import Repo
-from rancid.lib.fileops import RancidConf
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from rancid.lib.fileops import file_signature
+from rancid.lib.metrics import timed
+from rancid.models import ConfigDiff,ConfigDiffHead,DeviceChange,DeviceChangeHead
 from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError,models,transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-confFile = RancidConf()
+SHA_RE = re.compile(r"^[0-9a-f]{40}$")
+NULL_SHA = "0" * 40
+# Stored in the cache backend in place of the lines of a diff that could not be made
+TOO_LARGE = "too large"
+
+_blobCache = None
+_blobCacheLock = threading.Lock()
+_repoClass = None
+
+
+class DiffTooLarge(Exception):
+    pass
+
+
+class BlobCache(object):
+    '''Least recently used cache of blob contents keyed by blob sha, bounded by their
+    total size. Blobs are immutable, so entries never need invalidating'''
+    def __init__(self,maxBytes):
+        self.maxBytes = maxBytes
+        self.blobs = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self,sha,load):
+        '''Contents of blob sha, calling load(sha) to read it on a miss'''
+        with self.lock:
+            data = self.blobs.get(sha)
+            if data is not None:
+                self.blobs.move_to_end(sha)
+                self.hits += 1
+                return(data)
+            self.misses += 1
+        data = load(sha)
+        if len(data) <= self.maxBytes:
+            with self.lock:
+                if sha not in self.blobs:
+                    self.blobs[sha] = data
+                    self.size += len(data)
+                    while self.size > self.maxBytes:
+                        self.size -= len(self.blobs.popitem(last=False)[1])
+        return(data)
+
+def blob_cache():
+    '''The process wide BlobCache, sized by BLOB_CACHE_BYTES'''
+    global _blobCache
+    with _blobCacheLock:
+        if _blobCache is None:
+            _blobCache = BlobCache(settings.BLOB_CACHE_BYTES)
+        return(_blobCache)
+
+def read_blob(group,sha):
+    '''Contents of a blob in a group's repo, as bytes'''
+    def load(sha):
+        with timed("git_object"):
+            return(open_repo(group).odb.stream(bytes.fromhex(sha)).read())
+    return(blob_cache().get(sha,load))
+
+def repo_class():
+    '''GitPython's Repo with every git command it runs counted and timed. A command run
+    as a process, such as a streamed "git log", is timed until the process has started'''
+    global _repoClass
+    if _repoClass is None:
+        from git import Git,Repo
+        class TimedGit(Git):
+            def execute(self,*args,**kwargs):
+                with timed("git"):
+                    return(super(TimedGit,self).execute(*args,**kwargs))
+        class TimedRepo(Repo):
+            GitCommandWrapperType = TimedGit
+        _repoClass = TimedRepo
+    return(_repoClass)
+
+
+class RepoPool(object):
+    '''Open repository handles, one per repository in each thread, since GitPython's
+    persistent "git cat-file --batch" and "--batch-check" processes must not be shared
+    between threads. Reusing a handle reuses those processes, so object reads do not fork
+    git. A handle is health checked before reuse. Every thread's handles are registered
+    with the pool, and any call sweeps them: a handle left idle for
+    REPO_POOL_IDLE_TIMEOUT seconds is closed, as are all handles of a thread that has
+    exited, so a thread that stops serving djancid does not keep git running forever'''
+    stats = {"opened":0,"reused":0,"unhealthy":0,"restarted":0,"evicted":0}
+    statsLock = threading.Lock()
+    def __init__(self):
+        self.local = threading.local()
+        # Guards threadHandles and every thread's handles dict in it
+        self.lock = threading.Lock()
+        self.threadHandles = {}
+        self.nextSweep = 0
+
+    def handles(self):
+        '''This thread's handles, registered on first use. Call with self.lock held'''
+        if not hasattr(self.local,"handles"):
+            self.local.handles = {}
+            self.threadHandles[threading.current_thread()] = self.local.handles
+        return(self.local.handles)
+
+    def count(self,stat,n=1):
+        with self.statsLock:
+            self.stats[stat] += n
+
+    def healthy(self,handle):
+        '''False if the repository was removed or replaced since the handle was opened.
+        Dead cat-file processes are dropped so GitPython starts new ones on next use'''
+        repo,gitDirInode,lastUsed = handle
+        try:
+            if os.stat(repo.git_dir).st_ino != gitDirInode:
+                return(False)
+        except FileNotFoundError:
+            return(False)
+        for proc in (repo.git.cat_file_all,repo.git.cat_file_header):
+            if proc is not None and proc.poll() is not None:
+                repo.git.clear_cache()
+                self.count("restarted")
+                break
+        return(True)
+
+    def evictIdle(self,now):
+        '''Take idle handles, and those of exited threads, out of every thread's handles.
+        Sweeps at most ten times per idle timeout. Call with self.lock held; returns the
+        repos for the caller to close once the lock is released'''
+        if now < self.nextSweep:
+            return([])
+        self.nextSweep = now + settings.REPO_POOL_IDLE_TIMEOUT / 10
+        evicted = []
+        for thread,handles in list(self.threadHandles.items()):
+            alive = thread.is_alive()
+            for repoDir,handle in list(handles.items()):
+                if not alive or now - handle[2] > settings.REPO_POOL_IDLE_TIMEOUT:
+                    evicted.append(handles.pop(repoDir)[0])
+            if not alive:
+                del self.threadHandles[thread]
+        return(evicted)
+
+    def get(self,group):
+        now = time.time()
+        repoDir = os.path.join(settings.RANCID_ROOT,group)
+        with self.lock:
+            evicted = self.evictIdle(now)
+            handles = self.handles()
+            handle = handles.get(repoDir)
+            if handle is not None:
+                # Marked as used before the lock is released, so no sweep takes it
+                handle[2] = now
+        for repo in evicted:
+            repo.close()
+        if evicted:
+            self.count("evicted",len(evicted))
+        if handle is not None and not self.healthy(handle):
+            with self.lock:
+                handles.pop(repoDir,None)
+            handle[0].close()
+            self.count("unhealthy")
+            handle = None
+        if handle is not None:
+            self.count("reused")
+            return(handle[0])
+        repo = repo_class()(repoDir)
+        handle = [repo,os.stat(repo.git_dir).st_ino,now]
+        with self.lock:
+            handles[repoDir] = handle
+        self.count("opened")
+        return(repo)
+
+    def closeAll(self):
+        '''Close this thread's handles'''
+        with self.lock:
+            handles = self.handles()
+            repos = [handle[0] for handle in handles.values()]
+            handles.clear()
+        for repo in repos:
+            repo.close()
+
+def open_repo(group):
+    '''This thread's handle on a group's git repository, from the process wide RepoPool.
+    GitPython is imported on first use rather than with this module because importing it
+    runs "git version" in a subprocess'''
+    return(_repoPool.get(group))
+
+_repoPool = RepoPool()
+
+def head_commit(repo):
+    '''sha of HEAD, read from the ref files without starting a git process'''
+    from git.refs.symbolic import SymbolicReference
+    return(SymbolicReference.dereference_recursive(repo,"HEAD"))
+
+def is_fast_forward(repo,oldCommit,newCommit):
+    '''True if newCommit descends from oldCommit, so oldCommit..newCommit holds every
+    change since oldCommit. False if history was rewound or oldCommit no longer exists'''
+    from git.exc import GitCommandError
+    try:
+        return(repo.is_ancestor(oldCommit,newCommit))
+    except GitCommandError:
+        return(False)
+
+def config_path(group,device):
+    return(os.path.join(settings.RANCID_ROOT,group,'configs',device))
+
+def get_config_validators(group,device):
+    '''ETag and Last-Modified timestamp for a device's latest config, or (None,None) if
+    no backup exists. Derived from the file's inode, mtime and size without reading it'''
+    try:
+        inode,mtime,size = file_signature(config_path(group,device))
+    except FileNotFoundError:
+        return((None,None))
+    etag = '"{i:x}-{m:x}-{s:x}"'.format(i=inode,m=mtime,s=size)
+    return((etag,mtime // 1000000000))
+
+def iter_config_chunks(group,device,chunkSize=65536):
+    '''Yield a device's latest config file as chunks of bytes'''
+    with open(config_path(group,device),"rb") as f:
+        chunk = f.read(chunkSize)
+        while chunk:
+            yield(chunk)
+            chunk = f.read(chunkSize)
 
 def get_config(group,device):
-    configFile = os.path.join(settings.RANCID_ROOT,group,'configs',device)
+    configFile = config_path(group,device)
     if os.path.exists(configFile):
-        with open(configFile,"r") as f:
+        with timed("file_read"),open(configFile,"r") as f:
             config = f.read()
         return(config)
     else:
         return("No configuration backups have been made for this device")
 
-def get_config_diffs(group,device):
-    repoDir = os.path.join(settings.RANCID_ROOT,group)
-    repo = Repo(repoDir)
-    commits = list(repo.iter_commits())
+def iter_config_history(group,device,revision="HEAD",limit=None,skip=0):
+    '''Yield (commit sha, commit datetime, blob sha, patch) for each commit that changed
+    the device's config, newest first. The blob is the config as of that commit, or None
+    if the commit deleted it. All patches come from one streamed "git log --raw -p" limited
+    to the config file, so commits that did not touch the device are never diffed. limit
+    and skip select a window of those commits, which git stops walking history after'''
+    repo = open_repo(group)
     configFile = os.path.join('configs',device)
-    diffs = []
-    for i,commit in enumerate(commits):
-        if commit != commits[-1]:
+    window = ["--skip={s}".format(s=skip)]
+    if limit is not None:
+        window.append("--max-count={n}".format(n=limit))
+    proc = repo.git.log(
+        "--format=%x00%H %cI","--raw","-p","--no-abbrev","--no-color","--no-ext-diff","--no-renames",*window,
+        revision,"--",configFile,as_process=True,env={"GIT_LITERAL_PATHSPECS":"1"}
+    )
+    commit = None
+    for line in proc.stdout:
+        if line.startswith(b"\x00"):
+            if commit is not None:
+                yield((commit[0],commit[1],commit[2],"".join(commit[3]).strip("\n")))
+            sha,committed = line[1:].decode("ascii").split()
+            commit = [sha,committed,None,[]]
+            inPatch = False
+        elif commit is None:
+            continue
+        elif not inPatch and line.startswith(b":"):
+            blob = line.split(None,4)[3].decode("ascii")
+            commit[2] = None if blob == NULL_SHA else blob
+        else:
+            inPatch = inPatch or line.startswith(b"diff ")
+            commit[3].append(line.decode("utf-8","replace"))
+    if commit is not None:
+        yield((commit[0],commit[1],commit[2],"".join(commit[3]).strip("\n")))
+    proc.wait()
+
+def get_config_diffs(group,device,before=None):
+    '''Generator of the diffs for every change to a device's config, newest first. If
+    before is a commit sha, only changes older than that commit are returned'''
+    for sha,committed,blob,text in iter_config_history(group,device,before or "HEAD"):
+        if text and sha != before:
             diff = {}
-            text = repo.git.diff(commits[i+1],commit,configFile)
-            if text:
-                diff['text'] = text.replace("\n","<br>")
-                diff['datetime'] = commit.committed_datetime.isoformat()
-                diffs.append(diff)
-    return(diffs)
+            diff['text'] = text.replace("\n","<br>")
+            diff['datetime'] = committed
+            diff['commit'] = sha
+            yield(diff)
+
+def cache_diffs(group,device,history,sequence,step):
+    '''Store history, as yielded by iter_config_history, numbering the rows from
+    sequence in steps of step. Commits with an empty patch are left out'''
+    newDiffs = []
+    for sha,committed,blob,text in history:
+        if text:
+            newDiffs.append(ConfigDiff(
+                rancidGroup=group,device=device,commit=sha,sequence=sequence,
+                committed=parse_datetime(committed),blob=blob,text=text
+            ))
+            sequence += step
+    ConfigDiff.objects.bulk_create(newDiffs,batch_size=500)
+
+def refresh_diff_cache(group,device):
+    '''Bring the newest end of the stored diffs for a device up to date with the group
+    repo and return its ConfigDiffHead. Only commits after the cached head are read from
+    git. If history no longer descends from that head, or nothing was read from it yet,
+    the cache is emptied and restarts at the new head; fill_diff_cache then reads older
+    diffs as pages need them'''
+    repo = open_repo(group)
+    headCommit = head_commit(repo)
+    cachedHead = ConfigDiffHead.objects.filter(rancidGroup=group,device=device).first()
+    if cachedHead is not None and cachedHead.commit == headCommit:
+        return(cachedHead)
+    cached = ConfigDiff.objects.filter(rancidGroup=group,device=device)
+    started = cachedHead is not None and (cachedHead.complete or cachedHead.oldest is not None)
+    try:
+        if started and is_fast_forward(repo,cachedHead.commit,headCommit):
+            history = list(iter_config_history(group,device,"{c}..{h}".format(c=cachedHead.commit,h=headCommit)))
+            # Read before the transaction so it starts with a write; SQLite cannot upgrade
+            # a read transaction while another writer waits
+            sequence = cached.aggregate(models.Max("sequence"))['sequence__max'] or 0
+            with transaction.atomic():
+                # Compare-and-set, so concurrent refreshes cannot store a commit twice
+                if ConfigDiffHead.objects.filter(pk=cachedHead.pk,commit=cachedHead.commit).update(commit=headCommit):
+                    cache_diffs(group,device,reversed(history),sequence + 1,1)
+                    cachedHead.commit = headCommit
+                    return(cachedHead)
+        elif cachedHead is None:
+            with transaction.atomic():
+                return(ConfigDiffHead.objects.create(rancidGroup=group,device=device,commit=headCommit))
+        else:
+            with transaction.atomic():
+                cached.delete()
+                ConfigDiffHead.objects.filter(pk=cachedHead.pk).update(commit=headCommit,oldest=None,complete=False)
+            cachedHead.commit,cachedHead.oldest,cachedHead.complete = headCommit,None,False
+            return(cachedHead)
+    except IntegrityError:
+        pass
+    # A concurrent request moved the head first
+    return(ConfigDiffHead.objects.get(rancidGroup=group,device=device))
+
+def fill_diff_cache(group,device,head,count,before=None):
+    '''Read older diffs from git until count diffs older than the before row, or older
+    than the head when it is None, are cached or the start of history is reached. Each
+    round is one "git log" of only the commits missing, from the oldest commit read so
+    far. Returns the ConfigDiffHead'''
+    cached = ConfigDiff.objects.filter(rancidGroup=group,device=device)
+    older = cached if before is None else cached.filter(sequence__lt=before.sequence)
+    while not head.complete:
+        missing = count - older.count()
+        if missing <= 0:
+            break
+        if head.oldest is None:
+            history = list(iter_config_history(group,device,head.commit,limit=missing))
+        else:
+            history = list(iter_config_history(group,device,head.oldest,limit=missing,skip=1))
+        sequence = cached.aggregate(models.Min("sequence"))['sequence__min']
+        oldest = history[-1][0] if history else head.oldest
+        complete = len(history) < missing
+        try:
+            with transaction.atomic():
+                # Compare-and-set, so a page read by a concurrent request is not stored twice
+                if ConfigDiffHead.objects.filter(pk=head.pk,commit=head.commit,oldest=head.oldest).update(oldest=oldest,complete=complete):
+                    cache_diffs(group,device,history,0 if sequence is None else sequence - 1,-1)
+                    head.oldest,head.complete = oldest,complete
+                    continue
+        except IntegrityError:
+            pass
+        head = ConfigDiffHead.objects.get(pk=head.pk)
+    return(head)
+
+def get_config_diff_page(group,device,pageSize=None,before=None):
+    '''A single page of a device's diffs, read from the diff cache after refreshing it.
+    before is the opaque cursor handed out as the "older"/"newer" value of another page.
+    "newer" is None with hasNewer True when the newer page is the first page'''
+    if pageSize is None:
+        pageSize = settings.CHANGES_PAGE_SIZE
+    if before is not None and not SHA_RE.match(before):
+        raise(ValueError("Invalid cursor: {c}".format(c=before)))
+    head = refresh_diff_cache(group,device)
+    page = {"diffs":[],"older":None,"newer":None,"hasNewer":False}
+    cached = ConfigDiff.objects.filter(rancidGroup=group,device=device)
+    diffs = cached
+    cursor = None
+    if before is not None:
+        cursor = cached.filter(commit=before).first()
+        if cursor is None:
+            raise(ValueError("Invalid cursor: {c}".format(c=before)))
+    # One more than a page tells whether there is an older page
+    fill_diff_cache(group,device,head,pageSize + 1,cursor)
+    if cursor is not None:
+        diffs = cached.filter(sequence__lt=cursor.sequence)
+        newerCommits = list(cached.filter(sequence__gte=cursor.sequence).order_by("sequence").values_list("commit",flat=True)[:pageSize+1])
+        page['hasNewer'] = True
+        if len(newerCommits) > pageSize:
+            page['newer'] = newerCommits[pageSize]
+    rows = list(diffs.order_by("-sequence")[:pageSize+1])
+    if len(rows) > pageSize:
+        page['older'] = rows[pageSize-1].commit
+    for row in rows[:pageSize]:
+        diff = {}
+        diff['text'] = row.text.replace("\n","<br>")
+        diff['datetime'] = timezone.localtime(row.committed).isoformat()
+        diff['commit'] = row.commit
+        page['diffs'].append(diff)
+    return(page)
+
+def iter_changed_configs(group,revision="HEAD"):
+    '''Yield (commit sha, commit datetime, [devices]) for each commit that touched
+    configs/, newest first, from a single streamed "git log --name-only"'''
+    repo = open_repo(group)
+    proc = repo.git.log(
+        "--format=%x01%H %cI","--name-only","--no-renames","-z",
+        revision,"--","configs/",as_process=True
+    )
+    commit = None
+    remainder = b""
+    for chunk in iter(lambda: proc.stdout.read(65536),b""):
+        fields = (remainder + chunk).split(b"\0")
+        remainder = fields.pop()
+        for field in fields:
+            field = field.lstrip(b"\n")
+            if field.startswith(b"\x01"):
+                if commit is not None:
+                    yield(commit)
+                sha,committed = field[1:].decode("ascii").split()
+                commit = (sha,committed,[])
+            elif field and commit is not None:
+                commit[2].append(field.decode("utf-8","replace")[len("configs/"):])
+    if commit is not None:
+        yield(commit)
+    proc.wait()
+
+def refresh_change_index(group):
+    '''Bring the last-change index of a group up to date with its repo. Only commits
+    after the indexed head are read; if history no longer descends from that head the
+    index is rebuilt. The head is advanced with a compare-and-set so concurrent refreshes cannot count a commit twice'''
+    repo = open_repo(group)
+    headCommit = head_commit(repo)
+    cachedHead = DeviceChangeHead.objects.filter(rancidGroup=group).first()
+    if cachedHead is not None and cachedHead.commit == headCommit:
+        return
+    rebuild = cachedHead is None or not is_fast_forward(repo,cachedHead.commit,headCommit)
+    if rebuild:
+        history = list(iter_changed_configs(group,headCommit))
+    else:
+        history = list(iter_changed_configs(group,"{c}..{h}".format(c=cachedHead.commit,h=headCommit)))
+    latest = {}
+    counts = {}
+    for sha,committed,devices in history:
+        for device in devices:
+            counts[device] = counts.get(device,0) + 1
+            if device not in latest:
+                latest[device] = (sha,parse_datetime(committed))
+    try:
+        with transaction.atomic():
+            if cachedHead is None:
+                DeviceChangeHead.objects.create(rancidGroup=group,commit=headCommit)
+            elif DeviceChangeHead.objects.filter(rancidGroup=group,commit=cachedHead.commit).update(commit=headCommit) == 0:
+                return
+            if rebuild:
+                DeviceChange.objects.filter(rancidGroup=group).delete()
+                existing = {}
+            else:
+                existing = dict([(row.device,row) for row in DeviceChange.objects.filter(rancidGroup=group)])
+            newChanges = []
+            for device,(sha,changed) in latest.items():
+                if device in existing:
+                    row = existing[device]
+                    row.commit = sha
+                    row.changed = changed
+                    row.changeCount += counts[device]
+                    row.save()
+                else:
+                    newChanges.append(DeviceChange(rancidGroup=group,device=device,commit=sha,changed=changed,changeCount=counts[device]))
+            DeviceChange.objects.bulk_create(newChanges,batch_size=500)
+    except IntegrityError:
+        pass
+
+def get_last_changes(group):
+    '''{device: DeviceChange} for every config in the group's history, from the
+    last-change index after refreshing it. Empty if the group has no repo or commits'''
+    from git.exc import InvalidGitRepositoryError,NoSuchPathError
+    try:
+        refresh_change_index(group)
+    except (InvalidGitRepositoryError,NoSuchPathError,ValueError):
+        return({})
+    return(dict([(row.device,row) for row in DeviceChange.objects.filter(rancidGroup=group)]))
+
+def resolve_config_revision(group,device,revision=None,when=None):
+    '''{commit, committed, blob} for a device's config as of a commit or an aware
+    datetime, or None if the config did not exist then. Timestamps and commits that
+    changed the config are answered from the diff cache, which is filled back as far as
+    the time asked for; other revisions are looked up in the commit's tree. Raises
+    ValueError for a revision git does not know'''
+    head = refresh_diff_cache(group,device)
+    changes = ConfigDiff.objects.filter(rancidGroup=group,device=device).order_by("-sequence")
+    if when is not None:
+        change = changes.filter(committed__lte=when).first()
+        wanted = settings.CHANGES_PAGE_SIZE
+        while change is None and not head.complete:
+            head = fill_diff_cache(group,device,head,changes.count() + wanted)
+            change = changes.filter(committed__lte=when).first()
+            wanted *= 2
+    elif SHA_RE.match(revision or "") and changes.filter(commit=revision).exists():
+        change = changes.filter(commit=revision).first()
+    else:
+        from gitdb.exc import BadName,BadObject
+        repo = open_repo(group)
+        try:
+            commit = repo.commit(revision or "HEAD")
+        except (BadName,BadObject,ValueError) as e:
+            raise(ValueError("Unknown revision: {r} ({e})".format(r=revision,e=e)))
+        try:
+            blob = (commit.tree / "configs" / device).hexsha
+        except KeyError:
+            blob = None
+        return({"commit":commit.hexsha,"committed":commit.committed_datetime,"blob":blob})
+    if change is None:
+        return(None)
+    return({"commit":change.commit,"committed":change.committed,"blob":change.blob})
+
+def get_config_at(group,device,revision=None,when=None):
+    '''(config text or None, revision info) for a device as of a commit or datetime.
+    The config is read from the object database through the blob cache, never from a
+    checkout'''
+    info = resolve_config_revision(group,device,revision,when)
+    if info is None or info['blob'] is None:
+        return((None,info))
+    return((read_blob(group,info['blob']).decode("utf-8","replace"),info))
+
+def blob_size(group,sha):
+    '''Size in bytes of a blob, 0 for None, asked of the repo without reading the blob'''
+    if sha is None:
+        return(0)
+    return(open_repo(group).odb.info(bytes.fromhex(sha)).size)
+
+def git_diff(repo,*args):
+    '''Hunks of a "git diff" run in repo, without file headers. Raises DiffTooLarge if
+    git is killed after COMPARE_TIMEOUT seconds'''
+    from git.exc import GitCommandError
+    status,output,error = repo.git.diff(
+        "--text","--no-color","--no-ext-diff","--no-textconv",*args,
+        kill_after_timeout=settings.COMPARE_TIMEOUT,with_extended_output=True,with_exceptions=False
+    )
+    if status < 0:
+        raise(DiffTooLarge("git diff did not finish in {t} seconds".format(t=settings.COMPARE_TIMEOUT)))
+    # --no-index exits with 1 when the files differ
+    if status not in (0,1):
+        raise(GitCommandError(["git","diff"] + list(args),status,error))
+    lines = output.splitlines()
+    for start,line in enumerate(lines):
+        if line.startswith("@@"):
+            return(lines[start:])
+    return([])
+
+def diff_blobs(groupA,blobA,groupB,blobB):
+    '''Unified diff lines from blob A to blob B, without file headers. A blob of None is an
+    empty config. Blobs in one repo are diffed by git there; otherwise they are written to
+    temporary files for "git diff --no-index". Kept in the cache backend by blob sha pair,
+    so the same two blobs are never diffed twice. Raises DiffTooLarge when the blobs total
+    more than COMPARE_MAX_BYTES or git takes longer than COMPARE_TIMEOUT'''
+    cacheKey = "djancid:blobdiff:{a}:{b}".format(a=blobA or NULL_SHA,b=blobB or NULL_SHA)
+    lines = cache.get(cacheKey)
+    if lines is None:
+        timeout = settings.BLOB_DIFF_CACHE_TIMEOUT
+        if blobA == blobB:
+            lines = []
+        elif blob_size(groupA,blobA) + blob_size(groupB,blobB) > settings.COMPARE_MAX_BYTES:
+            lines = TOO_LARGE
+        else:
+            repo = open_repo(groupA)
+            try:
+                if blobA and blobB and groupA == groupB:
+                    lines = git_diff(repo,blobA,blobB)
+                else:
+                    with tempfile.TemporaryDirectory(prefix="djancid-diff-") as tmpDir:
+                        paths = []
+                        for name,group,blob in (("a",groupA,blobA),("b",groupB,blobB)):
+                            paths.append(os.path.join(tmpDir,name))
+                            with open(paths[-1],"wb") as f:
+                                f.write(read_blob(group,blob) if blob else b"")
+                        lines = git_diff(repo,"--no-index","--",*paths)
+            except DiffTooLarge:
+                # A slow diff may only have been slow under load, so try again later
+                lines = TOO_LARGE
+                timeout = 3600
+        cache.set(cacheKey,lines,timeout)
+    if lines == TOO_LARGE:
+        raise(DiffTooLarge("The configs are too large to compare"))
+    return(lines)
+
+def compare_configs(groupA,deviceA,groupB,deviceB,revisionA=None,whenA=None,revisionB=None,whenB=None):
+    '''Diff two configs, each of a device as of a revision or datetime (latest commit by
+    default). The devices may be the same or different. Returns a dict with the revision
+    info of each side and the diff lines, which are None with tooLarge set when the diff
+    could not be made within the limits. Raises ValueError for an unknown revision'''
+    infoA = resolve_config_revision(groupA,deviceA,revisionA,whenA)
+    infoB = resolve_config_revision(groupB,deviceB,revisionB,whenB)
+    blobA = infoA['blob'] if infoA else None
+    blobB = infoB['blob'] if infoB else None
+    try:
+        lines = diff_blobs(groupA,blobA,groupB,blobB)
+    except DiffTooLarge:
+        return({"a":infoA,"b":infoB,"lines":None,"tooLarge":True})
+    return({"a":infoA,"b":infoB,"lines":lines,"tooLarge":False})
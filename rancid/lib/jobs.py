@@ -0,0 +1,160 @@
+import logging
+import os
+import subprocess
+import traceback
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor,FIRST_COMPLETED,wait
+from django.conf import settings
+from django.db import IntegrityError,connection,transaction
+from django.db.models import Value
+from django.db.models.functions import Concat
+from django.utils import timezone
+from rancid.lib.metrics import timed
+from rancid.models import Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+# rancid-run refuses a group another rancid-run holds, so collection jobs for the same
+# group never run at once
+COLLECT_KINDS = ("collect-group","collect-device")
+
+def job_handler(kind):
+    '''Register the decorated function as the runner for jobs of this kind. It is called
+    with the job and returns the text to store as the job's output'''
+    def register(function):
+        _handlers[kind] = function
+        return(function)
+    return(register)
+
+def enqueue(kind,group="",target=""):
+    '''Queue a job, or return the identical job that is already queued. A job that is
+    running does not absorb new requests, since it may have read its input already'''
+    pendingKey = "{k}:{g}:{t}".format(k=kind,g=group,t=target)
+    try:
+        with transaction.atomic():
+            return(Job.objects.create(kind=kind,rancidGroup=group,target=target,pendingKey=pendingKey))
+    except IntegrityError:
+        job = Job.objects.filter(pendingKey=pendingKey).first()
+        if job is None:
+            return(enqueue(kind,group,target))
+        return(job)
+
+def enqueue_collection(group,device=None):
+    '''Queue rancid-run for a group, or for one device of it. A device request is
+    coalesced into a queued collection of its whole group'''
+    if device is None:
+        return(enqueue("collect-group",group))
+    groupJob = Job.objects.filter(pendingKey="collect-group:{g}:".format(g=group)).first()
+    if groupJob is not None:
+        return(groupJob)
+    return(enqueue("collect-device",group,device))
+
+def claim_next():
+    '''Oldest queued job, marked as running, or None. Collection jobs are passed over
+    while their group is being collected. Claiming is a compare-and-set on the status so
+    several workers can share the queue'''
+    busyGroups = set(Job.objects.filter(status=Job.RUNNING,kind__in=COLLECT_KINDS).values_list("rancidGroup",flat=True))
+    for job in Job.objects.filter(status=Job.QUEUED).order_by("id")[:100]:
+        if job.kind in COLLECT_KINDS:
+            if job.rancidGroup in busyGroups:
+                continue
+        now = timezone.now()
+        claimed = Job.objects.filter(id=job.id,status=Job.QUEUED).update(
+            status=Job.RUNNING,pendingKey=None,started=now,heartbeat=now
+        )
+        if claimed:
+            job.refresh_from_db()
+            return(job)
+    return(None)
+
+def recover_orphans():
+    '''Fail running jobs that have had no heartbeat for JOB_HEARTBEAT_TIMEOUT seconds,
+    left behind by a worker that was killed or whose host restarted. Until then a
+    collection job would keep its group busy for good. Returns the number failed'''
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_HEARTBEAT_TIMEOUT)
+    orphans = Job.objects.filter(status=Job.RUNNING,heartbeat__lt=cutoff)
+    for job in orphans:
+        logger.warning("Job %s (%s %s) lost its worker",job.id,job.kind,job.rancidGroup)
+    return(orphans.update(
+        status=Job.FAILED,finished=timezone.now(),
+        output=Concat("output",Value("The worker running this job stopped before it finished\n"))
+    ))
+
+def run_job(job):
+    try:
+        handler = _handlers[job.kind]
+        job.output = handler(job) or ""
+        job.status = Job.DONE
+    except Exception:
+        logger.exception("Job %s (%s %s) failed",job.id,job.kind,job.rancidGroup)
+        job.output = "{o}{t}".format(o=job.output,t=traceback.format_exc())
+        job.status = Job.FAILED
+    job.finished = timezone.now()
+    job.save(update_fields=["status","output","finished"])
+    return(job)
+
+def run_in_thread(job):
+    try:
+        return(run_job(job))
+    finally:
+        connection.close()
+
+def run_pending(parallel=None):
+    '''Run queued jobs, up to parallel (JOB_PAR_COUNT) at a time, until none can be
+    claimed and none are running. Jobs orphaned by a dead worker are failed first, and
+    the running jobs' heartbeat is kept up every JOB_HEARTBEAT_INTERVAL seconds.
+    Returns the number of jobs run'''
+    if parallel is None:
+        parallel = settings.JOB_PAR_COUNT
+    recover_orphans()
+    count = 0
+    running = {}
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        while True:
+            while len(running) < parallel:
+                job = claim_next()
+                if job is None:
+                    break
+                running[executor.submit(run_in_thread,job)] = job.id
+                count += 1
+            if not running:
+                break
+            done,notDone = wait(list(running),timeout=settings.JOB_HEARTBEAT_INTERVAL,return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+            Job.objects.filter(id__in=list(running.values()),status=Job.RUNNING).update(heartbeat=timezone.now())
+    return(count)
+
+def visible_jobs(user,permitted_groups):
+    '''Jobs the user may see: those of their permitted groups, and global jobs for staff'''
+    jobs = Job.objects.all()
+    if user.is_staff:
+        return(jobs.filter(rancidGroup__in=list(permitted_groups) + [""]))
+    return(jobs.filter(rancidGroup__in=permitted_groups))
+
+def run_rancid_command(command,*args):
+    '''Run a program from RANCID_BIN_DIR and return its output. Raises RuntimeError with
+    the output if it fails'''
+    with timed("subprocess"):
+        result = subprocess.run(
+            [os.path.join(settings.RANCID_BIN_DIR,command)] + list(args),
+            stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True
+        )
+    if result.returncode != 0:
+        raise(RuntimeError("{c} exited with status {r}:\n{o}".format(c=command,r=result.returncode,o=result.stdout)))
+    return(result.stdout)
+
+@job_handler("rancid-cvs")
+def run_rancid_cvs(job):
+    '''Create the directories and repositories for every group in LIST_OF_GROUPS'''
+    return(run_rancid_command("rancid-cvs"))
+
+@job_handler("collect-group")
+def collect_group(job):
+    return(run_rancid_command("rancid-run",job.rancidGroup))
+
+@job_handler("collect-device")
+def collect_device(job):
+    return(run_rancid_command("rancid-run","-r",job.target,job.rancidGroup))
@@ -0,0 +1,370 @@
+import io
+import math
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from base64 import b64encode
+from http.cookiejar import CookieJar
+from http.cookies import SimpleCookie
+from html.parser import HTMLParser
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer,WSGIRequestHandler,make_server
+from wsgiref.util import setup_testing_defaults
+from rancid.lib.fileops import RouterDB,Cloginrc,get_device_types
+
+DEFAULT_MIX = [
+    ("AllDevices",30),
+    ("GroupDetails",20),
+    ("Config",20),
+    ("Changes",15),
+    ("DeviceSave",10),
+    ("GroupSave",5),
+]
+
+
+class LoadTestError(Exception):
+    pass
+
+
+class WSGIClient(object):
+    '''Calls a WSGI application directly in this process, keeping the cookies it sets the
+    way a browser would. Redirects are returned, not followed'''
+    def __init__(self,application):
+        self.application = application
+        self.cookies = {}
+
+    def request(self,method,path,data=None):
+        '''(status code, body) of one request'''
+        environ = {}
+        setup_testing_defaults(environ)
+        path,query = (path.split("?",1) + [""])[:2]
+        body = urllib.parse.urlencode(data or {}).encode("ascii")
+        environ.update({
+            "REQUEST_METHOD":method,
+            "PATH_INFO":path,
+            "QUERY_STRING":query,
+            "CONTENT_TYPE":"application/x-www-form-urlencoded",
+            "CONTENT_LENGTH":str(len(body)),
+            "wsgi.input":io.BytesIO(body),
+            "wsgi.multithread":True,
+        })
+        if self.cookies:
+            environ['HTTP_COOKIE'] = "; ".join("{k}={v}".format(k=k,v=v) for k,v in self.cookies.items())
+        response = {}
+        def start_response(status,headers,excInfo=None):
+            response['status'] = int(status.split()[0])
+            for name,value in headers:
+                if name.lower() == "set-cookie":
+                    for morsel in SimpleCookie(value).values():
+                        self.cookies[morsel.key] = morsel.value
+        result = self.application(environ,start_response)
+        try:
+            content = b"".join(result)
+        finally:
+            if hasattr(result,"close"):
+                result.close()
+        return((response['status'],content))
+
+    def cookie(self,name):
+        return(self.cookies.get(name))
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self,*args,**kwargs):
+        return(None)
+
+
+class HTTPClient(object):
+    '''Sends real HTTP requests to baseUrl with a cookie jar of its own. Redirects are
+    returned, not followed'''
+    def __init__(self,baseUrl):
+        self.baseUrl = baseUrl.rstrip("/")
+        self.jar = CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar),NoRedirects())
+
+    def request(self,method,path,data=None):
+        body = urllib.parse.urlencode(data).encode("ascii") if data is not None else None
+        request = urllib.request.Request(self.baseUrl + path,data=body,method=method)
+        try:
+            with self.opener.open(request,timeout=60) as response:
+                return((response.status,response.read()))
+        except urllib.error.HTTPError as e:
+            return((e.code,e.read()))
+
+    def cookie(self,name):
+        for cookie in self.jar:
+            if cookie.name == name:
+                return(cookie.value)
+        return(None)
+
+
+class FormParser(HTMLParser):
+    '''Collects what a browser would submit for each form on a page: {action: {name: value}}
+    with only checked checkboxes and the selected option of each select'''
+    def __init__(self):
+        super(FormParser,self).__init__(convert_charrefs=True)
+        self.forms = {}
+        self.fields = None
+        self.select = None
+        self.textarea = None
+
+    def handle_starttag(self,tag,attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self.fields = self.forms.setdefault(attrs.get("action") or "",{})
+        elif self.fields is None or "name" not in attrs and tag != "option":
+            return
+        elif tag == "input":
+            inputType = attrs.get("type","text").lower()
+            if inputType in ("checkbox","radio"):
+                if "checked" in attrs:
+                    self.fields[attrs['name']] = attrs.get("value") or "on"
+            elif inputType not in ("submit","button","reset","image","file"):
+                self.fields[attrs['name']] = attrs.get("value") or ""
+        elif tag == "select":
+            self.select = attrs['name']
+        elif tag == "option" and self.select is not None:
+            if "selected" in attrs or self.select not in self.fields:
+                self.fields[self.select] = attrs.get("value") or ""
+        elif tag == "textarea":
+            self.textarea = attrs['name']
+            self.fields[self.textarea] = ""
+
+    def handle_endtag(self,tag):
+        if tag == "form":
+            self.fields = None
+        elif tag == "select":
+            self.select = None
+        elif tag == "textarea":
+            self.textarea = None
+
+    def handle_data(self,data):
+        if self.textarea is not None and self.fields is not None:
+            self.fields[self.textarea] += data
+
+
+def form_fields(body,action):
+    '''Fields of the form posting to action on an HTML page, or None if there is none'''
+    parser = FormParser()
+    parser.feed(body.decode("utf-8","replace"))
+    return(parser.forms.get(action))
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self,*args):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn,WSGIServer):
+    daemon_threads = True
+
+
+def serve(application):
+    '''Serve application on a free localhost port from a background thread, one thread
+    per connection. Returns the server; call shutdown() when done'''
+    server = make_server("127.0.0.1",0,application,server_class=ThreadingWSGIServer,handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever,name="loadtest-server",daemon=True)
+    thread.start()
+    return(server)
+
+def percentile(sortedValues,percent):
+    '''Nearest rank percentile of an already sorted list'''
+    if not sortedValues:
+        return(None)
+    rank = int(math.ceil(percent / 100.0 * len(sortedValues)))
+    return(sortedValues[max(rank - 1,0)])
+
+def latency_summary(timings):
+    '''Count and p50/p95/p99/max in milliseconds of a list of timings in seconds'''
+    timings = sorted(timings)
+    summary = {"count":len(timings)}
+    for name,percent in [("p50",50),("p95",95),("p99",99),("max",100)]:
+        value = percentile(timings,percent)
+        summary[name] = None if value is None else round(value * 1000,2)
+    return(summary)
+
+def b64(device):
+    return(b64encode(bytes(device,'ascii')).decode('ascii'))
+
+
+class SimulatedUser(object):
+    '''One logged in user sending a weighted random mix of page views and saves. Device
+    saves only touch the user's own devices and set a user name unique to the request,
+    so the last acknowledged save of each device is known and can be checked afterwards'''
+    def __init__(self,number,client,groups,ownDevices,mix,seed):
+        self.number = number
+        self.client = client
+        self.groups = groups
+        self.groupNames = sorted(groups)
+        self.ownDevices = ownDevices
+        if not ownDevices:
+            mix = [(kind,weight) for kind,weight in mix if kind != "DeviceSave"]
+        self.kinds = [kind for kind,weight in mix]
+        self.weights = [weight for kind,weight in mix]
+        self.rng = random.Random(seed)
+        self.deviceTypes = get_device_types()
+        self.timings = {}
+        self.errors = []
+        self.expected = {}
+        self.saves = 0
+
+    def login(self,username,password):
+        '''Log in through the login form and load the page it redirects to, untimed'''
+        self.client.request("GET","/login/")
+        status,body = self.client.request("POST","/login/",{
+            "username":username,
+            "password":password,
+            "csrfmiddlewaretoken":self.client.cookie("csrftoken"),
+            "next":"/",
+        })
+        if status != 302:
+            raise(LoadTestError("Login as {u} failed with status {s}".format(u=username,s=status)))
+        self.client.request("GET","/")
+
+    def pick(self):
+        group = self.rng.choice(self.groupNames)
+        return((group,self.rng.choice(self.groups[group])))
+
+    def send(self,kind,method,path,data=None):
+        '''Time one request and record it under kind. Returns the body, or None on an error'''
+        if method == "POST":
+            data = dict(data,csrfmiddlewaretoken=self.client.cookie("csrftoken"))
+        start = time.perf_counter()
+        try:
+            status,body = self.client.request(method,path,data)
+        except Exception as e:
+            error = "{m} {p}: {e!r}".format(m=method,p=path,e=e)
+            body = None
+        else:
+            if status != 200:
+                error = "{m} {p}: status {s}".format(m=method,p=path,s=status)
+            elif method == "POST" and b"errorlist" in body:
+                text = re.sub(r"<[^>]*>"," ",body.decode("utf-8","replace"))
+                error = "{m} {p}: form errors {t}".format(m=method,p=path,t=" ".join(text.split())[:200])
+            else:
+                error = None
+        self.timings.setdefault(kind,[]).append(time.perf_counter() - start)
+        if error is not None:
+            self.errors.append(error)
+            return(None)
+        return(body)
+
+    def edit(self,kind,path,changes):
+        '''Load the form on a page, change some fields and post it back as a browser would,
+        so fields the user did not touch keep their values. True if the save was accepted'''
+        body = self.send(kind.replace("Save","Details"),"GET",path)
+        if body is None:
+            return(False)
+        fields = form_fields(body,path)
+        if fields is None:
+            self.errors.append("GET {p}: no form posting to it".format(p=path))
+            return(False)
+        fields.update(changes)
+        return(self.send(kind,"POST",path,fields) is not None)
+
+    def step(self):
+        '''Send one request of a random kind, or for a save the page view and post'''
+        kind = self.rng.choices(self.kinds,self.weights)[0]
+        if kind == "AllDevices":
+            self.send(kind,"GET","/")
+        elif kind == "GroupDetails":
+            self.send(kind,"GET","/rancid/groupdetails/{g}".format(g=self.rng.choice(self.groupNames)))
+        elif kind == "Config":
+            group,device = self.pick()
+            self.send(kind,"GET","/rancid/config/{g}/{d}/".format(g=group,d=b64(device)))
+        elif kind == "Changes":
+            group,device = self.pick()
+            self.send(kind,"GET","/rancid/changes/{g}/{d}/".format(g=group,d=b64(device)))
+        elif kind == "DeviceSave":
+            group,device = self.rng.choice(self.ownDevices)
+            self.saves += 1
+            user = "lt{u}-{n}".format(u=self.number,n=self.saves)
+            deviceType = self.rng.choice(self.deviceTypes)
+            path = "/rancid/devicedetails/{g}/{d}/".format(g=group,d=b64(device))
+            if self.edit(kind,path,{"user":user,"deviceType":deviceType}):
+                self.expected[(group,device)] = (user,deviceType)
+        elif kind == "GroupSave":
+            group = self.rng.choice(self.groupNames)
+            self.edit(kind,"/rancid/groupdetails/{g}".format(g=group),{"timeout":str(self.rng.randint(1,30))})
+
+    def run(self,barrier,requests=None,duration=None):
+        barrier.wait()
+        deadline = None if duration is None else time.perf_counter() + duration
+        sent = 0
+        while (requests is None or sent < requests) and (deadline is None or time.perf_counter() < deadline):
+            self.step()
+            sent += 1
+
+
+def check_writes(expected):
+    '''[(group, device, expected, found)] for each device whose router.db and .cloginrc
+    do not hold the last save that was acknowledged for it'''
+    crcFile = Cloginrc()
+    lost = []
+    for (group,device),(user,deviceType) in sorted(expected.items()):
+        try:
+            foundType = RouterDB(group).getRouterDetails(device)['deviceType']
+        except RouterDB.RouterNotFoundException:
+            foundType = None
+        foundUser = crcFile.resolve(device).get('user')
+        if foundType != deviceType or foundUser is None or crcFile.formatValue(foundUser) != crcFile.formatValue(user):
+            lost.append((group,device,{"user":user,"deviceType":deviceType},{"user":foundUser,"deviceType":foundType}))
+    return(lost)
+
+def run_load_test(makeClient,groups,accounts,users=10,requests=None,duration=None,mix=None,devicesPerUser=5,seed=0):
+    '''Drive the app with users concurrent SimulatedUsers, each sending requests requests
+    or for duration seconds. makeClient() returns a new WSGIClient or HTTPClient, groups
+    maps each group to its devices and the users log in with the (username, password)
+    accounts in turn. Returns a report of throughput, latency percentiles per kind of
+    request, errors and lost writes'''
+    if requests is None and duration is None:
+        raise(LoadTestError("Give a number of requests or a duration"))
+    rng = random.Random(seed)
+    allDevices = [(group,device) for group,devices in sorted(groups.items()) for device in devices]
+    ownDevices = rng.sample(allDevices,min(len(allDevices),users * devicesPerUser))
+    simulated = []
+    for number in range(users):
+        user = SimulatedUser(number,makeClient(),groups,ownDevices[number::users],mix or DEFAULT_MIX,seed * 1000 + number)
+        user.login(*accounts[number % len(accounts)])
+        simulated.append(user)
+    barrier = threading.Barrier(users + 1)
+    threads = []
+    for user in simulated:
+        thread = threading.Thread(target=user.run,name="loadtest-user-{n}".format(n=user.number),
+            kwargs={"barrier":barrier,"requests":requests,"duration":duration})
+        threads.append(thread)
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    timings = {}
+    errors = []
+    expected = {}
+    for user in simulated:
+        for kind,values in user.timings.items():
+            timings.setdefault(kind,[]).extend(values)
+        errors.extend(user.errors)
+        expected.update(user.expected)
+    allTimings = [value for values in timings.values() for value in values]
+    lost = check_writes(expected)
+    return({
+        "users":users,
+        "seconds":round(elapsed,3),
+        "requests":len(allTimings),
+        "throughput":round(len(allTimings) / elapsed,2) if elapsed else None,
+        "errors":len(errors),
+        "errorSamples":errors[:10],
+        "writesChecked":len(expected),
+        "lostWrites":len(lost),
+        "lostWriteSamples":[
+            {"group":group,"device":device,"expected":want,"found":found}
+            for group,device,want,found in lost[:10]
+        ],
+        "latency":dict([("all",latency_summary(allTimings))] + [(kind,latency_summary(values)) for kind,values in sorted(timings.items())]),
+    })
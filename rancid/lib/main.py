@@ -1,25 +1,78 @@
-import subprocess
 from base64 import b64encode,b64decode
 import os
 import shutil
-from rancid.lib.fileops import RouterDB,Cloginrc,RancidConf
+from rancid.lib.fileops import RouterDB,Cloginrc,RancidConf,FileTransaction,RancidRunBusy,wait_for_rancid_run
+from rancid.lib.gitops import get_last_changes
+from rancid.lib.jobs import enqueue,job_handler
 from rancid.models import Device,RancidGroupSetting,RancidGroupPermission
+from rancid.signals import list_of_groups_changed,permissions_version
 from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError,transaction
 
-rcFile = RancidConf()
-crcFile = Cloginrc()
+def rancid_cvsroot():
+    '''CVSROOT from rancid.conf. Resolved on use so importing this module does no file I/O'''
+    return(RancidConf().expandSetting("CVSROOT"))
 
-rancid_CVSROOT = rcFile.readSetting("CVSROOT").replace("$BASEDIR",settings.RANCID_ROOT)
-rancid_LOGDIR = rcFile.readSetting("LOGDIR").replace("$BASEDIR",settings.RANCID_ROOT)
+def rancid_logdir():
+    '''LOGDIR from rancid.conf'''
+    return(RancidConf().expandSetting("LOGDIR"))
+
+def upsert(model,values,**lookup):
+    '''Set values on the row matching lookup, creating it if there is none. The update
+    comes first so concurrent saves queue on the database write lock, where reading
+    first would deadlock them on SQLite. Two racing creates are settled by the unique
+    constraint on lookup'''
+    if model.objects.filter(**lookup).update(**values) == 0:
+        try:
+            with transaction.atomic():
+                model.objects.create(**dict(lookup,**values))
+        except IntegrityError:
+            model.objects.filter(**lookup).update(**values)
+
+@job_handler("delete-group")
+def delete_group_files(job):
+    '''Remove a deleted group's directory, CVSROOT repository and logs. Skipped if the
+    group was added back to LIST_OF_GROUPS after this job was queued. If rancid-run is
+    still collecting the group after RANCID_RUN_JOB_WAIT seconds, nothing is removed and
+    the job is queued again'''
+    group = job.rancidGroup
+    if group in RancidConf().readSetting("LIST_OF_GROUPS").split():
+        return("{g} is in LIST_OF_GROUPS again, not deleting its files".format(g=group))
+    try:
+        wait_for_rancid_run(group,settings.RANCID_RUN_JOB_WAIT)
+    except RancidRunBusy as e:
+        retry = enqueue("delete-group",group)
+        return("{e}; queued again as job {j}".format(e=e,j=retry.id))
+    deleted = []
+    for path in [os.path.join(settings.RANCID_ROOT,group),os.path.join(rancid_cvsroot(),group)]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+            deleted.append(path)
+    logDir = rancid_logdir()
+    for logFile in [f for f in os.listdir(logDir) if group in f]:
+        path = os.path.join(logDir,logFile)
+        os.remove(path)
+        deleted.append(path)
+    return("Deleted:\n{d}".format(d="\n".join(deleted)))
 
 def get_permitted_groups(user):
+    '''RANCID groups the user may see. Memoised on the user object for the rest of the
+    request, and for non-staff users in the cache backend until a permission, group
+    membership or LIST_OF_GROUPS change bumps the permissions version'''
+    if hasattr(user,"permittedGroups"):
+        return(list(user.permittedGroups))
     if user.is_staff:
-        permitted_groups = rcFile.readSetting("LIST_OF_GROUPS").split(" ")
+        permitted_groups = RancidConf().readSetting("LIST_OF_GROUPS").split()
     else:
-        groups = user.groups.all()
-        group_permissions = RancidGroupPermission.objects.filter(djangoGroup__in=groups)
-        permitted_groups = list(set([gp.rancidGroup for gp in group_permissions]))
-    return(permitted_groups)
+        cacheKey = "djancid:permitted_groups:{v}:{u}".format(v=permissions_version(),u=user.pk)
+        permitted_groups = cache.get(cacheKey)
+        if permitted_groups is None:
+            group_permissions = RancidGroupPermission.objects.filter(djangoGroup__user=user)
+            permitted_groups = list(set(group_permissions.values_list("rancidGroup",flat=True)))
+            cache.set(cacheKey,permitted_groups,settings.PERMISSION_CACHE_TIMEOUT)
+    user.permittedGroups = permitted_groups
+    return(list(permitted_groups))
 
 
 class DjancidBase(object):
@@ -61,16 +114,17 @@ class DjancidDevice(DjancidBase):
     '''Class to represent a Djancid Device. Device settings are pulled from:
     the group's router.db file, the .cloginrc file and the Django db'''
 
-    def __init__(self,name,groupObj):
+    def __init__(self,name,groupObj,dbDetails=None,rcDetails=None,djangoDevice=None):
         self.name = name
         self.allSettings = {"name":self.name,"group":groupObj.name}
         self.parentGroup = groupObj
-        self.rdbFile = RouterDB(self.parentGroup.name)
+        self.rdbFile = groupObj.rdbFile or RouterDB(self.parentGroup.name)
         self.b64code = self.ip_to_b64(self.name)
-        self.crcFile = crcFile
-        self.rcFile = rcFile
+        self.crcFile = Cloginrc()
+        self.rcFile = RancidConf()
         self.exDetails = {}
-        self.pullDetails()
+        self.lastChange = None
+        self.pullDetails(dbDetails,rcDetails,djangoDevice)
         self.fillAllSettings()
 
     def ip_to_b64(self,ipStr):
@@ -81,21 +135,32 @@ class DjancidDevice(DjancidBase):
         ipStr = b64decode(bytes(b64encoded,'ascii')).decode('ascii')
         return(ipStr)
 
-    def pullDetails(self):
-        '''Gets the details for this device from files and database'''
-        try:
-            self.dbDetails = self.rdbFile.getRouterDetails(self.name)
-        except self.rdbFile.RouterNotFoundException:
-            self.dbDetails = {}
-        try:
-            self.rcDetails = self.crcFile.getRouterDetails(self.name)
-        except self.crcFile.NoRouterDetails:
-            self.rcDetails = {}
+    def pullDetails(self,dbDetails=None,rcDetails=None,djangoDevice=None):
+        '''Gets the details for this device from files and database. Details that were
+        already loaded in bulk (see DjancidGroup.loadDevices) can be passed in'''
+        if dbDetails is not None:
+            self.dbDetails = dict(dbDetails)
+        else:
+            try:
+                self.dbDetails = self.rdbFile.getRouterDetails(self.name)
+            except self.rdbFile.RouterNotFoundException:
+                self.dbDetails = {}
+        if rcDetails is not None:
+            self.rcDetails = dict(rcDetails)
+        else:
+            try:
+                self.rcDetails = self.crcFile.getRouterDetails(self.name)
+            except self.crcFile.NoRouterDetails:
+                self.rcDetails = {}
         if "password" in self.rcDetails.keys():
-            if isinstance(self.rcDetails['password'],list):
-                self.exDetails['enablepassword'] = self.rcDetails['password'][1]
-                self.rcDetails['password'] = self.rcDetails['password'][0]
-        self.djangoDevice,created = Device.objects.get_or_create(ip=self.name)
+            passwords = self.rcDetails['password']
+            if len(passwords) > 1:
+                self.exDetails['enablepassword'] = passwords[1]
+            self.rcDetails['password'] = passwords[0]
+        if djangoDevice is not None:
+            self.djangoDevice = djangoDevice
+        else:
+            self.djangoDevice,created = Device.objects.get_or_create(ip=self.name)
         self.inherits = self.djangoDevice.inheritGroupSettings
         if self.inherits:
             self.inheritGroupSettings()
@@ -116,26 +181,42 @@ class DjancidDevice(DjancidBase):
             raise(MissingRequiredSetting("deviceType setting needs to be defined"))
         if "status" not in self.dbDetails.keys():
             raise(MissingRequiredSetting("status setting needs to be defined"))
-        self.djangoDevice,created = Device.objects.get_or_create(ip=self.name)
-        self.djangoDevice.inheritGroupSettings = self.inherits
-        self.djangoDevice.save()
         if self.inherits:
             self.inheritGroupSettings()
-        try:
-            self.rdbFile.addRouter(self.name,self.dbDetails['deviceType'],self.dbDetails['status'])
-        except self.rdbFile.RouterAlreadyExistsException:
-            self.rdbFile.editRouter(self.name,self.dbDetails['deviceType'],self.dbDetails['status'])
-        for settingName,settingValue in self.rcDetails.items():
-            self.crcFile.addDetail(self.name,settingName,settingValue)
-        if self.exDetails:
-            if "enablepassword" in self.exDetails.keys():
-                passwordValue = [self.rcDetails['password'],self.exDetails['enablepassword']]
-                self.crcFile.addDetail(self.name,"password",passwordValue)
+        with FileTransaction():
+            try:
+                self.rdbFile.addRouter(self.name,self.dbDetails['deviceType'],self.dbDetails['status'])
+            except self.rdbFile.RouterAlreadyExistsException:
+                self.rdbFile.editRouter(self.name,self.dbDetails['deviceType'],self.dbDetails['status'])
+            self.crcFile.addDetails(self.name,self.changedRcDetails())
+        # Saved once the files are, so nothing is saved when rancid-run holds the group
+        upsert(Device,{"inheritGroupSettings":self.inherits},ip=self.name)
+        self.djangoDevice.inheritGroupSettings = self.inherits
+
+    def changedRcDetails(self):
+        '''The .cloginrc settings that are not already set for this device on its own
+        lines, with clogin resolving them to that value. A value that only a wildcard
+        entry supplies is written out, so later edits to the wildcard leave the device
+        alone. enablepassword is folded into the password setting'''
+        rcDetails = dict(self.rcDetails)
+        if "enablepassword" in self.exDetails.keys() and "password" in rcDetails.keys():
+            rcDetails['password'] = [rcDetails['password'],self.exDetails['enablepassword']]
+        hostDetails = self.crcFile.hostDetails(self.name)
+        currentDetails = self.crcFile.resolve(self.name)
+        changed = {}
+        for settingName,settingValue in rcDetails.items():
+            wanted = self.crcFile.formatValue(settingValue)
+            if settingName in hostDetails.keys() and settingName in currentDetails.keys():
+                if self.crcFile.formatValue(hostDetails[settingName]) == wanted and self.crcFile.formatValue(currentDetails[settingName]) == wanted:
+                    continue
+            changed[settingName] = settingValue
+        return(changed)
 
     def delete(self):
         '''Remove from routerdb and cloginrc and django database'''
-        self.rdbFile.deleteRouter(self.name)
-        self.crcFile.deleteRouterDetails(self.name)
+        with FileTransaction():
+            self.rdbFile.deleteRouter(self.name)
+            self.crcFile.deleteRouterDetails(self.name)
         self.djangoDevice.delete()
 
     def fillAllSettings(self):
@@ -156,10 +237,11 @@ class DjancidDevice(DjancidBase):
             del self.exDetails[settingName]
 
     def changeGroup(self,newGroupObj):
-        self.rdbFile.deleteRouter(self.name)
-        self.parentGroup = newGroupObj
-        self.rdbFile = RouterDB(self.parentGroup.name)
-        self.save()
+        with FileTransaction():
+            self.rdbFile.deleteRouter(self.name)
+            self.parentGroup = newGroupObj
+            self.rdbFile = RouterDB(self.parentGroup.name)
+            self.save()
 
 
 class DjancidGroup(DjancidBase):
@@ -172,8 +254,8 @@ class DjancidGroup(DjancidBase):
             self.rdbFile = RouterDB(self.name)
         except FileNotFoundError:
             self.rdbFile = None
-        self.crcFile = crcFile
-        self.rcFile = rcFile
+        self.crcFile = Cloginrc()
+        self.rcFile = RancidConf()
         self.dbDetails = {}
         self.rcDetails = {}
         self.exDetails = {}
@@ -184,6 +266,41 @@ class DjancidGroup(DjancidBase):
             self.devices = []
         self.fillAllSettings()
 
+    @staticmethod
+    def loadDevices(groupObjs,lastChanges=True):
+        '''Build the DjancidDevices of several groups at once. router.db and .cloginrc are
+        parsed once each and all Device rows come from a single query, with missing rows
+        created in bulk; the unique ip catches rows another request creates meanwhile.
+        Unless lastChanges is False, each device's lastChange comes from its group's
+        last-change index, which may run git. Sets djDevices on every group and returns
+        all devices'''
+        names = set()
+        for groupObj in groupObjs:
+            names.update([device['ip'] for device in groupObj.devices])
+        djangoDevices = dict([(d.ip,d) for d in Device.objects.filter(ip__in=names)])
+        missing = [name for name in names if name not in djangoDevices]
+        if missing:
+            try:
+                with transaction.atomic():
+                    Device.objects.bulk_create([Device(ip=name) for name in missing])
+            except IntegrityError:
+                for name in missing:
+                    Device.objects.get_or_create(ip=name)
+            djangoDevices.update(dict([(d.ip,d) for d in Device.objects.filter(ip__in=missing)]))
+        allDevices = []
+        for groupObj in groupObjs:
+            rcDetails = Cloginrc().getAllRouterDetails([device['ip'] for device in groupObj.devices])
+            groupObj.djDevices = [
+                DjancidDevice(device['ip'],groupObj,dbDetails=device,rcDetails=rcDetails[device['ip']],djangoDevice=djangoDevices[device['ip']])
+                for device in groupObj.devices
+            ]
+            if lastChanges:
+                groupChanges = get_last_changes(groupObj.name)
+                for djDevice in groupObj.djDevices:
+                    djDevice.lastChange = groupChanges.get(djDevice.name)
+            allDevices.extend(groupObj.djDevices)
+        return(allDevices)
+
     def pullSettings(self):
         '''Pull all settings objects from Django database'''
         self.groupSettings = RancidGroupSetting.objects.filter(rancidGroup=self.name)
@@ -202,52 +319,69 @@ class DjancidGroup(DjancidBase):
                 self.exDetails[setting.settingName] = settingValue
 
     def save(self):
-        '''Write group to LIST_OF_GROUPS if not exist. Save settings to database'''
+        '''Write group to LIST_OF_GROUPS if not exist. Save settings to database. Raises
+        RancidRunBusy, having saved nothing, while rancid-run is collecting the group'''
+        wait_for_rancid_run(self.name)
         groups = self.rcFile.readSetting("LIST_OF_GROUPS")
-        if self.name not in groups.split(" "):
+        if self.name not in groups.split():
             self.rcFile.appendValue("LIST_OF_GROUPS",self.name)
-            subprocess.call(os.path.join(settings.RANCID_BIN_DIR,"rancid-cvs"))
+            list_of_groups_changed.send(sender=self.__class__,group=self.name)
+            enqueue("rancid-cvs")
         for detail in [self.dbDetails,self.rcDetails,self.exDetails]:
             for settingName,settingValue in detail.items():
-                settingObj, created = RancidGroupSetting.objects.get_or_create(rancidGroup=self.name,settingName=settingName)
-                settingObj.settingValue = settingValue
-                settingObj.save()
+                upsert(RancidGroupSetting,{"settingValue":settingValue},rancidGroup=self.name,settingName=settingName)
         self.groupSettings = RancidGroupSetting.objects.filter(rancidGroup=self.name)
         self.refreshDevices()
 
     def delete(self):
-        '''Delete from LIST_OF_GROUPS if exists. Delete settings from database'''
+        '''Delete from LIST_OF_GROUPS if exists. Delete settings from database. Queues
+        rancid-cvs and the removal of the group's files for the job worker'''
         groups = self.rcFile.readSetting("LIST_OF_GROUPS")
-        if self.name in groups.split(" "):
+        if self.name in groups.split():
             self.rcFile.deleteValue("LIST_OF_GROUPS",self.name)
-            subprocess.call(os.path.join(settings.RANCID_BIN_DIR,"rancid-cvs"))
+            list_of_groups_changed.send(sender=self.__class__,group=self.name)
+            enqueue("rancid-cvs")
         self.groupSettings = RancidGroupSetting.objects.filter(rancidGroup=self.name)
         self.groupSettings.delete()
         self.deleteDevices()
-        deleteDirs = [os.path.join(settings.RANCID_ROOT,self.name),os.path.join(rancid_CVSROOT,self.name)]
-        for path in deleteDirs:
-            if os.path.exists(path):
-                shutil.rmtree(path)
-        deleteLogs = [f for f in os.listdir(rancid_LOGDIR) if self.name in f]
-        for logFile in deleteLogs:
-            path = os.path.join(rancid_LOGDIR,logFile)
-            os.remove(path)
+        enqueue("delete-group",self.name)
 
     def deleteDevices(self):
-        if self.rdbFile is not None:
-            self.devices = self.rdbFile.getAllRouters()
-        for device in self.devices:
-            djDevice = DjangoDevice(device['ip'])
-            djDevice.delete()
+        '''Forget the group's devices: their .cloginrc lines, rewritten once, and their
+        database rows. router.db goes with the group's directory'''
+        with FileTransaction():
+            if self.rdbFile is not None:
+                self.devices = self.rdbFile.getAllRouters()
+            ips = [device['ip'] for device in self.devices]
+            self.crcFile.deleteAllRouterDetails(ips)
+        Device.objects.filter(ip__in=ips).delete()
         self.devices = []
 
     def refreshDevices(self):
-        if self.rdbFile is not None:
+        '''Push the group settings to every device that inherits them. The new router.db
+        and .cloginrc contents for the whole group are computed in one pass and each file
+        is rewritten once'''
+        if self.rdbFile is None:
+            return
+        # Wait for rancid-run before locking, so other editors are not held up meanwhile
+        wait_for_rancid_run(self.name)
+        with FileTransaction() as fileTransaction:
+            # Lock both files before reading the devices, so a device saved meanwhile
+            # is not written back with the details it had before. Last changes are not
+            # needed here, so other editors never wait on git behind these locks
+            fileTransaction.lock(self.rdbFile.filePath)
+            fileTransaction.lock(self.crcFile.filePath)
             self.devices = self.rdbFile.getAllRouters()
-        for device in self.devices:
-            djDevice = DjancidDevice(device['ip'],self)
-            if djDevice.inherits:
-                djDevice.save()
+            routerChanges = {}
+            rcChanges = {}
+            for djDevice in DjancidGroup.loadDevices([self],lastChanges=False):
+                if djDevice.inherits:
+                    djDevice.inheritGroupSettings()
+                    routerChanges[djDevice.name] = (djDevice.dbDetails.get('deviceType'),djDevice.dbDetails.get('status'))
+                    rcChanges[djDevice.name] = djDevice.changedRcDetails()
+            self.rdbFile.editRouters(routerChanges)
+            self.crcFile.addAllRouterDetails(rcChanges)
+        self.devices = self.rdbFile.getAllRouters()
 
     def deleteSetting(self,settingName):
         groupSetting = RancidGroupSetting.objects.filter(rancidGroup=self.name,settingName=settingName)
@@ -258,10 +392,7 @@ class DjancidGroup(DjancidBase):
                 del detail[settingName]
 
     def addPermission(self,djangoGroup):
-        rgp,created = RancidGroupPermission.objects.get_or_create(
-                rancidGroup=self.name,djangoGroup=djangoGroup)
-        if created:
-            rgp.save()
+        RancidGroupPermission.objects.get_or_create(rancidGroup=self.name,djangoGroup=djangoGroup)
 
     def deletePermission(self,djangoGroup):
         rgp = RancidGroupPermission.objects.filter(
@@ -0,0 +1,276 @@
+import bisect
+import ipaddress
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger("rancid.metrics")
+
+_local = threading.local()
+
+# Kinds of work counted per request. db and template are measured by TimedCursor and
+# TimedDjangoTemplates, the rest by timed() around the code doing it
+KINDS = ["db","file_read","file_write","git","git_object","subprocess","template"]
+
+SECONDS_BUCKETS = [0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0]
+COUNT_BUCKETS = [0,1,2,3,5,10,20,50,100,200,500,1000]
+
+
+class Histogram(object):
+    '''Cumulative bucket counts, sum and count of observed values, as Prometheus keeps them'''
+    def __init__(self,buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    '''Process wide histograms, each named metric split by its labels. Every mod_wsgi
+    process has its own, so a scrape sees the process that answered it'''
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def define(self,name,help,buckets,labelNames):
+        self.metrics[name] = {"help":help,"buckets":buckets,"labelNames":labelNames,"series":{}}
+
+    def observe(self,name,value,*labelValues):
+        metric = self.metrics[name]
+        with self.lock:
+            histogram = metric['series'].get(labelValues)
+            if histogram is None:
+                histogram = metric['series'][labelValues] = Histogram(metric['buckets'])
+            histogram.observe(value)
+
+    def clear(self):
+        with self.lock:
+            for metric in self.metrics.values():
+                metric['series'] = {}
+
+    def render(self):
+        '''Every histogram in the Prometheus text exposition format'''
+        lines = []
+        with self.lock:
+            for name,metric in sorted(self.metrics.items()):
+                lines.append("# HELP {n} {h}".format(n=name,h=metric['help']))
+                lines.append("# TYPE {n} histogram".format(n=name))
+                for labelValues,histogram in sorted(metric['series'].items()):
+                    labels = list(zip(metric['labelNames'],labelValues))
+                    cumulative = 0
+                    for bound,count in zip(metric['buckets'] + ["+Inf"],histogram.counts):
+                        cumulative += count
+                        lines.append("{n}_bucket{l} {c}".format(n=name,l=format_labels(labels + [("le",bound)]),c=cumulative))
+                    lines.append("{n}_sum{l} {s!r}".format(n=name,l=format_labels(labels),s=histogram.sum))
+                    lines.append("{n}_count{l} {c}".format(n=name,l=format_labels(labels),c=histogram.count))
+        return(lines)
+
+registry = Registry()
+registry.define("djancid_operation_duration_seconds","Time taken by each file read or write, git command, subprocess, query or template render",SECONDS_BUCKETS,["kind"])
+registry.define("djancid_request_duration_seconds","Time to handle a request",SECONDS_BUCKETS,["view"])
+registry.define("djancid_request_operations","Operations of each kind done by a request",COUNT_BUCKETS,["view","kind"])
+registry.define("djancid_request_operation_seconds","Time a request spent on each kind of operation",SECONDS_BUCKETS,["view","kind"])
+
+def format_labels(labels):
+    if not labels:
+        return("")
+    escaped = [(k,str(v).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")) for k,v in labels]
+    return("{" + ",".join('{k}="{v}"'.format(k=k,v=v) for k,v in escaped) + "}")
+
+
+class RequestMetrics(object):
+    '''Count and total seconds of each kind of operation done while handling one request'''
+    def __init__(self):
+        self.counts = dict((kind,0) for kind in KINDS)
+        self.seconds = dict((kind,0.0) for kind in KINDS)
+
+    def add(self,kind,seconds,count=1):
+        self.counts[kind] += count
+        self.seconds[kind] += seconds
+
+    def summary(self):
+        return(" ".join("{k}={c}/{s:.1f}ms".format(k=kind,c=self.counts[kind],s=self.seconds[kind] * 1000) for kind in KINDS))
+
+def current_request():
+    '''RequestMetrics of the request this thread is handling, or None'''
+    return(getattr(_local,"request",None))
+
+def record(kind,seconds,count=1):
+    '''Add count operations of a kind that took seconds in total'''
+    requestMetrics = current_request()
+    if requestMetrics is not None:
+        requestMetrics.add(kind,seconds,count)
+    if count == 1:
+        registry.observe("djancid_operation_duration_seconds",seconds,kind)
+
+@contextmanager
+def timed(kind):
+    '''Count and time the enclosed operation'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind,time.perf_counter() - start)
+
+class TimedCursor(object):
+    '''Database cursor with each query counted and timed as db work. Unlike Django's
+    debug cursor it keeps no SQL, so it costs next to nothing on every request'''
+    def __init__(self,cursor):
+        self.cursor = cursor
+
+    def __getattr__(self,name):
+        return(getattr(self.cursor,name))
+
+    def __iter__(self):
+        return(iter(self.cursor))
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self,excType,excValue,traceback):
+        return(self.cursor.__exit__(excType,excValue,traceback))
+
+    def execute(self,sql,params=None):
+        with timed("db"):
+            return(self.cursor.execute(sql,params))
+
+    def executemany(self,sql,paramList):
+        with timed("db"):
+            return(self.cursor.executemany(sql,paramList))
+
+    def callproc(self,procname,params=None):
+        with timed("db"):
+            return(self.cursor.callproc(procname,params))
+
+def time_queries(connection):
+    '''Have a connection hand out TimedCursors, wrapping both its plain cursors and the
+    debug cursors that DEBUG and the test runner turn on. Done once per connection'''
+    if getattr(connection,"queriesTimed",False):
+        return
+    makeCursor = connection.make_cursor
+    makeDebugCursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: TimedCursor(makeCursor(cursor))
+    connection.make_debug_cursor = lambda cursor: TimedCursor(makeDebugCursor(cursor))
+    connection.queriesTimed = True
+
+@contextmanager
+def collecting():
+    '''Collect the operations done by this thread into a new RequestMetrics, which is
+    yielded'''
+    requestMetrics = RequestMetrics()
+    outer = current_request()
+    _local.request = requestMetrics
+    for connection in connections.all():
+        time_queries(connection)
+    try:
+        yield(requestMetrics)
+    finally:
+        _local.request = outer
+        if outer is not None:
+            for kind in KINDS:
+                outer.add(kind,requestMetrics.seconds[kind],requestMetrics.counts[kind])
+
+
+class MetricsMiddleware(object):
+    '''Counts and times the file, git, subprocess, database and template work of each
+    request. The totals are logged to rancid.metrics with the view name and added to the
+    histograms served by the Metrics view. Goes first in MIDDLEWARE to see everything'''
+    def __init__(self,get_response):
+        self.get_response = get_response
+
+    def __call__(self,request):
+        request.metricsView = None
+        start = time.perf_counter()
+        with collecting() as requestMetrics:
+            response = self.get_response(request)
+        seconds = time.perf_counter() - start
+        view = request.metricsView or "unresolved"
+        registry.observe("djancid_request_duration_seconds",seconds,view)
+        for kind in KINDS:
+            registry.observe("djancid_request_operations",requestMetrics.counts[kind],view,kind)
+            registry.observe("djancid_request_operation_seconds",requestMetrics.seconds[kind],view,kind)
+        logger.info("%s %s %s %s %.1fms %s",view,request.method,request.path,response.status_code,seconds * 1000,requestMetrics.summary())
+        return(response)
+
+    def process_view(self,request,viewFunc,viewArgs,viewKwargs):
+        viewClass = getattr(viewFunc,"view_class",None)
+        request.metricsView = viewClass.__name__ if viewClass is not None else viewFunc.__name__
+
+
+class TimedTemplate(object):
+    def __init__(self,template):
+        self.template = template
+
+    def __getattr__(self,name):
+        return(getattr(self.template,name))
+
+    def render(self,context=None,request=None):
+        if getattr(_local,"rendering",False):
+            return(self.template.render(context,request))
+        _local.rendering = True
+        try:
+            with timed("template"):
+                return(self.template.render(context,request))
+        finally:
+            _local.rendering = False
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    '''The Django template backend, with each top level render counted and timed.
+    Templates rendered from inside another, such as a form's, count towards the outer one'''
+    def from_string(self,templateCode):
+        return(TimedTemplate(super(TimedDjangoTemplates,self).from_string(templateCode)))
+
+    def get_template(self,templateName):
+        return(TimedTemplate(super(TimedDjangoTemplates,self).get_template(templateName)))
+
+
+def address_allowed(address,allowed):
+    '''True if address is in one of the allowed addresses or networks'''
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return(False)
+    for network in allowed:
+        try:
+            if address in ipaddress.ip_network(network,strict=False):
+                return(True)
+        except ValueError:
+            continue
+    return(False)
+
+def stats_lines():
+    '''Counters kept by FileLock, RepoPool and the blob cache, as Prometheus counters'''
+    from rancid.lib.fileops import FileLock
+    from rancid.lib.gitops import RepoPool,blob_cache
+    lines = []
+    def counter(name,help,values,metricType="counter"):
+        lines.append("# HELP {n} {h}".format(n=name,h=help))
+        lines.append("# TYPE {n} {t}".format(n=name,t=metricType))
+        for labels,value in values:
+            lines.append("{n}{l} {v!r}".format(n=name,l=format_labels(labels),v=value))
+    with FileLock.statsLock:
+        lockStats = dict(FileLock.stats)
+    counter("djancid_file_lock_total","File lock acquisitions by outcome",
+        [([("event",event)],lockStats[event]) for event in ["acquired","contended","timeouts"]])
+    counter("djancid_file_lock_wait_seconds_total","Time spent waiting for file locks",[([],lockStats['waitSeconds'])])
+    with RepoPool.statsLock:
+        poolStats = dict(RepoPool.stats)
+    counter("djancid_repo_pool_total","Git repository handle pool events",
+        [([("event",event)],value) for event,value in sorted(poolStats.items())])
+    cache = blob_cache()
+    counter("djancid_blob_cache_total","Blob cache lookups by result",[([("result","hit")],cache.hits),([("result","miss")],cache.misses)])
+    counter("djancid_blob_cache_bytes","Bytes of blobs held in the blob cache",[([],cache.size)],"gauge")
+    return(lines)
+
+def render_metrics():
+    '''The /metrics page: request and operation histograms and the library counters'''
+    return("\n".join(registry.render() + stats_lines()) + "\n")
@@ -0,0 +1,238 @@
+import os
+import pickle
+import tempfile
+import threading
+from django.conf import settings
+from rancid.lib.fileops import FileLock,file_signature
+from rancid.lib.gitops import open_repo,head_commit
+from rancid.lib.metrics import timed
+
+_indexes = {}
+_indexesLock = threading.Lock()
+
+# Shorter queries have no trigrams to narrow the search, so would read every config
+MIN_QUERY_LENGTH = 3
+
+def trigrams(text):
+    '''Set of lower case three character substrings of text'''
+    text = text.lower()
+    return(set(text[i:i+3] for i in range(len(text) - 2)))
+
+def index_path(group):
+    indexDir = getattr(settings,"SEARCH_INDEX_DIR",None) or settings.RANCID_ROOT
+    return(os.path.join(indexDir,".djancid-search-{g}.pickle".format(g=group)))
+
+
+def bitmap(docIds):
+    '''Integer with the bit for each document id set'''
+    data = bytearray((max(docIds) >> 3) + 1)
+    for docId in docIds:
+        data[docId >> 3] |= 1 << (docId & 7)
+    return(int.from_bytes(data,"little"))
+
+def bitmap_ids(bits):
+    '''Document ids set in an integer bitmap'''
+    return([i for i,bit in enumerate(reversed(bin(bits))) if bit == "1"])
+
+
+class ConfigIndex(object):
+    '''Trigram index over the committed configs/* of one group. Each device gets a
+    document id and every trigram maps to a bitmap of the ids whose config contains it.
+    The index remembers the commit it was built from and the blob of every config, so it
+    is brought up to date from "git diff --raw" between that commit and HEAD'''
+    def __init__(self,group):
+        self.group = group
+        self.signature = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Forget everything indexed. The lock is kept, since the caller may hold it'''
+        self.head = None
+        self.devices = {}
+        self.names = {}
+        self.postings = {}
+        self.freeIds = []
+        self.nextId = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        del state['signature']
+        return(state)
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.signature = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls,group):
+        '''Index saved on disk for the group, or an empty one'''
+        filePath = index_path(group)
+        try:
+            signature = file_signature(filePath)
+            with timed("file_read"),open(filePath,"rb") as f:
+                index = pickle.load(f)
+        except (FileNotFoundError,EOFError,pickle.UnpicklingError):
+            return(cls(group))
+        index.signature = signature
+        return(index)
+
+    def save(self):
+        filePath = index_path(self.group)
+        fd,tempPath = tempfile.mkstemp(dir=os.path.dirname(filePath),prefix=".djancid-search-")
+        try:
+            with timed("file_write"),os.fdopen(fd,"wb") as f:
+                pickle.dump(self,f,pickle.HIGHEST_PROTOCOL)
+            os.replace(tempPath,filePath)
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+        self.signature = file_signature(filePath)
+
+    def readBlob(self,repo,sha):
+        with timed("git_object"):
+            return(repo.odb.stream(bytes.fromhex(sha)).read().decode("utf-8","replace"))
+
+    def changes(self,repo,head):
+        '''(device, new blob sha or None) for every config that differs between the
+        indexed commit and head. Everything is returned when the indexed commit has gone'''
+        from git.exc import GitCommandError
+        if self.head is not None:
+            try:
+                output = repo.git.diff("--raw","-z","--no-renames","--no-abbrev",self.head,head,"--","configs/")
+            except GitCommandError:
+                self.reset()
+            else:
+                fields = output.split("\0")
+                for status,path in zip(fields[0::2],fields[1::2]):
+                    newSha = status.split()[3]
+                    yield((path[len("configs/"):],None if status.endswith("D") else newSha))
+                return
+        output = repo.git.ls_tree("-r","-z",head,"--","configs/")
+        for entry in output.split("\0"):
+            if entry:
+                info,path = entry.split("\t",1)
+                yield((path[len("configs/"):],info.split()[2]))
+
+    def update(self,repo,head):
+        '''Apply the changes between the indexed commit and head. The old blob of a changed
+        config gives the trigrams to clear, and each trigram's bitmap is rewritten once'''
+        with self.lock:
+            removed = {}
+            added = {}
+            for device,sha in list(self.changes(repo,head)):
+                if device in self.devices:
+                    docId,oldSha = self.devices.pop(device)
+                    for trigram in trigrams(self.readBlob(repo,oldSha)):
+                        removed.setdefault(trigram,[]).append(docId)
+                    if sha is None:
+                        del self.names[docId]
+                        self.freeIds.append(docId)
+                elif sha is not None:
+                    if self.freeIds:
+                        docId = self.freeIds.pop()
+                    else:
+                        docId = self.nextId
+                        self.nextId += 1
+                    self.names[docId] = device
+                if sha is not None:
+                    self.devices[device] = (docId,sha)
+                    for trigram in trigrams(self.readBlob(repo,sha)):
+                        added.setdefault(trigram,[]).append(docId)
+            for trigram in set(removed) | set(added):
+                bits = self.postings.get(trigram,0)
+                if trigram in removed:
+                    bits &= ~bitmap(removed[trigram])
+                if trigram in added:
+                    bits |= bitmap(added[trigram])
+                if bits:
+                    self.postings[trigram] = bits
+                else:
+                    self.postings.pop(trigram,None)
+            self.head = head
+
+    def search(self,query,maxLines=None,limit=None):
+        '''{device: [(line number, line)]} for configs containing query, ignoring case, in
+        device order. Candidates come from ANDing the trigram bitmaps and are confirmed
+        against the same committed blobs the index was built from, so configs rancid-run
+        has written but not committed yet do not skew the results. Stops once limit
+        devices have matched. Queries shorter than MIN_QUERY_LENGTH match nothing'''
+        if maxLines is None:
+            maxLines = settings.SEARCH_MAX_LINES
+        needle = query.lower()
+        queryTrigrams = trigrams(query)
+        if not queryTrigrams:
+            return({})
+        with self.lock:
+            candidates = -1
+            for trigram in queryTrigrams:
+                candidates &= self.postings.get(trigram,0)
+                if not candidates:
+                    break
+            devices = sorted((self.names[docId],self.devices[self.names[docId]][1]) for docId in bitmap_ids(candidates))
+        results = {}
+        repo = open_repo(self.group) if devices else None
+        for device,sha in devices:
+            if limit is not None and len(results) >= limit:
+                break
+            text = self.readBlob(repo,sha)
+            lowered = text.lower()
+            position = lowered.find(needle)
+            lines = []
+            while position != -1 and len(lines) < maxLines:
+                start = lowered.rfind("\n",0,position) + 1
+                end = lowered.find("\n",position)
+                if end == -1:
+                    end = len(lowered)
+                lines.append((lowered.count("\n",0,start) + 1,text[start:end]))
+                position = lowered.find(needle,end)
+            if lines:
+                results[device] = lines
+        return(results)
+
+
+def get_index(group):
+    '''Up to date index for a group, or None if the group has no commits. Kept in memory
+    per process; the saved copy is reloaded when another process has updated it'''
+    from git.exc import InvalidGitRepositoryError,NoSuchPathError
+    try:
+        repo = open_repo(group)
+        head = head_commit(repo)
+    except (InvalidGitRepositoryError,NoSuchPathError,ValueError):
+        return(None)
+    with _indexesLock:
+        index = _indexes.get(group)
+    if index is not None and index.head == head:
+        return(index)
+    with FileLock(index_path(group)):
+        try:
+            signature = file_signature(index_path(group))
+        except FileNotFoundError:
+            signature = None
+        if index is None or signature != index.signature:
+            index = ConfigIndex.load(group)
+        if index.head != head:
+            index.update(repo,head)
+            index.save()
+    with _indexesLock:
+        _indexes[group] = index
+    return(index)
+
+def search_configs(query,groups):
+    '''[(group, device, [(line number, line)])] for every device in groups whose latest
+    committed config contains query, ignoring case. At most SEARCH_MAX_RESULTS devices;
+    no more configs are read once that many have matched'''
+    results = []
+    if len(query) < MIN_QUERY_LENGTH:
+        return(results)
+    for group in groups:
+        if len(results) >= settings.SEARCH_MAX_RESULTS:
+            break
+        index = get_index(group)
+        if index is None:
+            continue
+        for device,lines in index.search(query,limit=settings.SEARCH_MAX_RESULTS - len(results)).items():
+            results.append((group,device,lines))
+    return(results)
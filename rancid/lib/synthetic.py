@@ -0,0 +1,133 @@
+import os
+import random
+import subprocess
+
+DEVICE_TYPES = ["cisco","juniper","arista","hp","foundry"]
+METHODS = ["ssh","telnet","{ssh} {telnet}"]
+
+def device_name(groupIndex,deviceIndex):
+    return("10.{g}.{h}.{l}".format(g=groupIndex,h=deviceIndex // 250,l=deviceIndex % 250 + 1))
+
+def group_name(groupIndex):
+    return("GROUP{g:03d}".format(g=groupIndex))
+
+def write_lines(filePath,lines):
+    with open(filePath,"w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def device_config(device,revision,lines):
+    '''A plausible IOS style config. Most lines are stable across revisions; a few depend
+    on the revision so each commit produces a small diff'''
+    config = [
+        "!RANCID-CONTENT-TYPE: cisco",
+        "!",
+        "hostname {d}".format(d=device.replace(".","-")),
+        "! revision {r}".format(r=revision),
+        "snmp-server community {c} RO".format(c="public" if revision % 7 else "rotated{r}".format(r=revision)),
+        "ntp server 192.0.2.{n}".format(n=revision % 4 + 1),
+    ]
+    interface = 0
+    while len(config) < lines:
+        config.extend([
+            "interface GigabitEthernet0/{i}".format(i=interface),
+            " description link {i} to {d}".format(i=interface,d=device),
+            " ip address 10.{a}.{b}.1 255.255.255.0".format(a=interface // 256,b=interface % 256),
+            " shutdown" if interface == revision % 10 else " no shutdown",
+        ])
+        interface += 1
+    return("\n".join(config[:lines]) + "\n")
+
+def fast_import_stream(devices,commits,lines,churn,rng,start=1500000000):
+    '''git fast-import commands for a group history of commits commits. The first adds
+    every device's config and router.db; each later one rewrites a churn fraction of the
+    configs, as a rancid-run that saw that many changes would. Yields bytes'''
+    def data(text):
+        payload = text.encode("utf-8")
+        return(b"data " + str(len(payload)).encode("ascii") + b"\n" + payload + b"\n")
+    routerDB = "".join("{d};{t};up\n".format(d=d,t=DEVICE_TYPES[i % len(DEVICE_TYPES)]) for i,d in enumerate(devices))
+    for commit in range(commits):
+        when = start + commit * 3600
+        yield(b"commit refs/heads/master\n")
+        yield(b"mark :" + str(commit + 1).encode("ascii") + b"\n")
+        yield("committer rancid <rancid@localhost> {w} +0000\n".format(w=when).encode("ascii"))
+        yield(data("updates"))
+        if commit == 0:
+            changed = devices
+            yield(b"M 100644 inline router.db\n")
+            yield(data(routerDB))
+        else:
+            yield(b"from :" + str(commit).encode("ascii") + b"\n")
+            changed = rng.sample(devices,max(1,int(len(devices) * churn)))
+        for device in changed:
+            yield("M 100644 inline configs/{d}\n".format(d=device).encode("ascii"))
+            yield(data(device_config(device,commit,lines)))
+    yield(b"done\n")
+
+def build_group(rancidRoot,groupIndex,devices,commits,lines,churn,rng):
+    groupDir = os.path.join(rancidRoot,group_name(groupIndex))
+    os.makedirs(groupDir)
+    subprocess.check_call(["git","init","-q",groupDir])
+    subprocess.check_call(["git","-C",groupDir,"symbolic-ref","HEAD","refs/heads/master"])
+    names = [device_name(groupIndex,i) for i in range(devices)]
+    proc = subprocess.Popen(["git","-C",groupDir,"fast-import","--quiet","--done"],stdin=subprocess.PIPE)
+    for chunk in fast_import_stream(names,commits,lines,churn,rng):
+        proc.stdin.write(chunk)
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise(RuntimeError("git fast-import failed for {g}".format(g=groupDir)))
+    subprocess.check_call(["git","-C",groupDir,"reset","-q","--hard"])
+    return(names)
+
+def build_cloginrc(filePath,hostEntries,globEntries,rng):
+    '''A .cloginrc with per-host lines for some devices, per-subnet wildcard lines and
+    catch-all defaults last, which is the order clogin needs for first match wins'''
+    lines = ["# synthetic .cloginrc"]
+    for device in hostEntries:
+        lines.append("add user {d} {{admin}}".format(d=device))
+        lines.append("add password {d} {{pw{r}}} {{en{r}}}".format(d=device,r=rng.randint(1,99)))
+    for pattern in globEntries:
+        lines.append("add method {p} {m}".format(p=pattern,m=METHODS[rng.randrange(len(METHODS))]))
+        lines.append("add autoenable {p} {{1}}".format(p=pattern))
+    lines.extend([
+        "add user * {rancid}",
+        "add password * {default} {enable}",
+        "add method * {ssh}",
+    ])
+    write_lines(filePath,lines)
+
+def build_tree(root,groups=2,devices=50,commits=10,lines=200,churn=0.1,hostFraction=0.2,seed=0):
+    '''Build a fake RANCID installation under root: etc/rancid.conf and rancid.types.base,
+    var/.cloginrc, and for each group a router.db, configs/ and a git repo with commits
+    commits. Returns the settings to override to point djancid at it'''
+    rng = random.Random(seed)
+    etcDir = os.path.join(root,"etc")
+    rancidRoot = os.path.join(root,"var")
+    binDir = os.path.join(rancidRoot,"bin")
+    for path in [etcDir,binDir,os.path.join(rancidRoot,"logs"),os.path.join(rancidRoot,"CVS"),os.path.join(rancidRoot,"tmp")]:
+        os.makedirs(path)
+    groupNames = [group_name(g) for g in range(groups)]
+    write_lines(os.path.join(etcDir,"rancid.conf"),[
+        "# synthetic rancid.conf",
+        "TERM=network;export TERM",
+        "umask 027",
+        "BASEDIR={r}; export BASEDIR".format(r=rancidRoot),
+        "PATH={b}:/usr/bin:/bin; export PATH".format(b=binDir),
+        "CVSROOT=$BASEDIR/CVS; export CVSROOT",
+        "LOGDIR=$BASEDIR/logs; export LOGDIR",
+        "TMPDIR=$BASEDIR/tmp; export TMPDIR",
+        "RCSSYS=git; export RCSSYS",
+        "PAR_COUNT=5; export PAR_COUNT",
+        'LIST_OF_GROUPS="{g}"; export LIST_OF_GROUPS'.format(g=" ".join(groupNames)),
+    ])
+    write_lines(os.path.join(etcDir,"rancid.types.base"),["{t};script;rancid -t {t}".format(t=t) for t in DEVICE_TYPES])
+    allDevices = []
+    for g in range(groups):
+        allDevices.extend(build_group(rancidRoot,g,devices,commits,lines,churn,rng))
+    hostEntries = rng.sample(allDevices,int(len(allDevices) * hostFraction))
+    globEntries = ["10.{g}.{h}.*".format(g=g,h=h) for g in range(groups) for h in range((devices - 1) // 250 + 1)]
+    build_cloginrc(os.path.join(rancidRoot,".cloginrc"),hostEntries,globEntries,rng)
+    return({
+        "RANCID_SETTINGS_DIR":etcDir + "/",
+        "RANCID_ROOT":rancidRoot + "/",
+        "RANCID_BIN_DIR":binDir + "/",
+    })
@@ -0,0 +1,51 @@
+import datetime
+import json
+import platform
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand,CommandError
+from django.test.utils import setup_databases,teardown_databases
+from rancid.lib.benchmark import time_cold_start,run_lib_benchmarks,parse_scale
+
+DEFAULT_SCALES = ["1x50x20","4x250x50","4x1000x100"]
+
+
+class Command(BaseCommand):
+    help = "Time djancid's cold start and rancid.lib hot paths and print the results as JSON"
+
+    def add_arguments(self,parser):
+        parser.add_argument("--runs",type=int,default=5,help="Timed runs per benchmark")
+        parser.add_argument("--only",choices=["cold-start","lib"],default=None,help="Run one suite only")
+        parser.add_argument("--scale",action="append",default=None,
+            help="GROUPSxDEVICESxCOMMITS synthetic tree size for the lib suite, may be repeated (default {d})".format(d=" ".join(DEFAULT_SCALES)))
+        parser.add_argument("--output",default=None,help="Also write the JSON to this file")
+        parser.add_argument("--max-ms",type=float,default=None,help="Fail if the median cold start is slower than this")
+
+    def handle(self,*args,**options):
+        report = {
+            "started":datetime.datetime.utcnow().isoformat() + "Z",
+            "python":platform.python_version(),
+            "django":django.get_version(),
+        }
+        if options['only'] in (None,"cold-start"):
+            report['coldStart'] = time_cold_start(options['runs'])
+        if options['only'] in (None,"lib"):
+            report['scales'] = []
+            oldConfig = setup_databases(verbosity=0,interactive=False)
+            try:
+                for scale in options['scale'] or DEFAULT_SCALES:
+                    try:
+                        groups,devices,commits = parse_scale(scale)
+                    except ValueError:
+                        raise(CommandError("Invalid scale {s}, expected GROUPSxDEVICESxCOMMITS".format(s=scale)))
+                    report['scales'].append(run_lib_benchmarks(groups,devices,commits,options['runs']))
+                    call_command("flush",interactive=False,verbosity=0)
+            finally:
+                teardown_databases(oldConfig,verbosity=0)
+        output = json.dumps(report,indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'],"w") as f:
+                f.write(output + "\n")
+        if options['max_ms'] is not None and 'coldStart' in report and report['coldStart']['median'] * 1000 > options['max_ms']:
+            raise(CommandError("Median cold start {m:.1f}ms exceeds {b}ms".format(m=report['coldStart']['median'] * 1000,b=options['max_ms'])))
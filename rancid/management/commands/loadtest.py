@@ -0,0 +1,128 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from django.contrib.auth.models import User,Group
+from django.core.management.base import BaseCommand,CommandError
+from django.db import connections
+from django.test.utils import override_settings,setup_databases,teardown_databases
+from rancid.lib.benchmark import parse_scale
+from rancid.lib.fileops import RancidConf,RouterDB
+from rancid.lib.loadtest import WSGIClient,HTTPClient,LoadTestError,serve,run_load_test
+from rancid.lib.synthetic import build_tree,group_name,device_name
+from rancid.models import RancidGroupPermission
+
+PASSWORD = "loadtest"
+
+
+class Command(BaseCommand):
+    help = ("Drive djancid with many concurrent simulated users and print latency percentiles, "
+        "throughput, errors and lost writes as JSON")
+
+    def add_arguments(self,parser):
+        parser.add_argument("--users",type=int,default=10,help="Concurrent simulated users")
+        parser.add_argument("--requests",type=int,default=None,help="Requests per user (default 50)")
+        parser.add_argument("--duration",type=float,default=None,help="Seconds to run for instead of a number of requests")
+        parser.add_argument("--scale",default="2x100x20",help="GROUPSxDEVICESxCOMMITS synthetic tree size (default 2x100x20)")
+        parser.add_argument("--transport",choices=["wsgi","http"],default="wsgi",
+            help="Call djancid.wsgi.application directly, or over HTTP from a local threaded server")
+        parser.add_argument("--url",default=None,
+            help="Test an already running server instead, using this settings file's RANCID tree to check writes")
+        parser.add_argument("--username",default=None,help="Account to log in as with --url")
+        parser.add_argument("--password",default=None,help="Password for --username")
+        parser.add_argument("--seed",type=int,default=0,help="Seed for the request mix")
+        parser.add_argument("--output",default=None,help="Also write the JSON to this file")
+
+    def handle(self,*args,**options):
+        if options['requests'] is None and options['duration'] is None:
+            options['requests'] = 50
+        report = {
+            "started":datetime.datetime.utcnow().isoformat() + "Z",
+            "transport":"url" if options['url'] else options['transport'],
+        }
+        try:
+            if options['url']:
+                report.update(self.run_against_url(options))
+            else:
+                report.update(self.run_synthetic(options))
+        except LoadTestError as e:
+            raise(CommandError(str(e)))
+        output = json.dumps(report,indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'],"w") as f:
+                f.write(output + "\n")
+
+    def run_options(self,options):
+        return({
+            "users":options['users'],
+            "requests":options['requests'],
+            "duration":options['duration'],
+            "seed":options['seed'],
+        })
+
+    def run_against_url(self,options):
+        if not options['username'] or options['password'] is None:
+            raise(CommandError("--url needs --username and --password"))
+        groups = {}
+        for group in RancidConf().readSetting("LIST_OF_GROUPS").split():
+            try:
+                devices = [device['ip'] for device in RouterDB(group).getAllRouters()]
+            except FileNotFoundError:
+                continue
+            if devices:
+                groups[group] = devices
+        if not groups:
+            raise(CommandError("No group in LIST_OF_GROUPS has any devices"))
+        return(run_load_test(lambda: HTTPClient(options['url']),groups,[(options['username'],options['password'])],**self.run_options(options)))
+
+    def run_synthetic(self,options):
+        '''Build a synthetic tree and a throwaway database, then test the app in this process'''
+        try:
+            groupCount,deviceCount,commits = parse_scale(options['scale'])
+        except ValueError:
+            raise(CommandError("Invalid scale {s}, expected GROUPSxDEVICESxCOMMITS".format(s=options['scale'])))
+        root = tempfile.mkdtemp(prefix="djancid-loadtest-")
+        testSettings = connections['default'].settings_dict['TEST']
+        oldTestName = testSettings.get('NAME')
+        if connections['default'].vendor == "sqlite" and not oldTestName:
+            # Concurrent requests need a database file; the in-memory test database
+            # locks whole tables between threads
+            testSettings['NAME'] = os.path.join(root,"loadtest.sqlite3")
+        try:
+            overrides = build_tree(os.path.join(root,"rancid"),groupCount,deviceCount,commits)
+            oldConfig = setup_databases(verbosity=0,interactive=False)
+            try:
+                with override_settings(ALLOWED_HOSTS=["*"],**overrides):
+                    groups = dict([(group_name(g),[device_name(g,i) for i in range(deviceCount)]) for g in range(groupCount)])
+                    accounts = self.create_accounts(groups)
+                    from djancid.wsgi import application
+                    if options['transport'] == "http":
+                        server = serve(application)
+                        baseUrl = "http://127.0.0.1:{p}".format(p=server.server_port)
+                        try:
+                            result = run_load_test(lambda: HTTPClient(baseUrl),groups,accounts,**self.run_options(options))
+                        finally:
+                            server.shutdown()
+                            server.server_close()
+                    else:
+                        result = run_load_test(lambda: WSGIClient(application),groups,accounts,**self.run_options(options))
+            finally:
+                teardown_databases(oldConfig,verbosity=0)
+        finally:
+            testSettings['NAME'] = oldTestName
+            shutil.rmtree(root,ignore_errors=True)
+        result['scale'] = {"groups":groupCount,"devices":deviceCount,"commits":commits}
+        return(result)
+
+    def create_accounts(self,groups):
+        '''A staff account, which sees every group, and an operator whose Django group is
+        given each RANCID group, so both permission paths are exercised'''
+        User.objects.create_user("loadtest-staff",password=PASSWORD,is_staff=True)
+        operator = User.objects.create_user("loadtest-operator",password=PASSWORD)
+        djangoGroup = Group.objects.create(name="loadtest")
+        operator.groups.add(djangoGroup)
+        for group in groups:
+            RancidGroupPermission.objects.create(rancidGroup=group,djangoGroup=djangoGroup)
+        return([("loadtest-staff",PASSWORD),("loadtest-operator",PASSWORD)])
@@ -0,0 +1,25 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rancid.lib.jobs import run_pending
+# Registers the job handlers defined alongside the group code
+import rancid.lib.main
+
+
+class Command(BaseCommand):
+    help = "Run queued djancid jobs such as rancid-cvs and group file removal"
+
+    def add_arguments(self,parser):
+        parser.add_argument("--once",action="store_true",help="Exit once the queue is empty")
+        parser.add_argument("--parallel",type=int,default=None,help="Jobs to run at once (JOB_PAR_COUNT)")
+        parser.add_argument("--poll",type=float,default=None,help="Seconds between queue checks (JOB_POLL_INTERVAL)")
+
+    def handle(self,*args,**options):
+        poll = options['poll'] or settings.JOB_POLL_INTERVAL
+        while True:
+            count = run_pending(options['parallel'])
+            if count:
+                self.stdout.write("Ran {c} job{s}".format(c=count,s="" if count == 1 else "s"))
+            if options['once']:
+                break
+            time.sleep(poll)
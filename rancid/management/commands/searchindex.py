@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from rancid.lib.fileops import RancidConf
+from rancid.lib.search import get_index
+
+
+class Command(BaseCommand):
+    help = "Build or update the config search index, e.g. after rancid-run"
+
+    def add_arguments(self,parser):
+        parser.add_argument("groups",nargs="*",help="Groups to index, all of LIST_OF_GROUPS by default")
+
+    def handle(self,*args,**options):
+        groups = options['groups'] or RancidConf().readSetting("LIST_OF_GROUPS").split()
+        for group in groups:
+            index = get_index(group)
+            if index is None:
+                self.stdout.write("{g}: no commits".format(g=group))
+            else:
+                self.stdout.write("{g}: {d} configs at {h}".format(g=group,d=len(index.devices),h=index.head))
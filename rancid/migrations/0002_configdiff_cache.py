@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 10:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rancid', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfigDiff',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rancidGroup', models.CharField(max_length=100)),
+                ('device', models.CharField(max_length=100)),
+                ('commit', models.CharField(max_length=40)),
+                ('sequence', models.IntegerField()),
+                ('committed', models.DateTimeField()),
+                ('text', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ConfigDiffHead',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rancidGroup', models.CharField(max_length=100)),
+                ('device', models.CharField(max_length=100)),
+                ('commit', models.CharField(max_length=40)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='configdiffhead',
+            unique_together=set([('rancidGroup', 'device')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='configdiff',
+            unique_together=set([('rancidGroup', 'device', 'commit')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='configdiff',
+            index_together=set([('rancidGroup', 'device', 'sequence')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 10:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rancid', '0002_configdiff_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rancidGroup', models.CharField(max_length=100)),
+                ('device', models.CharField(max_length=100)),
+                ('commit', models.CharField(max_length=40)),
+                ('changed', models.DateTimeField()),
+                ('changeCount', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeviceChangeHead',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rancidGroup', models.CharField(max_length=100, unique=True)),
+                ('commit', models.CharField(max_length=40)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='devicechange',
+            unique_together=set([('rancidGroup', 'device')]),
+        ),
+    ]
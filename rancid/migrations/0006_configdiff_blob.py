@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 10:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_diff_cache(apps, schema_editor):
+    # Cached diffs have no blob recorded; they are rebuilt from git on next view
+    apps.get_model('rancid', 'ConfigDiff').objects.all().delete()
+    apps.get_model('rancid', 'ConfigDiffHead').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rancid', '0005_job_target'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_diff_cache, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='configdiff',
+            name='blob',
+            field=models.CharField(max_length=40, null=True),
+        ),
+    ]
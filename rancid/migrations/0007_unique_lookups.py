@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 10:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def delete_duplicates(model, fields, keep):
+    # Keeps one row of each set of duplicates: the first, or the last saved for "last"
+    seen = set()
+    duplicates = []
+    for row in model.objects.order_by('-id' if keep == 'last' else 'id').values_list('id', *fields):
+        if row[1:] in seen:
+            duplicates.append(row[0])
+        else:
+            seen.add(row[1:])
+    for start in range(0, len(duplicates), 500):
+        model.objects.filter(id__in=duplicates[start:start + 500]).delete()
+
+
+def deduplicate(apps, schema_editor):
+    # Concurrent get_or_create calls could create the same row twice before the constraints
+    delete_duplicates(apps.get_model('rancid', 'Device'), ['ip'], 'first')
+    delete_duplicates(apps.get_model('rancid', 'RancidGroupSetting'), ['rancidGroup', 'settingName'], 'last')
+    delete_duplicates(apps.get_model('rancid', 'RancidGroupPermission'), ['rancidGroup', 'djangoGroup'], 'first')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        ('rancid', '0006_configdiff_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='device',
+            name='ip',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='rancidgrouppermission',
+            name='rancidGroup',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rancidgrouppermission',
+            unique_together=set([('rancidGroup', 'djangoGroup')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rancidgroupsetting',
+            unique_together=set([('rancidGroup', 'settingName')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_complete(apps, schema_editor):
+    # Diffs cached so far always covered the whole history
+    apps.get_model('rancid', 'ConfigDiffHead').objects.update(complete=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rancid', '0008_job_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configdiffhead',
+            name='oldest',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='configdiffhead',
+            name='complete',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_complete, migrations.RunPython.noop),
+    ]
@@ -2,14 +2,79 @@ from django.db import models
 from django.contrib.auth.models import Group
 
 class RancidGroupPermission(models.Model):
-    rancidGroup = models.CharField(max_length=100)
+    rancidGroup = models.CharField(max_length=100,db_index=True)
     djangoGroup = models.ForeignKey(Group)    
 
+    class Meta:
+        unique_together = (("rancidGroup","djangoGroup"),)
+
 class Device(models.Model):
-    ip = models.CharField(max_length=100)
+    ip = models.CharField(max_length=100,unique=True)
     inheritGroupSettings = models.BooleanField(default=True)
 
 class RancidGroupSetting(models.Model):
     rancidGroup = models.CharField(max_length=100)
     settingName = models.CharField(max_length=20)
     settingValue = models.CharField(max_length=100)
+
+    class Meta:
+        unique_together = (("rancidGroup","settingName"),)
+
+class ConfigDiff(models.Model):
+    rancidGroup = models.CharField(max_length=100)
+    device = models.CharField(max_length=100)
+    commit = models.CharField(max_length=40)
+    sequence = models.IntegerField()
+    committed = models.DateTimeField()
+    # Config as of this commit, null when the commit deleted it
+    blob = models.CharField(max_length=40,null=True)
+    text = models.TextField()
+
+    class Meta:
+        unique_together = (("rancidGroup","device","commit"),)
+        index_together = (("rancidGroup","device","sequence"),)
+
+class ConfigDiffHead(models.Model):
+    rancidGroup = models.CharField(max_length=100)
+    device = models.CharField(max_length=100)
+    commit = models.CharField(max_length=40)
+    # Oldest commit read from git so far, null before the first page is read. Older
+    # diffs are read from there when a page needs them, until complete
+    oldest = models.CharField(max_length=40,null=True)
+    complete = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (("rancidGroup","device"),)
+
+class DeviceChange(models.Model):
+    rancidGroup = models.CharField(max_length=100)
+    device = models.CharField(max_length=100)
+    commit = models.CharField(max_length=40)
+    changed = models.DateTimeField()
+    changeCount = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (("rancidGroup","device"),)
+
+class DeviceChangeHead(models.Model):
+    rancidGroup = models.CharField(max_length=100,unique=True)
+    commit = models.CharField(max_length=40)
+
+class Job(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = ((QUEUED,"Queued"),(RUNNING,"Running"),(DONE,"Done"),(FAILED,"Failed"))
+    kind = models.CharField(max_length=30)
+    rancidGroup = models.CharField(max_length=100,blank=True,default="")
+    target = models.CharField(max_length=100,blank=True,default="")
+    status = models.CharField(max_length=10,choices=STATUSES,default=QUEUED,db_index=True)
+    # Set while the job is queued so an identical job cannot be queued twice
+    pendingKey = models.CharField(max_length=200,null=True,unique=True)
+    output = models.TextField(blank=True,default="")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    # Updated by the worker while the job runs; see jobs.recover_orphans
+    heartbeat = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
@@ -0,0 +1,29 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models.signals import post_save,post_delete,m2m_changed
+from django.dispatch import Signal,receiver
+from rancid.models import RancidGroupPermission
+
+PERMISSIONS_VERSION_KEY = "djancid:permitted_groups:version"
+
+# Sent by DjancidGroup when it adds or removes a group in LIST_OF_GROUPS
+list_of_groups_changed = Signal()
+
+def permissions_version():
+    '''Current generation of the cached permitted groups. Bumping it invalidates every
+    cached entry at once'''
+    version = cache.get(PERMISSIONS_VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.add(PERMISSIONS_VERSION_KEY,version,None)
+    return(version)
+
+@receiver(post_save,sender=RancidGroupPermission)
+@receiver(post_delete,sender=RancidGroupPermission)
+@receiver(m2m_changed,sender=get_user_model().groups.through)
+@receiver(list_of_groups_changed)
+def invalidate_permitted_groups(sender,**kwargs):
+    try:
+        cache.incr(PERMISSIONS_VERSION_KEY)
+    except ValueError:
+        cache.set(PERMISSIONS_VERSION_KEY,2,None)
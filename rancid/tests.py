@@ -1,3 +1,1046 @@
-from django.test import TestCase
+import datetime
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import Group,User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase,TransactionTestCase
+from django.test.utils import CaptureQueriesContext,override_settings
+from django.utils import timezone
+from rancid.lib import gitops
+from rancid.lib.benchmark import clear_parsed_files
+from rancid.lib.fileops import FileLock,RouterDB,Cloginrc,FileTransaction,RancidRunBusy,atomic_write,rancid_run_lock_path
+from rancid.lib.gitops import get_config_at,get_config_diffs,get_config_diff_page,open_repo,resolve_config_revision
+from rancid.lib.jobs import enqueue,enqueue_collection,claim_next,recover_orphans,run_pending
+from rancid.lib.main import DjancidGroup,delete_group_files,get_permitted_groups
+from rancid.lib.loadtest import b64
+from rancid.lib.metrics import collecting
+from rancid.lib.search import ConfigIndex,search_configs
+from rancid.lib.synthetic import build_tree,group_name,device_name
+from rancid.models import Device,ConfigDiff,ConfigDiffHead,DeviceChange,DeviceChangeHead,Job,RancidGroupPermission
 
-# Create your tests here.
+# Queries every logged in page makes before the view runs: the session and the user
+REQUEST_QUERIES = 2
+
+
+def forget_history():
+    '''Drop the diff and last-change caches so the next page reads history from git again'''
+    for model in (ConfigDiff,ConfigDiffHead,DeviceChange,DeviceChangeHead):
+        model.objects.all().delete()
+    cache.clear()
+
+
+class SyntheticTreeTestCase(TestCase):
+    '''Runs each test against synthetic RANCID trees built once for the class, logged in
+    as a staff user. trees maps a name to (groups, devices per group, commits); the first
+    one is active unless a test switches with self.tree()'''
+    trees = {"default":(2,20,10)}
+
+    @classmethod
+    def setUpClass(cls):
+        super(SyntheticTreeTestCase,cls).setUpClass()
+        cls.root = tempfile.mkdtemp(prefix="djancid-test-")
+        cls.treeSettings = {}
+        for name,(groups,devices,commits) in cls.trees.items():
+            cls.treeSettings[name] = build_tree("{r}/{n}".format(r=cls.root,n=name),groups,devices,commits,lines=60)
+        cls.defaultTree = override_settings(**cls.treeSettings[sorted(cls.trees)[0]])
+        cls.defaultTree.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.defaultTree.disable()
+        gitops._repoPool.closeAll()
+        shutil.rmtree(cls.root,ignore_errors=True)
+        super(SyntheticTreeTestCase,cls).tearDownClass()
+
+    def setUp(self):
+        self.user = User.objects.create_user("budget",password="budget",is_staff=True)
+        self.client.force_login(self.user)
+        # Devices djancid has seen before, as on a running install
+        Device.objects.bulk_create([Device(ip=ip) for ip in sorted(set(
+            device_name(g,d) for groups,devices,commits in self.trees.values() for g in range(groups) for d in range(devices)
+        ))])
+        forget_history()
+        clear_parsed_files()
+        # Start without open repositories, so starting git cat-file is always counted
+        gitops._repoPool.closeAll()
+
+    def tree(self,name):
+        return(override_settings(**self.treeSettings[name]))
+
+    def measure(self,url,data=None,cold=True,status=200):
+        '''(queries, RequestMetrics) of one GET, or POST when data is given. A cold
+        request parses rancid.conf, router.db and .cloginrc from disk'''
+        if cold:
+            clear_parsed_files()
+        with CaptureQueriesContext(connection) as queries,collecting() as work:
+            if data is None:
+                response = self.client.get(url)
+            else:
+                response = self.client.post(url,data)
+            if response.streaming:
+                b"".join(response.streaming_content)
+        self.assertEqual(response.status_code,status,url)
+        return((len(queries),work))
+
+    def assertBudget(self,url,queries,fileReads,git=0,gitObjects=0,fileWrites=0,data=None,cold=True,status=200):
+        '''Fail if the request does more than the given number of each kind of work.
+        Views never run subprocesses; rancid commands are left to the job worker'''
+        queryCount,work = self.measure(url,data,cold,status)
+        self.assertLessEqual(queryCount,queries,"{u}: SQL queries".format(u=url))
+        self.assertLessEqual(work.counts['file_read'],fileReads,"{u}: file reads".format(u=url))
+        self.assertLessEqual(work.counts['file_write'],fileWrites,"{u}: file writes".format(u=url))
+        self.assertLessEqual(work.counts['git'],git,"{u}: git commands".format(u=url))
+        self.assertLessEqual(work.counts['git_object'],gitObjects,"{u}: git object reads".format(u=url))
+        self.assertEqual(work.counts['subprocess'],0,"{u}: subprocesses".format(u=url))
+        return(work)
+
+
+class ViewBudgetTests(SyntheticTreeTestCase):
+    '''Upper bounds on the work each view does. The first request of a test finds every
+    cache cold: files unparsed, no history indexed and no git process running. Bounds
+    for the warm request that follows are the ones that matter for a busy install'''
+    groups = 2
+    devices = 20
+
+    def setUp(self):
+        super(ViewBudgetTests,self).setUp()
+        self.group = group_name(1)
+        self.device = device_name(1,3)
+        self.deviceUrl = "{g}/{d}/".format(g=self.group,d=b64(self.device))
+
+    def test_all_devices(self):
+        # Files: rancid.conf, .cloginrc and each router.db. Queries: the devices, then per
+        # group its settings and its last-change head and changes; indexing the history
+        # cold adds a few per group. git: one log per group
+        self.assertBudget("/",queries=REQUEST_QUERIES + 7 + 5 * self.groups,
+            fileReads=2 + self.groups,git=self.groups)
+        self.assertBudget("/",queries=REQUEST_QUERIES + 1 + 3 * self.groups,fileReads=0,cold=False)
+
+    def test_group_details(self):
+        url = "/rancid/groupdetails/{g}".format(g=self.group)
+        self.assertBudget(url,queries=REQUEST_QUERIES + 12,fileReads=4,git=1)
+        self.assertBudget(url,queries=REQUEST_QUERIES + 7,fileReads=1,cold=False)
+
+    def test_device_details(self):
+        self.assertBudget("/rancid/devicedetails/" + self.deviceUrl,queries=REQUEST_QUERIES + 3,fileReads=4)
+        self.assertBudget("/rancid/devicedetails/" + self.deviceUrl,queries=REQUEST_QUERIES + 3,fileReads=1,cold=False)
+
+    def test_config(self):
+        self.assertBudget("/rancid/config/" + self.deviceUrl,queries=REQUEST_QUERIES + 2,fileReads=4)
+        self.assertBudget("/rancid/config/" + self.deviceUrl,queries=REQUEST_QUERIES + 2,fileReads=1,cold=False)
+
+    def test_config_raw(self):
+        self.assertBudget("/rancid/rawconfig/" + self.deviceUrl,queries=REQUEST_QUERIES,fileReads=1)
+
+    def test_config_raw_etag(self):
+        url = "/rancid/rawconfig/" + self.deviceUrl
+        plain = self.client.get(url)
+        gzipped = self.client.get(url,HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(gzipped['Content-Encoding'],"gzip")
+        self.assertEqual(gzipped['ETag'],plain['ETag'][:-1] + '-gzip"')
+        # A cached copy is only revalidated for the encoding it was sent in
+        self.assertEqual(self.client.get(url,HTTP_IF_NONE_MATCH=plain['ETag']).status_code,304)
+        self.assertEqual(self.client.get(url,HTTP_IF_NONE_MATCH=gzipped['ETag'],HTTP_ACCEPT_ENCODING="gzip").status_code,304)
+        self.assertEqual(self.client.get(url,HTTP_IF_NONE_MATCH=plain['ETag'],HTTP_ACCEPT_ENCODING="gzip").status_code,200)
+        self.assertEqual(self.client.get(url,HTTP_IF_NONE_MATCH=gzipped['ETag']).status_code,200)
+
+    def test_changes(self):
+        # Every diff comes from one "git log -p"; after that the diff cache answers
+        self.assertBudget("/rancid/changes/" + self.deviceUrl,queries=REQUEST_QUERIES + 15,fileReads=3,git=1)
+        self.assertBudget("/rancid/changes/" + self.deviceUrl,queries=REQUEST_QUERIES + 4,fileReads=0,cold=False)
+
+    def test_config_at(self):
+        # The history log, then the blob through cat-file; the blob cache answers after
+        url = "/rancid/configat/{d}?at=2017-07-14".format(d=self.deviceUrl)
+        self.assertBudget(url,queries=REQUEST_QUERIES + 15,fileReads=3,git=2,gitObjects=1)
+        self.assertBudget(url,queries=REQUEST_QUERIES + 4,fileReads=0,cold=False)
+
+    def test_compare(self):
+        # The history log, cat-file for the blob sizes and one "git diff" of the two blobs
+        url = "/rancid/compare/?a={g}/{d}&ra=2017-07-14".format(g=self.group,d=b64(self.device))
+        self.assertBudget(url,queries=REQUEST_QUERIES + 14,fileReads=1,git=3,gitObjects=0)
+        self.assertBudget(url,queries=REQUEST_QUERIES + 3,fileReads=0,cold=False)
+
+    def test_compare_too_large(self):
+        url = "/rancid/compare/?a={g}/{d}&b={g}/{o}".format(g=self.group,d=b64(self.device),o=b64(device_name(1,4)))
+        with override_settings(COMPARE_MAX_BYTES=100):
+            response = self.client.get(url)
+        self.assertContains(response,"too large to compare")
+        self.assertContains(self.client.get(url),"too large to compare")
+        cache.clear()
+        self.assertNotContains(self.client.get(url),"too large to compare")
+
+    def test_search(self):
+        # Building each group's index lists its tree and reads every blob once. After
+        # that, candidates come from the trigram index, so only the blobs of configs that
+        # match are read again to confirm them
+        configs = self.groups * self.devices
+        self.assertBudget("/rancid/search/?q=hostname",queries=REQUEST_QUERIES,fileReads=1,
+            fileWrites=self.groups,git=2 * self.groups,gitObjects=2 * configs)
+        self.assertBudget("/rancid/search/?q=hostname+10-1-0-3",queries=REQUEST_QUERIES,fileReads=0,gitObjects=1,cold=False)
+        self.assertBudget("/rancid/search/?q=nothing+matches+this",queries=REQUEST_QUERIES,fileReads=0,cold=False)
+        # A query matching every config reads no more of them than it shows
+        with override_settings(SEARCH_MAX_RESULTS=3):
+            self.assertBudget("/rancid/search/?q=hostname",queries=REQUEST_QUERIES,fileReads=0,gitObjects=3,cold=False)
+        # Too short to use the index, so nothing is read
+        self.assertBudget("/rancid/search/?q=ho",queries=REQUEST_QUERIES,fileReads=0,cold=False)
+        self.assertContains(self.client.get("/rancid/search/?q=ho"),"at least 3 characters")
+
+    def test_jobs(self):
+        job = enqueue("collect-group",self.group)
+        self.assertBudget("/rancid/jobs/",queries=REQUEST_QUERIES + 1,fileReads=1)
+        self.assertBudget("/rancid/jobs/{j}/".format(j=job.id),queries=REQUEST_QUERIES + 1,fileReads=1)
+
+    def test_forms(self):
+        self.assertBudget("/rancid/addgroup/",queries=REQUEST_QUERIES + 1,fileReads=1)
+        self.assertBudget("/rancid/adddevice/{g}".format(g=self.group),queries=REQUEST_QUERIES + 5,fileReads=4)
+        self.assertBudget("/rancid/confirmgroup/{g}/".format(g=self.group),queries=REQUEST_QUERIES + 9,fileReads=3,git=1)
+        self.assertBudget("/rancid/confirmdevice/" + self.deviceUrl,queries=REQUEST_QUERIES + 2,fileReads=3)
+
+    def test_collect(self):
+        # Collecting queues a job; rancid-run is left to the worker
+        self.assertBudget("/rancid/collect/{g}/".format(g=self.group),data={},queries=REQUEST_QUERIES + 3,fileReads=1,status=302)
+
+    def test_collect_device(self):
+        url = "/rancid/collect/{g}/{d}/".format(g=self.group,d=b64(self.device))
+        self.assertBudget(url,data={},queries=REQUEST_QUERIES + 4,fileReads=2,status=302)
+        self.assertEqual(Job.objects.get().target,self.device)
+        # Only devices in the group's router.db can be collected
+        self.assertEqual(self.client.post("/rancid/collect/{g}/{d}/".format(g=self.group,d=b64("10.9.9.9")),{}).status_code,404)
+        self.assertEqual(Job.objects.count(),1)
+
+    def test_device_save(self):
+        data = {"group":self.group,"inherits":"on","deviceType":"juniper","status":"on","user":"budget","password":"secret","method":"ssh"}
+        work = self.assertBudget("/rancid/devicedetails/" + self.deviceUrl,data=data,queries=REQUEST_QUERIES + 3,fileReads=4,fileWrites=2)
+        self.assertEqual(work.counts['file_write'],2)
+
+    def test_group_save(self):
+        # Every inheriting device is updated, but router.db and .cloginrc are written once
+        work = self.assertBudget("/rancid/groupdetails/{g}".format(g=self.group),data={"name":self.group,"timeout":"15"},
+            queries=REQUEST_QUERIES + 22,fileReads=6,fileWrites=2,git=1)
+        self.assertEqual(work.counts['file_write'],2)
+
+
+class RancidRunLockTests(SyntheticTreeTestCase):
+    '''Edits wait for rancid-run to release a group, and give up rather than go ahead'''
+    trees = {"default":(2,5,2)}
+
+    def setUp(self):
+        super(RancidRunLockTests,self).setUp()
+        self.group = group_name(1)
+        self.device = device_name(1,3)
+
+    def lock(self,group,age=0):
+        runLock = rancid_run_lock_path(group)
+        os.makedirs(os.path.dirname(runLock),exist_ok=True)
+        open(runLock,"w").close()
+        self.addCleanup(os.remove,runLock)
+        if age:
+            os.utime(runLock,(time.time() - age,time.time() - age))
+
+    def save_device(self):
+        data = {"group":self.group,"inherits":"on","deviceType":"juniper","status":"on","user":"locked","password":"secret","method":"ssh"}
+        return(self.client.post("/rancid/devicedetails/{g}/{d}/".format(g=self.group,d=b64(self.device)),data))
+
+    @override_settings(RANCID_RUN_LOCK_WAIT=0.1)
+    def test_edit_refused_while_collecting(self):
+        self.lock(self.group)
+        response = self.save_device()
+        self.assertEqual(response.status_code,503)
+        self.assertIn(b"try again",response.content)
+        clear_parsed_files()
+        self.assertNotEqual(RouterDB(self.group).getRouterDetails(self.device)['deviceType'],"juniper")
+        self.assertEqual(self.client.post("/rancid/groupdetails/{g}".format(g=self.group),{"name":self.group,"timeout":"15"}).status_code,503)
+
+    @override_settings(FILE_LOCK_TIMEOUT=0.1)
+    def test_edit_refused_while_file_locked(self):
+        # Another editor holds router.db for longer than the lock timeout
+        locked = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        def editor():
+            with FileLock(RouterDB(self.group).filePath):
+                locked.set()
+                release.wait(10)
+        thread = threading.Thread(target=editor)
+        thread.start()
+        locked.wait(10)
+        response = self.save_device()
+        release.set()
+        thread.join()
+        self.assertEqual(response.status_code,503)
+        self.assertEqual(response['Retry-After'],"30")
+        self.assertEqual(self.save_device().status_code,200)
+
+    @override_settings(RANCID_RUN_LOCK_WAIT=0.1)
+    def test_stale_lock_is_ignored(self):
+        self.lock(self.group,age=5 * 3600)
+        self.assertEqual(self.save_device().status_code,200)
+        clear_parsed_files()
+        self.assertEqual(RouterDB(self.group).getRouterDetails(self.device)['deviceType'],"juniper")
+
+    @override_settings(RANCID_RUN_JOB_WAIT=0.1)
+    def test_group_files_kept_while_collecting(self):
+        groupDir = os.path.join(settings.RANCID_ROOT,"REMOVED")
+        os.makedirs(groupDir)
+        self.addCleanup(shutil.rmtree,groupDir,ignore_errors=True)
+        self.lock("REMOVED")
+        enqueue("delete-group","REMOVED")
+        job = claim_next()
+        self.assertIn("queued again",delete_group_files(job))
+        self.assertTrue(os.path.exists(groupDir))
+        self.assertEqual(Job.objects.filter(kind="delete-group",status=Job.QUEUED).count(),1)
+
+
+class DiffCacheTests(SyntheticTreeTestCase):
+    '''The diff cache is filled from git a page at a time, newest first'''
+    trees = {"long":(1,1,120)}
+    pageSize = 10
+
+    def setUp(self):
+        super(DiffCacheTests,self).setUp()
+        self.group = group_name(0)
+        self.device = device_name(0,0)
+        self.read = []
+        iterConfigHistory = gitops.iter_config_history
+        def counted(*args,**kwargs):
+            for commit in iterConfigHistory(*args,**kwargs):
+                self.read.append(commit[0])
+                yield(commit)
+        patcher = mock.patch.object(gitops,"iter_config_history",counted)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_page_reads_one_page(self):
+        page = get_config_diff_page(self.group,self.device,self.pageSize)
+        self.assertEqual(len(page['diffs']),self.pageSize)
+        self.assertIsNotNone(page['older'])
+        self.assertLessEqual(len(self.read),self.pageSize + 1)
+        self.assertEqual(ConfigDiff.objects.count(),len(self.read))
+
+    def test_pages_cover_history_once(self):
+        commits = []
+        before = None
+        while True:
+            readBefore = len(self.read)
+            page = get_config_diff_page(self.group,self.device,self.pageSize,before)
+            self.assertLessEqual(len(self.read) - readBefore,self.pageSize + 1)
+            commits.extend(diff['commit'] for diff in page['diffs'])
+            before = page['older']
+            if before is None:
+                break
+        # Every commit was read from git once, however the pages fell
+        self.assertEqual(sorted(self.read),sorted(set(self.read)))
+        self.assertEqual(commits,[diff['commit'] for diff in get_config_diffs(self.group,self.device)])
+        self.assertEqual(len(get_config_diff_page(self.group,self.device,self.pageSize)['diffs']),self.pageSize)
+
+    def test_new_commits_read_alone(self):
+        page = get_config_diff_page(self.group,self.device,self.pageSize)
+        groupDir = os.path.join(settings.RANCID_ROOT,self.group)
+        with open(os.path.join(groupDir,"configs",self.device),"a") as f:
+            f.write("! collected again\n")
+        subprocess.check_call(["git","-C",groupDir,"-c","user.name=rancid","-c","user.email=rancid@localhost",
+            "commit","-q","-a","-m","updates"])
+        del self.read[:]
+        newPage = get_config_diff_page(self.group,self.device,self.pageSize)
+        self.assertEqual(len(self.read),1)
+        self.assertIn("collected again",newPage['diffs'][0]['text'])
+        self.assertEqual([diff['commit'] for diff in newPage['diffs'][1:]],[diff['commit'] for diff in page['diffs'][:-1]])
+
+    def test_config_at_reads_back_to_the_time(self):
+        first = list(open_repo(self.group).iter_commits("HEAD"))[-1]
+        get_config_diff_page(self.group,self.device,self.pageSize)
+        config,info = get_config_at(self.group,self.device,when=first.committed_datetime)
+        self.assertEqual(info['commit'],first.hexsha)
+        self.assertIn("! revision 0\n",config)
+        self.assertEqual(len(self.read),len(set(self.read)))
+
+
+class SearchIndexTests(SyntheticTreeTestCase):
+    trees = {"small":(1,3,2)}
+
+    def setUp(self):
+        super(SearchIndexTests,self).setUp()
+        self.group = group_name(0)
+        self.device = device_name(0,1)
+
+    def write(self,filePath,text):
+        with open(filePath,"w") as f:
+            f.write(text)
+
+    def test_committed_configs_only(self):
+        # rancid-run has written a new config but not committed it yet
+        configFile = os.path.join(settings.RANCID_ROOT,self.group,"configs",self.device)
+        with open(configFile) as f:
+            committed = f.read()
+        self.addCleanup(self.write,configFile,committed)
+        self.write(configFile,"hostname not-committed-yet\n")
+        self.assertEqual(search_configs("not-committed-yet",[self.group]),[])
+        hostname = "hostname {h}".format(h=self.device.replace(".","-"))
+        self.assertEqual(search_configs(hostname,[self.group]),[(self.group,self.device,[(3,hostname)])])
+
+    def test_rebuild_keeps_lock(self):
+        # The indexed commit is gone, so update() starts again from the tree
+        repo = open_repo(self.group)
+        index = ConfigIndex(self.group)
+        index.update(repo,gitops.head_commit(repo))
+        index.head = "0" * 40
+        lock = index.lock
+        index.update(repo,gitops.head_commit(repo))
+        self.assertIs(index.lock,lock)
+        self.assertFalse(lock.locked())
+        self.assertEqual(sorted(index.search("hostname")),[device_name(0,d) for d in range(3)])
+
+
+class ConfigAtTests(SyntheticTreeTestCase):
+    '''Configs as of a time or a commit agree with what git has in that commit'''
+    trees = {"history":(1,5,8)}
+
+    def setUp(self):
+        super(ConfigAtTests,self).setUp()
+        self.group = group_name(0)
+        self.device = device_name(0,2)
+        self.history = list(reversed(list(open_repo(self.group).iter_commits("HEAD"))))
+
+    def config_in(self,commit):
+        try:
+            return((commit.tree / "configs" / self.device).data_stream.read().decode("utf-8"))
+        except KeyError:
+            return(None)
+
+    def test_by_time(self):
+        for commit in self.history:
+            # Between this commit and the next, the config is the one in this commit
+            when = commit.committed_datetime + datetime.timedelta(minutes=30)
+            config,info = get_config_at(self.group,self.device,when=when)
+            self.assertEqual(config,self.config_in(commit))
+            self.assertLessEqual(info['committed'],when)
+        before = self.history[0].committed_datetime - datetime.timedelta(seconds=1)
+        self.assertEqual(get_config_at(self.group,self.device,when=before),(None,None))
+
+    def test_by_commit(self):
+        # Most commits leave this device alone, so both the diff cache and tree lookups run
+        for commit in self.history:
+            for revision in [commit.hexsha,commit.hexsha[:10]]:
+                config,info = get_config_at(self.group,self.device,revision)
+                self.assertEqual(config,self.config_in(commit))
+        self.assertEqual(resolve_config_revision(self.group,self.device)['commit'],self.history[-1].hexsha)
+        config,info = get_config_at(self.group,"10.0.99.99",self.history[-1].hexsha)
+        self.assertIsNone(config)
+        self.assertIsNone(info['blob'])
+
+    def test_unknown_revision(self):
+        for revision in ["0" * 40,"no-such-branch"]:
+            with self.assertRaises(ValueError):
+                resolve_config_revision(self.group,self.device,revision)
+
+    def test_view(self):
+        url = "/rancid/configat/{g}/{d}/".format(g=self.group,d=b64(self.device))
+        first = self.history[0]
+        response = self.client.get(url,{"commit":first.hexsha})
+        self.assertContains(response,"! revision 0\n")
+        self.assertContains(response,first.hexsha[:10])
+        at = (first.committed_datetime + datetime.timedelta(minutes=30)).isoformat()
+        self.assertContains(self.client.get(url,{"at":at}),"! revision 0\n")
+        before = (first.committed_datetime - datetime.timedelta(days=1)).date().isoformat()
+        self.assertContains(self.client.get(url,{"at":before}),"No configuration existed")
+        self.assertEqual(self.client.get(url,{"commit":"0" * 40}).status_code,404)
+        self.assertEqual(self.client.get(url,{"at":"yesterday"}).status_code,404)
+        self.assertRedirects(self.client.get(url),"/rancid/config/{g}/{d}/".format(g=self.group,d=b64(self.device)),fetch_redirect_response=False)
+
+
+class RepoPoolTests(SyntheticTreeTestCase):
+    '''Any thread's call sweeps the handles other threads left idle or behind'''
+    trees = {"small":(1,2,2)}
+
+    def setUp(self):
+        super(RepoPoolTests,self).setUp()
+        self.pool = gitops.RepoPool()
+        self.group = group_name(0)
+        self.repoDir = os.path.join(settings.RANCID_ROOT,self.group)
+        self.addCleanup(self.pool.closeAll)
+
+    def open_in_thread(self,release=None):
+        '''(thread, repo) for a handle opened by another thread with its cat-file
+        running. The thread exits at once, or waits for release to be set'''
+        opened = {}
+        ready = threading.Event()
+        def worker():
+            repo = self.pool.get(self.group)
+            repo.odb.info(bytes.fromhex(repo.head.commit.hexsha))
+            opened['repo'] = repo
+            ready.set()
+            if release is not None:
+                release.wait(10)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        ready.wait(10)
+        self.assertIsNotNone(opened['repo'].git.cat_file_header)
+        return((thread,opened['repo']))
+
+    def sweep(self):
+        self.pool.nextSweep = 0
+        self.pool.get(self.group)
+
+    def test_idle_handle_of_live_thread(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        thread,repo = self.open_in_thread(release)
+        self.sweep()
+        self.assertIn(self.repoDir,self.pool.threadHandles[thread])
+        self.pool.threadHandles[thread][self.repoDir][2] -= settings.REPO_POOL_IDLE_TIMEOUT + 1
+        self.sweep()
+        self.assertEqual(self.pool.threadHandles[thread],{})
+        self.assertIsNone(repo.git.cat_file_header)
+        release.set()
+        thread.join()
+
+    def test_handles_of_exited_thread(self):
+        thread,repo = self.open_in_thread()
+        thread.join()
+        self.sweep()
+        self.assertNotIn(thread,self.pool.threadHandles)
+        self.assertIsNone(repo.git.cat_file_header)
+        self.assertIn(self.repoDir,self.pool.threadHandles[threading.current_thread()])
+
+
+class ScalingTests(SyntheticTreeTestCase):
+    '''The work a page does must not grow with the number of devices or commits'''
+    trees = {"a-small":(2,10,5),"b-large":(2,60,30)}
+
+    def counts(self,url,cold):
+        if cold:
+            forget_history()
+        queryCount,work = self.measure(url,cold=cold)
+        return((queryCount,work.counts['file_read'],work.counts['git'],work.counts['git_object']))
+
+    def compare(self,url,cold=True):
+        '''Work done for url in the small tree and then the large one'''
+        results = []
+        for name in sorted(self.trees):
+            with self.tree(name):
+                self.counts(url,cold=True)
+                results.append(self.counts(url,cold))
+        return(results)
+
+    def test_device_lists(self):
+        # No per-device query or file read, as DjancidDevice.pullDetails used to do
+        for url in ["/","/rancid/groupdetails/{g}".format(g=group_name(1))]:
+            for cold in (True,False):
+                small,large = self.compare(url,cold)
+                self.assertEqual(small,large,"{u} cold={c}: (queries, file reads, git, git objects)".format(u=url,c=cold))
+
+    def test_changes(self):
+        # One streamed "git log -p" whatever the number of commits, rather than a
+        # "git diff" per commit
+        url = "/rancid/changes/{g}/{d}/".format(g=group_name(1),d=b64(device_name(1,3)))
+        small,large = self.compare(url)
+        self.assertEqual(small[1:],large[1:],"{u}: (file reads, git, git objects)".format(u=url))
+        self.assertLessEqual(large[2],1)
+
+    def test_config_diffs(self):
+        for name in sorted(self.trees):
+            with self.tree(name),collecting() as work:
+                diffs = list(get_config_diffs(group_name(0),device_name(0,0)))
+            self.assertTrue(diffs)
+            self.assertEqual(work.counts['git'],1,name)
+
+
+class RancidFilesTestCase(TestCase):
+    '''Runs each test against a fresh rancid.conf, GROUP/router.db and .cloginrc, written
+    from the class attributes of the same names'''
+    rancidConf = "TMPDIR=$BASEDIR/tmp; export TMPDIR\nLIST_OF_GROUPS=\"GROUP\"\n"
+    routerDB = ""
+    cloginrc = ""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="djancid-test-")
+        self.addCleanup(shutil.rmtree,self.root,ignore_errors=True)
+        os.makedirs(os.path.join(self.root,"etc"))
+        os.makedirs(os.path.join(self.root,"var","GROUP"))
+        self.write("etc/rancid.conf",self.rancidConf)
+        self.write("var/GROUP/router.db",self.routerDB)
+        self.write("var/.cloginrc",self.cloginrc)
+        rancidRoot = override_settings(RANCID_ROOT=os.path.join(self.root,"var") + "/",RANCID_SETTINGS_DIR=os.path.join(self.root,"etc") + "/")
+        rancidRoot.enable()
+        self.addCleanup(rancidRoot.disable)
+        clear_parsed_files()
+        self.addCleanup(clear_parsed_files)
+
+    def write(self,path,text):
+        with open(os.path.join(self.root,path),"w") as f:
+            f.write(text)
+
+    def read(self,path):
+        with open(os.path.join(self.root,path)) as f:
+            return(f.read())
+
+
+class RouterDBTests(RancidFilesTestCase):
+    routerDB = (
+        "# core routers\n"
+        "10.0.0.10;juniper;up\n"
+        "10.0.0.1;cisco;up;edge router\n"
+        "\n"
+        "10.0.0.100;cisco;down\n"
+    )
+
+    def test_exact_name_match(self):
+        routerDB = RouterDB("GROUP")
+        self.assertEqual(routerDB.getRouterDetails("10.0.0.1"),{"ip":"10.0.0.1","deviceType":"cisco","status":True})
+        self.assertEqual(routerDB.getRouterDetails("10.0.0.100")['status'],False)
+        for name in ["10.0.0","10.0.0.1 ","","10.0.0.1;cisco"]:
+            with self.assertRaises(RouterDB.RouterNotFoundException):
+                routerDB.getRouterDetails(name)
+
+    def test_edit_changes_only_that_router(self):
+        RouterDB("GROUP").editRouter("10.0.0.1","arista",False)
+        self.assertEqual(self.read("var/GROUP/router.db"),
+            "# core routers\n10.0.0.10;juniper;up\n10.0.0.1;arista;down;edge router\n\n10.0.0.100;cisco;down\n")
+
+    def test_delete_changes_only_that_router(self):
+        RouterDB("GROUP").deleteRouter("10.0.0.1")
+        self.assertEqual(self.read("var/GROUP/router.db"),"# core routers\n10.0.0.10;juniper;up\n\n10.0.0.100;cisco;down\n")
+        RouterDB("GROUP").deleteRouter("10.0.0.1")
+        self.assertEqual([router['ip'] for router in RouterDB("GROUP").getAllRouters()],["10.0.0.10","10.0.0.100"])
+
+    def test_add(self):
+        self.write("var/GROUP/router.db","10.0.0.10;juniper;up")
+        clear_parsed_files()
+        RouterDB("GROUP").addRouter("10.0.0.1","cisco",True)
+        self.assertEqual(self.read("var/GROUP/router.db"),"10.0.0.10;juniper;up\n10.0.0.1;cisco;up\n")
+        with self.assertRaises(RouterDB.RouterAlreadyExistsException):
+            RouterDB("GROUP").addRouter("10.0.0.1")
+
+    def test_edits_written_once(self):
+        with collecting() as work:
+            RouterDB("GROUP").editRouters({"10.0.0.1":("arista",None),"10.0.0.10":(None,False),"10.9.9.9":("cisco",True)})
+        self.assertEqual(work.counts['file_write'],1)
+        self.assertEqual(self.read("var/GROUP/router.db"),
+            "# core routers\n10.0.0.10;juniper;down\n10.0.0.1;arista;up;edge router\n\n10.0.0.100;cisco;down\n")
+        with collecting() as work:
+            RouterDB("GROUP").editRouter("10.0.0.1","arista",True)
+        self.assertEqual(work.counts['file_write'],0)
+
+    def test_transaction_writes_once(self):
+        with collecting() as work,FileTransaction():
+            routerDB = RouterDB("GROUP")
+            routerDB.addRouter("10.0.0.2","cisco",True)
+            routerDB.editRouter("10.0.0.2","juniper")
+            routerDB.deleteRouter("10.0.0.100")
+            self.assertEqual(routerDB.getRouterDetails("10.0.0.2")['deviceType'],"juniper")
+        self.assertEqual(work.counts['file_write'],1)
+        self.assertEqual(self.read("var/GROUP/router.db"),
+            "# core routers\n10.0.0.10;juniper;up\n10.0.0.1;cisco;up;edge router\n\n10.0.0.2;juniper;up\n")
+
+    def test_reads_see_changes_on_disk(self):
+        RouterDB("GROUP").getAllRouters()
+        time.sleep(0.01)
+        self.write("var/GROUP/router.db","10.0.0.5;cisco;up\n")
+        self.assertEqual([router['ip'] for router in RouterDB("GROUP").getAllRouters()],["10.0.0.5"])
+
+
+class CloginrcTests(RancidFilesTestCase):
+    cloginrc = (
+        "# devices\n"
+        "add user 10.0.0.1 {alice}\n"
+        "add password 10.0.0.1 {vty1} {enable1}\n"
+        "add identity Router-A {/home/rancid/.ssh/id {with} braces}\n"
+        "add method 10.0.0.* {ssh} {telnet}\n"
+        "add user 10.0.0.? {bob}\n"
+        "add user 10.0.[12].* {carol}\n"
+        "add autoenable 10.0.1.* 1\n"
+        "add user * {nobody}\n"
+        "add password * {secret}\n"
+        "add method * {telnet}\n"
+    )
+
+    def test_exact_host(self):
+        details = Cloginrc().resolve("10.0.0.1")
+        self.assertEqual(details['user'],"alice")
+        self.assertEqual(details['password'],["vty1","enable1"])
+
+    def test_first_match_wins(self):
+        # 10.0.0.? comes before 10.0.[12].* and *
+        self.assertEqual(Cloginrc().resolve("10.0.0.5")['user'],"bob")
+        self.assertEqual(Cloginrc().resolve("10.0.1.5")['user'],"carol")
+        self.assertEqual(Cloginrc().resolve("10.0.5.5")['user'],"nobody")
+        self.assertEqual(Cloginrc().resolve("10.0.0.5")['method'],["ssh","telnet"])
+
+    def test_glob_characters(self):
+        crcFile = Cloginrc()
+        # ? is one character, [12] one of a set, * any run of characters
+        self.assertEqual(crcFile.resolve("10.0.0.55")['user'],"nobody")
+        self.assertEqual(crcFile.resolve("10.0.2.55")['user'],"carol")
+        self.assertEqual(crcFile.resolve("10.0.3.5")['user'],"nobody")
+        self.assertEqual(crcFile.resolve("10.0.0.")['method'],["ssh","telnet"])
+        self.assertEqual(crcFile.resolve("10.0.1.9")['autoenable'],True)
+
+    def test_braces_and_case(self):
+        self.assertEqual(Cloginrc().resolve("router-a")['identity'],"/home/rancid/.ssh/id {with} braces")
+
+    def test_value_types(self):
+        # method and password are lists even with one value; other commands never are
+        allDetails = Cloginrc().getAllRouterDetails(["10.0.0.1","10.0.5.5"])
+        for details in allDetails.values():
+            self.assertIsInstance(details['method'],list)
+            self.assertIsInstance(details['password'],list)
+            self.assertIsInstance(details['user'],str)
+        self.assertEqual(allDetails['10.0.5.5']['method'],["telnet"])
+        self.assertEqual(allDetails['10.0.5.5'],Cloginrc().getRouterDetails("10.0.5.5"))
+
+    def test_no_details(self):
+        self.write("var/.cloginrc","add user 10.0.0.1 {alice}\n")
+        clear_parsed_files()
+        with self.assertRaises(Cloginrc.NoRouterDetails):
+            Cloginrc().getRouterDetails("10.0.0.2")
+        self.assertEqual(Cloginrc().getAllRouterDetails(["10.0.0.2"]),{"10.0.0.2":{}})
+
+    def test_add_details(self):
+        # Existing hosts are edited where they are; new ones go first, ahead of the globs
+        Cloginrc().addAllRouterDetails({"10.0.0.1":{"user":"dave"},"10.0.0.9":{"user":"erin","password":["a","b"]}})
+        lines = self.read("var/.cloginrc").splitlines()
+        self.assertEqual(lines[:3],["add user 10.0.0.9 {erin}","add password 10.0.0.9 {a} {b}","# devices"])
+        self.assertEqual(lines[3:5],["add user 10.0.0.1 {dave}","add password 10.0.0.1 {vty1} {enable1}"])
+        self.assertEqual(len(lines),13)
+        self.assertEqual(Cloginrc().resolve("10.0.0.9")['user'],"erin")
+
+
+class GroupDeleteTests(RancidFilesTestCase):
+    routerDB = "10.0.0.1;cisco;up\n10.0.0.2;juniper;up\n"
+    cloginrc = (
+        "add user 10.0.0.1 {alice}\n"
+        "add password 10.0.0.1 {vty1} {enable1}\n"
+        "add user 10.0.9.9 {dave}\n"
+        "add password 10.0.0.2 {vty2}\n"
+        "add user 10.0.0.* {bob}\n"
+    )
+
+    def test_devices_forgotten(self):
+        Device.objects.bulk_create([Device(ip="10.0.0.1"),Device(ip="10.0.0.2"),Device(ip="10.0.9.9")])
+        with collecting() as work:
+            DjancidGroup("GROUP").deleteDevices()
+        self.assertEqual(work.counts['file_write'],1)
+        # Hosts of other groups and wildcard entries stay
+        self.assertEqual(self.read("var/.cloginrc"),"add user 10.0.9.9 {dave}\nadd user 10.0.0.* {bob}\n")
+        self.assertEqual(list(Device.objects.values_list("ip",flat=True)),["10.0.9.9"])
+
+
+class GroupRefreshTests(RancidFilesTestCase):
+    routerDB = "10.0.0.1;cisco;up\n10.0.0.2;juniper;up\n"
+
+    def test_settings_pushed_without_git(self):
+        Device.objects.create(ip="10.0.0.2",inheritGroupSettings=False)
+        groupObj = DjancidGroup("GROUP")
+        groupObj.dbDetails['deviceType'] = "arista"
+        groupObj.rcDetails['user'] = "rancid"
+        # The files stay locked throughout, so last changes are not looked up
+        with mock.patch("rancid.lib.main.get_last_changes") as getLastChanges:
+            groupObj.refreshDevices()
+        getLastChanges.assert_not_called()
+        self.assertEqual(self.read("var/GROUP/router.db"),"10.0.0.1;arista;up\n10.0.0.2;juniper;up\n")
+        self.assertEqual(Cloginrc().resolve("10.0.0.1")['user'],"rancid")
+        self.assertNotIn("10.0.0.2",self.read("var/.cloginrc"))
+
+    def test_wildcard_values_written_per_host(self):
+        self.write("var/.cloginrc","add user 10.0.0.* {rancid}\n")
+        clear_parsed_files()
+        groupObj = DjancidGroup("GROUP")
+        groupObj.rcDetails['user'] = "rancid"
+        groupObj.refreshDevices()
+        # Each device gets its own line, so editing the wildcard later leaves it alone
+        self.assertEqual(Cloginrc().hostDetails("10.0.0.1"),{"user":"rancid"})
+        self.assertEqual(Cloginrc().hostDetails("10.0.0.2"),{"user":"rancid"})
+        with collecting() as work:
+            groupObj.refreshDevices()
+        self.assertEqual(work.counts['file_write'],0)
+
+    def refresh_queries(self,devices):
+        '''Queries run by a refresh that changes every device of a group of that size'''
+        self.write("var/GROUP/router.db","".join("10.0.{a}.{b};cisco;up\n".format(a=d // 250,b=d % 250) for d in range(devices)))
+        clear_parsed_files()
+        Device.objects.all().delete()
+        groupObj = DjancidGroup("GROUP")
+        groupObj.dbDetails['deviceType'] = "arista"
+        groupObj.rcDetails['user'] = "rancid"
+        with CaptureQueriesContext(connection) as queries:
+            groupObj.refreshDevices()
+        self.assertEqual(Device.objects.count(),devices)
+        return(len(queries))
+
+    def test_queries_independent_of_group_size(self):
+        # Device rows are read in one query and missing ones created in one insert, then
+        # read back. Inherited settings live in the files, so no row needs updating
+        self.assertEqual(self.refresh_queries(2),self.refresh_queries(300))
+        self.assertLessEqual(self.refresh_queries(300),5)
+
+    @override_settings(RANCID_RUN_LOCK_WAIT=0)
+    def test_waits_for_rancid_run_before_locking(self):
+        os.makedirs(os.path.join(self.root,"var","tmp"))
+        self.write("var/tmp/.GROUP.run.lock","")
+        with mock.patch.object(FileLock,"acquire") as acquire:
+            with self.assertRaises(RancidRunBusy):
+                DjancidGroup("GROUP").refreshDevices()
+        acquire.assert_not_called()
+
+
+class AtomicWriteTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="djancid-test-")
+        self.addCleanup(shutil.rmtree,self.dir,ignore_errors=True)
+        self.path = os.path.join(self.dir,".cloginrc")
+        with open(self.path,"w") as f:
+            f.write("old\n")
+        os.chmod(self.path,0o640)
+
+    def test_replaces_file(self):
+        inode = os.stat(self.path).st_ino
+        atomic_write(self.path,["new\n"])
+        with open(self.path) as f:
+            self.assertEqual(f.read(),"new\n")
+        self.assertNotEqual(os.stat(self.path).st_ino,inode)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777,0o640)
+        self.assertEqual(os.listdir(self.dir),[".cloginrc"])
+
+    def ownedByOther(self):
+        if os.geteuid() != 0:
+            self.skipTest("changing a file's owner needs root")
+        os.chown(self.path,4321,4321)
+
+    def test_keeps_owner(self):
+        self.ownedByOther()
+        atomic_write(self.path,["new\n"])
+        self.assertEqual((os.stat(self.path).st_uid,os.stat(self.path).st_gid),(4321,4321))
+
+    def test_rewrites_in_place_when_owner_cannot_be_kept(self):
+        self.ownedByOther()
+        inode = os.stat(self.path).st_ino
+        with mock.patch("os.chown",side_effect=PermissionError):
+            atomic_write(self.path,["new\n"])
+        with open(self.path) as f:
+            self.assertEqual(f.read(),"new\n")
+        self.assertEqual(os.stat(self.path).st_ino,inode)
+        self.assertEqual(os.stat(self.path).st_uid,4321)
+        self.assertEqual(os.listdir(self.dir),[".cloginrc"])
+
+
+class DeleteGroupFilesTests(RancidFilesTestCase):
+    rancidConf = (
+        "TMPDIR=$BASEDIR/tmp; export TMPDIR\n"
+        "CVSROOT=$BASEDIR/CVS; export CVSROOT\n"
+        "LOGDIR=$BASEDIR/logs; export LOGDIR\n"
+        "LIST_OF_GROUPS=\"GROUP\"\n"
+    )
+
+    def setUp(self):
+        super().setUp()
+        for path in ["var/OLD","var/CVS/OLD","var/CVS/GROUP","var/logs","var/tmp"]:
+            os.makedirs(os.path.join(self.root,path))
+        for path in ["var/OLD/router.db","var/CVS/OLD/router.db","var/CVS/GROUP/router.db",
+            "var/logs/OLD.20261018.101500","var/logs/GROUP.20261018.101500"]:
+            self.write(path,"")
+
+    def exists(self,path):
+        return(os.path.exists(os.path.join(self.root,path)))
+
+    def test_files_and_logs_removed(self):
+        output = delete_group_files(enqueue("delete-group","OLD"))
+        self.assertTrue(output.startswith("Deleted:"))
+        for path in ["var/OLD","var/CVS/OLD","var/logs/OLD.20261018.101500"]:
+            self.assertFalse(self.exists(path),path)
+        for path in ["var/GROUP/router.db","var/CVS/GROUP/router.db","var/logs/GROUP.20261018.101500"]:
+            self.assertTrue(self.exists(path),path)
+
+    def test_group_added_back(self):
+        self.write("etc/rancid.conf",self.rancidConf.replace('"GROUP"','"GROUP OLD"'))
+        clear_parsed_files()
+        output = delete_group_files(enqueue("delete-group","OLD"))
+        self.assertIn("in LIST_OF_GROUPS again",output)
+        self.assertTrue(self.exists("var/CVS/OLD/router.db"))
+        self.assertTrue(self.exists("var/logs/OLD.20261018.101500"))
+
+    @override_settings(RANCID_RUN_JOB_WAIT=0)
+    def test_requeued_while_collecting(self):
+        self.write("var/tmp/.OLD.run.lock","")
+        job = enqueue("delete-group","OLD")
+        claim_next()
+        output = delete_group_files(job)
+        retry = Job.objects.get(status=Job.QUEUED)
+        self.assertEqual((retry.kind,retry.rancidGroup),("delete-group","OLD"))
+        self.assertIn("queued again as job {j}".format(j=retry.id),output)
+        self.assertTrue(self.exists("var/CVS/OLD/router.db"))
+
+
+class JobTests(TestCase):
+    def test_orphaned_job_is_failed(self):
+        # A worker died while collecting GROUP000; its job stopped heartbeating
+        enqueue("collect-group","GROUP000")
+        orphan = claim_next()
+        Job.objects.filter(id=orphan.id).update(heartbeat=timezone.now() - datetime.timedelta(seconds=301))
+        enqueue("collect-group","GROUP000")
+        self.assertIsNone(claim_next())
+        self.assertEqual(recover_orphans(),1)
+        orphan.refresh_from_db()
+        self.assertEqual(orphan.status,Job.FAILED)
+        self.assertIn("stopped before it finished",orphan.output)
+        self.assertIsNotNone(orphan.finished)
+        self.assertEqual(claim_next().rancidGroup,"GROUP000")
+
+    def test_live_job_is_kept(self):
+        enqueue("collect-group","GROUP000")
+        job = claim_next()
+        self.assertEqual(recover_orphans(),0)
+        job.refresh_from_db()
+        self.assertEqual(job.status,Job.RUNNING)
+
+
+STUB_RANCID_RUN = """#!/bin/sh
+echo "start $(date +%s.%N) $*" >> {log}
+sleep 0.3
+echo "end $(date +%s.%N) $*" >> {log}
+case "$*" in *BROKEN*) echo "cannot collect $*"; exit 1;; esac
+echo "collected $*"
+"""
+
+
+class CollectionTests(TransactionTestCase):
+    '''Collection jobs run by run_pending against a stub rancid-run that records when it
+    ran and with which arguments'''
+    def setUp(self):
+        self.binDir = tempfile.mkdtemp(prefix="djancid-test-")
+        self.addCleanup(shutil.rmtree,self.binDir,ignore_errors=True)
+        self.log = os.path.join(self.binDir,"calls.log")
+        script = os.path.join(self.binDir,"rancid-run")
+        with open(script,"w") as f:
+            f.write(STUB_RANCID_RUN.format(log=self.log))
+        os.chmod(script,0o755)
+        binDir = override_settings(RANCID_BIN_DIR=self.binDir)
+        binDir.enable()
+        self.addCleanup(binDir.disable)
+
+    def calls(self):
+        '''[(arguments, start, end)] of each stub run, in the order they started'''
+        runs = {}
+        with open(self.log) as f:
+            for line in f:
+                event,when,args = line.rstrip("\n").split(" ",2)
+                runs.setdefault(args,{})[event] = float(when)
+        return(sorted([(args,run['start'],run['end']) for args,run in runs.items()],key=lambda run: run[1]))
+
+    def most_at_once(self):
+        events = sorted([(start,1) for args,start,end in self.calls()] + [(end,-1) for args,start,end in self.calls()])
+        running = most = 0
+        for when,change in events:
+            running += change
+            most = max(most,running)
+        return(most)
+
+    def test_identical_jobs_are_queued_once(self):
+        first = enqueue_collection("GROUP000")
+        self.assertEqual(enqueue_collection("GROUP000").id,first.id)
+        self.assertEqual(claim_next().id,first.id)
+        # A running job does not absorb new requests
+        self.assertNotEqual(enqueue_collection("GROUP000").id,first.id)
+
+    def test_device_collection_joins_queued_group_collection(self):
+        groupJob = enqueue_collection("GROUP000")
+        self.assertEqual(enqueue_collection("GROUP000","10.0.0.1").id,groupJob.id)
+        self.assertEqual(run_pending(),1)
+        self.assertEqual([args for args,start,end in self.calls()],["GROUP000"])
+
+    def test_device_collection(self):
+        job = enqueue_collection("GROUP000","10.0.0.1")
+        with override_settings(JOB_HEARTBEAT_INTERVAL=0.05):
+            self.assertEqual(run_pending(),1)
+        job.refresh_from_db()
+        self.assertEqual(job.status,Job.DONE)
+        self.assertGreater(job.heartbeat,job.started)
+        self.assertEqual(job.output,"collected -r 10.0.0.1 GROUP000\n")
+        self.assertIsNotNone(job.finished)
+        self.assertEqual([args for args,start,end in self.calls()],["-r 10.0.0.1 GROUP000"])
+
+    def test_failed_collection(self):
+        job = enqueue_collection("BROKEN")
+        with self.assertLogs("rancid.lib.jobs","ERROR"):
+            run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status,Job.FAILED)
+        self.assertIn("cannot collect BROKEN",job.output)
+
+    def test_one_collection_per_group_at_once(self):
+        for device in ["10.0.0.1","10.0.0.2","10.0.0.3"]:
+            enqueue_collection("GROUP000",device)
+        self.assertEqual(run_pending(parallel=4),3)
+        self.assertEqual(self.most_at_once(),1)
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(),3)
+
+    def test_groups_are_collected_in_parallel(self):
+        for g in range(6):
+            enqueue_collection(group_name(g))
+        with override_settings(JOB_PAR_COUNT=3):
+            self.assertEqual(run_pending(),6)
+        self.assertEqual(self.most_at_once(),3)
+        self.assertEqual(sorted(args for args,start,end in self.calls()),[group_name(g) for g in range(6)])
+
+
+class PermissionCacheTests(TestCase):
+    '''A non-staff user's permitted groups are cached until a permission or group
+    membership changes'''
+    def setUp(self):
+        cache.clear()
+        self.operators = Group.objects.create(name="operators")
+        self.user = User.objects.create_user("operator")
+        self.user.groups.add(self.operators)
+        self.permission = RancidGroupPermission.objects.create(rancidGroup="CORE",djangoGroup=self.operators)
+
+    def permitted(self):
+        '''Groups for the user as a new request would see them'''
+        return(sorted(get_permitted_groups(User.objects.get(pk=self.user.pk))))
+
+    def test_cached(self):
+        self.assertEqual(self.permitted(),["CORE"])
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_permitted_groups(user),["CORE"])
+
+    def test_permission_changes(self):
+        self.assertEqual(self.permitted(),["CORE"])
+        RancidGroupPermission.objects.create(rancidGroup="EDGE",djangoGroup=self.operators)
+        self.assertEqual(self.permitted(),["CORE","EDGE"])
+        self.permission.delete()
+        self.assertEqual(self.permitted(),["EDGE"])
+
+    def test_membership_changes(self):
+        self.assertEqual(self.permitted(),["CORE"])
+        self.user.groups.remove(self.operators)
+        self.assertEqual(self.permitted(),[])
+        self.operators.user_set.add(self.user)
+        self.assertEqual(self.permitted(),["CORE"])
+        self.user.groups.clear()
+        self.assertEqual(self.permitted(),[])
+
+
+class QueryMetricsTests(TestCase):
+    def test_counted_without_debug_cursor(self):
+        logged = len(connection.queries_log)
+        with collecting() as work:
+            self.assertFalse(connection.queries_logged)
+            list(Device.objects.all())
+            Device.objects.count()
+        self.assertEqual(work.counts['db'],2)
+        self.assertEqual(len(connection.queries_log),logged)
+
+    def test_counted_with_debug_cursor(self):
+        with CaptureQueriesContext(connection) as queries,collecting() as outer:
+            with collecting() as inner:
+                Device.objects.count()
+            Device.objects.count()
+        self.assertEqual(len(queries),2)
+        self.assertEqual((inner.counts['db'],outer.counts['db']),(1,2))
@@ -1,5 +1,5 @@
 from django.conf.urls import url
-from .views import NewGroup,GroupDetails,NewDevice,DeviceDetails,ConfirmGroup,ConfirmDevice,Config,Changes
+from .views import NewGroup,GroupDetails,NewDevice,DeviceDetails,ConfirmGroup,ConfirmDevice,Config,ConfigAt,ConfigRaw,Compare,Changes,Search,Jobs,JobStatus,Collect
 
 urlpatterns = [
     url(r'addgroup/',NewGroup.as_view(),name='NewGroup'),
@@ -8,6 +8,14 @@ urlpatterns = [
     url(r'devicedetails/(?P<group>.*)/(?P<device>.*)/',DeviceDetails.as_view(),name='DeviceDetails'),
     url(r'confirmgroup/(?P<name>.*)/',ConfirmGroup.as_view(),name='ConfirmGroup'),
     url(r'confirmdevice/(?P<group>.*)/(?P<name>.*)/',ConfirmDevice.as_view(),name='ConfirmDevice'),
+    url(r'rawconfig/(?P<group>.*)/(?P<name>.*)/',ConfigRaw.as_view(),name='ConfigRaw'),
+    url(r'configat/(?P<group>.*)/(?P<name>.*)/',ConfigAt.as_view(),name='ConfigAt'),
     url(r'config/(?P<group>.*)/(?P<name>.*)/',Config.as_view(),name='Config'),
     url(r'changes/(?P<group>.*)/(?P<name>.*)/',Changes.as_view(),name='Changes'),
+    url(r'collect/(?P<group>[^/]*)/(?P<device>.*)/',Collect.as_view(),name='CollectDevice'),
+    url(r'collect/(?P<group>[^/]*)/',Collect.as_view(),name='CollectGroup'),
+    url(r'compare/',Compare.as_view(),name='Compare'),
+    url(r'search/',Search.as_view(),name='Search'),
+    url(r'jobs/(?P<jobId>[0-9]+)/',JobStatus.as_view(),name='JobStatus'),
+    url(r'jobs/',Jobs.as_view(),name='Jobs'),
 ]
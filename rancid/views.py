@@ -1,22 +1,43 @@
 import os
+import datetime
 import logging
 from base64 import b64encode,b64decode
 from django.shortcuts import render,redirect
-from django.http import HttpResponse,Http404
+from django.http import HttpResponse,Http404,JsonResponse,StreamingHttpResponse
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import Group
 from django.views import View
+from django.utils.cache import get_conditional_response,patch_cache_control,patch_vary_headers
+from django.utils.http import http_date
+from django.utils import timezone
+from django.utils.dateparse import parse_date,parse_datetime
+from django.utils.text import compress_sequence
 from django import forms
 from rancid.lib.main import DjancidGroup,DjancidDevice,get_permitted_groups
-from rancid.lib.fileops import RancidConf,Cloginrc,RouterDB
-from rancid.lib.gitops import get_config,get_config_diffs
-from rancid.models import RancidGroupPermission
+from rancid.lib.fileops import FileLock,RouterDB,RancidRunBusy
+from rancid.lib.gitops import compare_configs,get_config,get_config_at,get_config_diff_page,get_config_validators,iter_config_chunks
+from rancid.lib.search import MIN_QUERY_LENGTH,search_configs
+from rancid.lib.jobs import visible_jobs,enqueue_collection
+from rancid.lib.metrics import address_allowed,render_metrics
+from rancid.models import RancidGroupPermission,Job
 from rancid.forms import GroupForm,DeviceForm
 
-rcFile = RancidConf()
-
 class BaseView(LoginRequiredMixin,View):
+    def dispatch(self,request,*args,**kwargs):
+        try:
+            return(super(BaseView,self).dispatch(request,*args,**kwargs))
+        except RancidRunBusy as e:
+            return(self.busy(str(e)))
+        except FileLock.LockTimeout:
+            return(self.busy("Another change to these settings is in progress, try again shortly"))
+
+    def busy(self,message):
+        '''503 asking the client to retry an edit that rancid-run or another edit held up'''
+        response = HttpResponse(message,status=503)
+        response['Retry-After'] = "30"
+        return(response)
+
     def ip_to_b64(self,ipStr):
         b64encoded = b64encode(bytes(ipStr,'ascii')).decode('ascii')
         return(b64encoded)
@@ -25,14 +46,28 @@ class BaseView(LoginRequiredMixin,View):
         ipStr = b64decode(bytes(b64encoded,'ascii')).decode('ascii')
         return(ipStr)
 
+    def parse_time(self,value):
+        '''Aware datetime from an ISO date or date and time, naive values being in the
+        current time zone. A bare date means the end of that day. Raises Http404'''
+        try:
+            when = parse_datetime(value)
+            if when is None and parse_date(value) is not None:
+                when = datetime.datetime.combine(parse_date(value),datetime.time.max)
+        except ValueError:
+            when = None
+        if when is None:
+            raise(Http404("Invalid time"))
+        if timezone.is_naive(when):
+            when = timezone.make_aware(when)
+        return(when)
+
 
 class AllDevices(BaseView):
     def get(self,request):
         permitted_groups = get_permitted_groups(request.user)
         context = {}
         groups = [DjancidGroup(gp) for gp in permitted_groups]
-        for groupObj in groups:
-            groupObj.djDevices = [DjancidDevice(dev['ip'],groupObj) for dev in groupObj.devices]
+        DjancidGroup.loadDevices(groups)
         context['groups'] = groups
         return(render(request,'rancid/AllDevices.html',context))
 
@@ -55,12 +90,7 @@ class NewGroup(BaseView):
                     groupObj.putSetting(settingName,settingValue)
                 elif settingName.startswith("perm_"):
                     if settingValue:
-                        rgp,created = RancidGroupPermission.objects.get_or_create(
-                                rancidGroup=groupObj.name,
-                                djangoGroup=settingName.replace("perm_","")
-                            )
-                        if created:
-                            rgp.save()
+                        groupObj.addPermission(Group.objects.get(name=settingName.replace("perm_","")))
             groupObj.save()
         else:
             return(HttpResponse(form.errors))
@@ -89,7 +119,7 @@ class GroupDetails(BaseView):
         if group in permitted_groups:
             context = {}
             groupObj = DjancidGroup(group)
-            groupObj.djDevices = [DjancidDevice(d['ip'],groupObj) for d in groupObj.devices]
+            DjancidGroup.loadDevices([groupObj])
             groupObj.fillAllSettings()
             form = self.prepForm(groupObj)
             if not request.user.is_staff:
@@ -98,6 +128,7 @@ class GroupDetails(BaseView):
                         fieldValue.widget = forms.HiddenInput()
             context['form'] = form
             context['group'] = groupObj
+            context['jobs'] = visible_jobs(request.user,[group]).filter(status__in=[Job.QUEUED,Job.RUNNING])
             return(render(request,'rancid/GroupDetails.html',context))
         else:
             return(redirect("/"))
@@ -121,7 +152,7 @@ class GroupDetails(BaseView):
                     else:
                         groupObj.deletePermission(djangoGroup)
             groupObj.save()
-            groupObj.djDevices = [DjancidDevice(d['ip'],groupObj) for d in groupObj.devices]
+            DjancidGroup.loadDevices([groupObj])
             context = {}
             context['form'] = form
             context['group'] = groupObj
@@ -133,7 +164,8 @@ class GroupDetails(BaseView):
 class NewDevice(BaseView):
     def prepForm(self,deviceObj,request):
         deviceObj.fillAllSettings()
-        settingsDict = dict(deviceObj.allSettings)
+        # The form offers one connection method, the first clogin tries
+        settingsDict = dict([(k,v[0] if isinstance(v,list) else v) for k,v in deviceObj.allSettings.items()])
         for passwordSetting in ["password","enablepassword"]:
             if passwordSetting in settingsDict.keys():
                 settingsDict[passwordSetting] = "00000000"
@@ -197,6 +229,9 @@ class DeviceDetails(NewDevice):
                     if fieldName in groupObj.allSettings.keys():
                         fieldValue.label = "{l} (i)".format(l=fieldValue.label)
             context['form'] = form
+            context['jobs'] = visible_jobs(request.user,[group]).filter(
+                status__in=[Job.QUEUED,Job.RUNNING],kind__in=["collect-group","collect-device"],target__in=["",device]
+            )
             return(render(request,'rancid/DeviceDetails.html',context))
         else:
             raise(Http404("Permission Error"))
@@ -240,7 +275,7 @@ class ConfirmGroup(BaseView):
             context = {}
             groupObj = DjancidGroup(name)
             if groupObj.devices:
-                alsoDeleting = [DjancidDevice(dev['ip']) for dev in groupObj.devices]
+                alsoDeleting = DjancidGroup.loadDevices([groupObj])
                 context['alsoDeleting'] = alsoDeleting
             context['group'] = groupObj
             return(render(request,'rancid/ConfirmGroup.html',context))
@@ -289,17 +324,126 @@ class Config(BaseView):
         if group in permitted_groups:
             context = {}
             device = self.b64_to_ip(name)
+            etag,lastModified = get_config_validators(group,device)
+            if etag is not None:
+                etag = "{e}-{s:d}\"".format(e=etag[:-1],s=request.user.is_staff)
+                response = get_conditional_response(request,etag=etag,last_modified=lastModified)
+                if response is not None:
+                    return(response)
             groupObj = DjancidGroup(group)
             deviceObj = DjancidDevice(device,groupObj)
-            config = get_config(group,device)
-            context['config'] = config.replace("\n","<br>")
+            context['config'] = get_config(group,device)
             context['device'] = deviceObj
             context['group'] = groupObj
+            response = render(request,'rancid/Config.html',context)
+            if etag is not None:
+                response['ETag'] = etag
+                response['Last-Modified'] = http_date(lastModified)
+                patch_cache_control(response,private=True,no_cache=True)
+                patch_vary_headers(response,["Cookie"])
+            return(response)
+        else:
+            raise(Http404("Permission Error"))
+
+
+class ConfigAt(BaseView):
+    '''A device's config as of ?at=<datetime> or ?commit=<revision>, read from git objects'''
+    def get(self,request,group,name):
+        permitted_groups = get_permitted_groups(request.user)
+        if group in permitted_groups:
+            device = self.b64_to_ip(name)
+            at = request.GET.get("at")
+            revision = request.GET.get("commit")
+            if not at and not revision:
+                return(redirect("Config",group=group,name=name))
+            when = self.parse_time(at) if at else None
+            try:
+                config,revisionInfo = get_config_at(group,device,revision,when)
+            except ValueError:
+                raise(Http404("Unknown revision"))
+            groupObj = DjancidGroup(group)
+            context = {}
+            context['config'] = config if config is not None else "No configuration existed for this device at that time"
+            context['revision'] = revisionInfo
+            context['at'] = at
+            context['device'] = DjancidDevice(device,groupObj)
+            context['group'] = groupObj
             return(render(request,'rancid/Config.html',context))
         else:
             raise(Http404("Permission Error"))
 
 
+class Compare(BaseView):
+    '''Diff two configs. a and b are "<group>/<b64 device>", b defaulting to a. ra and rb
+    are each a commit or a time, the latest commit when empty'''
+    def side(self,request,key,default=None):
+        value = request.GET.get(key) or default
+        try:
+            group,name = value.split("/",1)
+            device = self.b64_to_ip(name)
+        except (AttributeError,ValueError):
+            raise(Http404("Invalid device"))
+        return((group,name,device))
+
+    def revision(self,request,key):
+        value = request.GET.get(key,"").strip()
+        if not value:
+            return((None,None))
+        try:
+            return((None,self.parse_time(value)))
+        except Http404:
+            return((value,None))
+
+    def get(self,request):
+        permitted_groups = get_permitted_groups(request.user)
+        groupA,nameA,deviceA = self.side(request,"a")
+        groupB,nameB,deviceB = self.side(request,"b",request.GET.get("a"))
+        if groupA not in permitted_groups or groupB not in permitted_groups:
+            raise(Http404("Permission Error"))
+        revisionA,whenA = self.revision(request,"ra")
+        revisionB,whenB = self.revision(request,"rb")
+        try:
+            comparison = compare_configs(groupA,deviceA,groupB,deviceB,revisionA,whenA,revisionB,whenB)
+        except ValueError:
+            raise(Http404("Unknown revision"))
+        context = {}
+        context['comparison'] = comparison
+        context['a'] = {"group":groupA,"name":deviceA,"b64code":nameA,"revision":request.GET.get("ra","")}
+        context['b'] = {"group":groupB,"name":deviceB,"b64code":nameB,"revision":request.GET.get("rb","")}
+        return(render(request,'rancid/Compare.html',context))
+
+
+class ConfigRaw(BaseView):
+    '''Latest config as plain text, streamed from disk and gzipped when the client accepts it'''
+    def get(self,request,group,name):
+        permitted_groups = get_permitted_groups(request.user)
+        if group in permitted_groups:
+            device = self.b64_to_ip(name)
+            etag,lastModified = get_config_validators(group,device)
+            if etag is None:
+                raise(Http404("No configuration backups have been made for this device"))
+            gzipped = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING","")
+            if gzipped:
+                # The gzipped body is a different representation, so it has its own ETag
+                etag = '{e}-gzip"'.format(e=etag[:-1])
+            response = get_conditional_response(request,etag=etag,last_modified=lastModified)
+            if response is not None:
+                return(response)
+            chunks = iter_config_chunks(group,device)
+            if gzipped:
+                response = StreamingHttpResponse(compress_sequence(chunks),content_type="text/plain; charset=utf-8")
+                response['Content-Encoding'] = "gzip"
+            else:
+                response = StreamingHttpResponse(chunks,content_type="text/plain; charset=utf-8")
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(lastModified)
+            patch_cache_control(response,private=True,no_cache=True)
+            patch_vary_headers(response,["Accept-Encoding","Cookie"])
+            return(response)
+        else:
+            raise(Http404("Permission Error"))
+
+
 class Changes(BaseView):
     def get(self,request,group,name):
         permitted_groups = get_permitted_groups(request.user)
@@ -308,10 +452,76 @@ class Changes(BaseView):
             groupObj = DjancidGroup(group)
             deviceObj = DjancidDevice(device,groupObj)
             context = {}
-            diffs = get_config_diffs(group,device)
-            context['diffs'] = diffs
+            try:
+                pageSize = min(int(request.GET.get("size",settings.CHANGES_PAGE_SIZE)),settings.CHANGES_MAX_PAGE_SIZE)
+                page = get_config_diff_page(group,device,max(pageSize,1),request.GET.get("before"))
+            except ValueError:
+                raise(Http404("Invalid page"))
+            context['diffs'] = page['diffs']
+            context['page'] = page
+            context['pageSize'] = pageSize
             context['device'] = deviceObj
             context['group'] = groupObj
             return(render(request,'rancid/Changes.html',context))
         else:
             raise(Http404("Permission Error"))
+
+
+class Search(BaseView):
+    def get(self,request):
+        query = request.GET.get("q","")
+        context = {"query":query,"results":[],"minLength":MIN_QUERY_LENGTH}
+        if len(query) >= MIN_QUERY_LENGTH:
+            permitted_groups = get_permitted_groups(request.user)
+            for group,device,lines in search_configs(query,permitted_groups):
+                context['results'].append({"group":group,"name":device,"b64code":self.ip_to_b64(device),"lines":lines})
+            context['truncated'] = len(context['results']) >= settings.SEARCH_MAX_RESULTS
+        return(render(request,'rancid/Search.html',context))
+
+
+class Collect(BaseView):
+    '''Queue rancid-run for a group, or for one device of its router.db when a device is given'''
+    def post(self,request,group,device=None):
+        permitted_groups = get_permitted_groups(request.user)
+        if group in permitted_groups:
+            if device is None:
+                enqueue_collection(group)
+                return(redirect("GroupDetails",group=group))
+            deviceName = self.b64_to_ip(device)
+            try:
+                RouterDB(group).getRouterDetails(deviceName)
+            except (FileNotFoundError,RouterDB.RouterNotFoundException):
+                raise(Http404("Device not found"))
+            enqueue_collection(group,deviceName)
+            return(redirect("DeviceDetails",group=group,device=device))
+        else:
+            raise(Http404("Permission Error"))
+
+
+class Jobs(BaseView):
+    def get(self,request):
+        permitted_groups = get_permitted_groups(request.user)
+        context = {}
+        context['jobs'] = visible_jobs(request.user,permitted_groups).order_by("-id")[:settings.JOBS_PAGE_SIZE]
+        return(render(request,'rancid/Jobs.html',context))
+
+
+class JobStatus(BaseView):
+    def get(self,request,jobId):
+        permitted_groups = get_permitted_groups(request.user)
+        job = visible_jobs(request.user,permitted_groups).filter(id=jobId).first()
+        if job is None:
+            raise(Http404("Permission Error"))
+        return(JsonResponse({
+            "id":job.id,"kind":job.kind,"group":job.rancidGroup,"target":job.target,"status":job.status,
+            "created":job.created,"started":job.started,"finished":job.finished,"output":job.output,
+        }))
+
+
+class Metrics(View):
+    '''Request histograms and library counters in the Prometheus text format. Scrapers
+    cannot log in, so this is open to the addresses in METRICS_ALLOWED_IPS instead'''
+    def get(self,request):
+        if not address_allowed(request.META.get("REMOTE_ADDR",""),settings.METRICS_ALLOWED_IPS):
+            raise(Http404("Permission Error"))
+        return(HttpResponse(render_metrics(),content_type="text/plain; version=0.0.4; charset=utf-8"))